@@ -40,6 +40,7 @@ import sys
 import argparse
 from tarfile import ReadError
 from elastic_blast.filehelper import open_for_read, open_for_write, copy_to_bucket
+from elastic_blast.filehelper import start_bucket_upload
 from elastic_blast.split import FASTAReader
 from elastic_blast.jobs import write_job_files
 from elastic_blast.constants import ELB_QUERY_BATCH_FILE_PREFIX
@@ -72,6 +73,8 @@ def parse_arguments():
         help='Variable substitutes in form var1=vale1,var2=value2 ...')
     parser.add_argument('-m', '--manifest',  default='',
         help='manifest file to write')
+    parser.add_argument('--single-job-file', action='store_true',
+        help='write all jobs to one multi-document YAML file')
     parser.add_argument('-c', '--count',  default='',
         help='file to report total number of bases/residues in input file')
     parser.add_argument("-n", "--dry-run", action='store_true', 
@@ -110,11 +113,21 @@ def main():
     subs = { key: value for key, value in filter(lambda x: len(x) == 2 and x[0], map(lambda x: x.split('='), args.subs.split(','))) }
     subs['RESULTS'] = res_path
     total_count = 0
+    if not dry_run:
+        # upload batches to the bucket while the input is being split
+        start_bucket_upload()
     try:
-        with open_for_read(input_path) as s:
+        jobs = []
+        with open_for_read(input_path, ranged=True) as s:
             reader = FASTAReader(s, batch_len, out_path)
-            total_count, queries = reader.read_and_cut()
-        jobs = write_job_files(job_path, ELB_QUERY_BATCH_FILE_PREFIX, job_template_text, queries, **subs)
+            if job_template_text:
+                # job files are written as soon as their query batches are
+                queries = (batch.name for batch in reader.iter_batches())
+                jobs = write_job_files(job_path, ELB_QUERY_BATCH_FILE_PREFIX, job_template_text, queries,
+                                       single_file=args.single_job_file, **subs)
+            else:
+                reader.read_and_cut()
+            total_count = reader.total_count
         if count_file:
             if count_file == '-':
                 sys.stdout.write(str(total_count)+'\n')
@@ -0,0 +1,137 @@
+#                           PUBLIC DOMAIN NOTICE
+#              National Center for Biotechnology Information
+#
+# This software is a "United States Government Work" under the
+# terms of the United States Copyright Act.  It was written as part of
+# the authors' official duties as United States Government employees and
+# thus cannot be copyrighted.  This software is freely available
+# to the public for use.  The National Library of Medicine and the U.S.
+# Government have not placed any restriction on its use or reproduction.
+#
+# Although all reasonable efforts have been taken to ensure the accuracy
+# and reliability of the software and data, the NLM and the U.S.
+# Government do not and cannot warrant the performance or results that
+# may be obtained by using this software or data.  The NLM and the U.S.
+# Government disclaim all warranties, express or implied, including
+# warranties of performance, merchantability or fitness for any particular
+# purpose.
+#
+# Please cite NCBI in any work or product based on this material.
+
+
+# Node-level BLAST database cache shared by all jobs on an instance. Each
+# database version is downloaded and checked once into its own subdirectory,
+# an entry, named by db_cache_key. An entry is complete once it has the
+# DB_CACHE_VERIFIED marker file, whose modification time tracks the last use
+# of the entry.
+#
+# Jobs hold a shared flock on NAME.in-use for the life of the process for the
+# entry NAME they use, so that other jobs running on the same node do not
+# evict it. Downloads of an entry are serialized with NAME.lock, and
+# evictions with eviction.lock.
+
+import os
+import re
+import fcntl
+import shutil
+import filelock
+from hashlib import md5
+from typing import Callable, IO, List, Optional
+
+# Marker file for database cache entries that passed integrity checks
+DB_CACHE_VERIFIED = '.verified'
+# Least recently used cache entries are removed before a download until
+# at least this fraction of the disk is free
+DB_CACHE_MIN_FREE_FRACTION = 0.25
+
+
+def db_cache_key(db: str, source: str, mol_type: str, version: Optional[str]) -> str:
+    """ Name of the database cache entry: database name and a digest of
+        database location, molecule type, and version of its files.
+        Without a version the entry is never considered stale. """
+    digest = md5(f'{db}\t{source}\t{mol_type}\t{version or ""}'.encode()).hexdigest()
+    sanitized = re.sub(r'[^-A-Za-z0-9.]', '-', db)
+    return f'{sanitized}_{digest}'
+
+
+class DbCache:
+    """ Database cache in a local directory """
+
+    def __init__(self, path: str, min_free_fraction: float = DB_CACHE_MIN_FREE_FRACTION,
+                 log: Callable[[str], None] = print):
+        """ Initialize the cache
+        Arguments:
+            path: Cache directory, created if it does not exist
+            min_free_fraction: Fraction of the disk kept free by evictions
+            log: Function printing progress messages
+        """
+        self.path = path
+        self.min_free_fraction = min_free_fraction
+        self.log = log
+        self.in_use: Optional[IO] = None
+        os.makedirs(path, exist_ok=True)
+
+    def lock(self, key: str) -> None:
+        """ Take a shared lock marking the cache entry as in use by this
+            process, release the lock on the entry used before """
+        f = open(os.path.join(self.path, key + '.in-use'), 'a')
+        fcntl.flock(f, fcntl.LOCK_SH)
+        if self.in_use:
+            self.in_use.close()
+        self.in_use = f
+
+    def evict(self, keep: str) -> List[str]:
+        """ Remove least recently used cache entries, other than keep and the
+            ones in use by other processes, until enough disk space is free
+            Returns:
+                Names of removed entries
+        """
+        entries = []
+        for name in os.listdir(self.path):
+            path = os.path.join(self.path, name)
+            if name != keep and os.path.isdir(path):
+                verified = os.path.join(path, DB_CACHE_VERIFIED)
+                last_used = os.path.getmtime(verified if os.path.exists(verified) else path)
+                entries.append((last_used, name))
+        evicted = []
+        for _, name in sorted(entries):
+            total, _, free = shutil.disk_usage(self.path)
+            if free >= total * self.min_free_fraction:
+                break
+            with open(os.path.join(self.path, name + '.in-use'), 'a') as f:
+                try:
+                    fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except BlockingIOError:
+                    continue
+                self.log(f'Evicting database cache entry {name}')
+                shutil.rmtree(os.path.join(self.path, name))
+                evicted.append(name)
+        return evicted
+
+    def get(self, key: str, fill: Callable[[str], None]) -> str:
+        """ Return the absolute path of cache entry key, locked as in use by
+            this process. The entry is filled, in the mutually exclusive
+            manner, only if it is not already complete.
+            Arguments:
+                key: Entry name, see db_cache_key
+                fill: Function downloading and checking the database in
+                      the directory given as its argument, raises an
+                      exception on failure
+        """
+        entry = os.path.join(self.path, key)
+        self.lock(key)
+        verified = os.path.join(entry, DB_CACHE_VERIFIED)
+        with filelock.FileLock(os.path.join(self.path, key + '.lock')):
+            if os.path.exists(verified):
+                self.log(f'Database found in cache entry {entry}')
+            else:
+                with filelock.FileLock(os.path.join(self.path, 'eviction.lock')):
+                    self.evict(key)
+                # remove leftovers of an interrupted download
+                shutil.rmtree(entry, ignore_errors=True)
+                os.makedirs(entry)
+                fill(entry)
+                with open(verified, 'w'): pass
+            # modification time of the marker tracks the last use
+            os.utime(verified)
+        return os.path.abspath(entry)
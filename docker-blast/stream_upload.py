@@ -0,0 +1,138 @@
+#                           PUBLIC DOMAIN NOTICE
+#              National Center for Biotechnology Information
+#
+# This software is a "United States Government Work" under the
+# terms of the United States Copyright Act.  It was written as part of
+# the authors' official duties as United States Government employees and
+# thus cannot be copyrighted.  This software is freely available
+# to the public for use.  The National Library of Medicine and the U.S.
+# Government have not placed any restriction on its use or reproduction.
+#
+# Although all reasonable efforts have been taken to ensure the accuracy
+# and reliability of the software and data, the NLM and the U.S.
+# Government do not and cannot warrant the performance or results that
+# may be obtained by using this software or data.  The NLM and the U.S.
+# Government disclaim all warranties, express or implied, including
+# warranties of performance, merchantability or fitness for any particular
+# purpose.
+#
+# Please cite NCBI in any work or product based on this material.
+
+
+# Pipeline of a command whose output is compressed and uploaded on the fly,
+# used to upload BLAST results to AWS S3 without writing them to local disk.
+#
+# An upload command reading from stdin, like aws s3 cp -, completes the upload
+# when its input ends. If the command fails, the uploader is interrupted with
+# SIGINT before the compressor ends its output, so that it cancels the
+# upload, including its multipart upload, instead of completing it with
+# partial output or leaving the multipart upload incomplete as it would if it
+# were killed.
+
+import os
+import signal
+import threading
+import subprocess
+from dataclasses import dataclass
+from typing import List
+
+# Time in seconds given to an interrupted uploader to cancel the upload
+# before it is killed
+UPLOAD_CANCEL_TIMEOUT = 60
+
+
+class StreamError(Exception):
+    """ A command of the pipeline failed
+    Attributes:
+        returncode: exit code of the command
+        message: error message
+        stderr: standard error of the streamed command
+    """
+    def __init__(self, returncode: int, message: str, stderr: bytes):
+        super().__init__(message)
+        self.returncode = returncode
+        self.message = message
+        self.stderr = stderr
+
+
+@dataclass
+class StreamResult:
+    """ Output of a successful pipeline """
+    # beginning of the output of the streamed command, at least preview_lines
+    # lines unless the output is shorter
+    head: bytes
+    # standard error of the streamed command
+    stderr: bytes
+
+
+def _drain(stream, output: List[bytes]) -> threading.Thread:
+    """ Read a stream to the end in a background thread, collecting data in
+        the output list """
+    thread = threading.Thread(target=lambda: output.append(stream.read()), daemon=True)
+    thread.start()
+    return thread
+
+
+def _cancel_upload(upload: subprocess.Popen) -> None:
+    """ Interrupt the uploader so that it cancels the upload, kill it if it
+        does not exit in time """
+    upload.send_signal(signal.SIGINT)
+    try:
+        upload.wait(UPLOAD_CANCEL_TIMEOUT)
+    except subprocess.TimeoutExpired:
+        upload.kill()
+
+
+def stream(cmd: List[str], compress_cmd: List[str], upload_cmd: List[str],
+           chunk_size: int, preview_lines: int) -> StreamResult:
+    """ Run cmd with its output, read from a pipe in chunks of chunk_size
+        bytes, compressed by compress_cmd and uploaded by upload_cmd, both
+        reading stdin and the former writing stdout.
+        Raises:
+            StreamError if any command failed; the upload is cancelled
+    """
+    upload = subprocess.Popen(upload_cmd, stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+    compress = subprocess.Popen(compress_cmd, stdin=subprocess.PIPE, stdout=upload.stdin, stderr=subprocess.PIPE)
+    # the compressor holds the upload pipe
+    upload.stdin.close()
+    # the command may run under time in its own process group, so that the
+    # whole group can be killed
+    proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, start_new_session=True)
+    proc_err: List[bytes] = []
+    compress_err: List[bytes] = []
+    upload_out: List[bytes] = []
+    drains = [_drain(proc.stderr, proc_err), _drain(compress.stderr, compress_err),
+              _drain(upload.stdout, upload_out)]
+    head = b''
+    broken = False
+    try:
+        for chunk in iter(lambda: proc.stdout.read(chunk_size), b''):
+            if head.count(b'\n') < preview_lines:
+                head += chunk
+            compress.stdin.write(chunk)
+    except BrokenPipeError:
+        # compression or upload failed, the error is reported below
+        broken = True
+        os.killpg(proc.pid, signal.SIGKILL)
+    proc.wait()
+    proc.stdout.close()
+    if proc.returncode and not broken:
+        # do not let partial output be uploaded
+        _cancel_upload(upload)
+    try:
+        compress.stdin.close()
+    except BrokenPipeError:
+        pass
+    compress.wait()
+    upload.wait()
+    for thread in drains:
+        thread.join()
+    stderr = b''.join(proc_err)
+    checks = [(cmd, proc, proc_err), (compress_cmd, compress, compress_err), (upload_cmd, upload, upload_out)]
+    if broken:
+        # the failing process is at the end of the pipeline
+        checks.reverse()
+    for c, p, err in checks:
+        if p.returncode:
+            raise StreamError(p.returncode, f'The command "{" ".join(c)}" returned with exit code {p.returncode}\n{b"".join(err).decode()}', stderr)
+    return StreamResult(head, stderr)
@@ -0,0 +1,305 @@
+#                           PUBLIC DOMAIN NOTICE
+#              National Center for Biotechnology Information
+#
+# This software is a "United States Government Work" under the
+# terms of the United States Copyright Act.  It was written as part of
+# the authors' official duties as United States Government employees and
+# thus cannot be copyrighted.  This software is freely available
+# to the public for use.  The National Library of Medicine and the U.S.
+# Government have not placed any restriction on its use or reproduction.
+#
+# Although all reasonable efforts have been taken to ensure the accuracy
+# and reliability of the software and data, the NLM and the U.S.
+# Government do not and cannot warrant the performance or results that
+# may be obtained by using this software or data.  The NLM and the U.S.
+# Government disclaim all warranties, express or implied, including
+# warranties of performance, merchantability or fitness for any particular
+# purpose.
+#
+# Please cite NCBI in any work or product based on this material.
+
+# Work queue of query batches shared by persistent workers running on any
+# number of nodes. The queue is kept in AWS S3, usually in the results
+# bucket, or in a local directory for testing. Workers coordinate only with
+# conditional writes: the first write of an item's state claims it, and
+# later writes succeed only if the state was not changed by another worker
+# in the meantime.
+#
+# Queue layout:
+#   batches       - list of query batches, one per line, written once
+#   items/NNNNNN  - state of the query batch with index NNNNNN: the worker
+#                   that claimed it, its lease expiration time, and whether
+#                   it is claimed, done, or failed
+#   done/NNNNNN   - written once the query batch with index NNNNNN is done or
+#                   failed
+#
+# A claim is a lease that the worker renews while it searches the batch. Items
+# whose lease expired, for example because the worker or its node was
+# terminated, are claimed again by other workers.
+#
+# Workers poll the queue with object listings only: finished batches are
+# found by their done/ markers and leases that may have expired by the
+# modification times of their items, so an item is read only when its lease
+# is about to be taken over. Modification times come from the storage clock,
+# which needs to agree with workers' clocks only to well within the lease
+# time.
+
+import os
+import json
+import time
+import socket
+import uuid
+import hashlib
+import filelock
+from dataclasses import dataclass
+from typing import Dict, List, Optional, Tuple, Union
+
+# Time in seconds a claimed item stays reserved for its worker without
+# renewal of the lease
+WORK_QUEUE_LEASE_SECONDS = 600
+
+STATE_CLAIMED = 'claimed'
+STATE_DONE = 'done'
+STATE_FAILED = 'failed'
+
+BATCHES_KEY = 'batches'
+ITEMS_PREFIX = 'items/'
+DONE_PREFIX = 'done/'
+
+
+class S3Store:
+    """ Queue storage in AWS S3 with conditional writes """
+
+    def __init__(self, url: str, client=None):
+        """ Initialize storage
+        Arguments:
+            url: Queue location as s3://bucket/prefix
+            client: boto3 S3 client, created if not provided
+        """
+        bucket, _, prefix = url[len('s3://'):].partition('/')
+        self.bucket = bucket
+        self.prefix = prefix.rstrip('/') + '/' if prefix else ''
+        if client is None:
+            import boto3  # type: ignore
+            client = boto3.client('s3')
+        self.s3 = client
+
+    def get(self, key: str) -> Optional[Tuple[str, str]]:
+        """ Return content and version tag of an object, or None if it does
+        not exist """
+        try:
+            resp = self.s3.get_object(Bucket=self.bucket, Key=self.prefix + key)
+        except self.s3.exceptions.NoSuchKey:
+            return None
+        return resp['Body'].read().decode(), resp['ETag']
+
+    def put(self, key: str, body: str, etag: Optional[str] = None) -> Optional[str]:
+        """ Write an object only if it does not exist, or if etag is given,
+        only if its current version tag is etag.
+        Returns:
+            Version tag of the written object, None if the condition failed
+        """
+        condition = {'IfMatch': etag} if etag else {'IfNoneMatch': '*'}
+        try:
+            resp = self.s3.put_object(Bucket=self.bucket, Key=self.prefix + key,
+                                      Body=body.encode(), **condition)
+        except self.s3.exceptions.ClientError as e:
+            # ConditionalRequestConflict is returned for concurrent
+            # conditional writes of the same object
+            if e.response['Error']['Code'] in ('PreconditionFailed', 'ConditionalRequestConflict',
+                                               'NoSuchKey', '412', '409'):
+                return None
+            raise
+        return resp['ETag']
+
+    def list(self, prefix: str) -> Dict[str, float]:
+        """ Return modification times of objects in seconds since the epoch
+        by key, for keys starting with prefix """
+        result = {}
+        paginator = self.s3.get_paginator('list_objects_v2')
+        for page in paginator.paginate(Bucket=self.bucket, Prefix=self.prefix + prefix):
+            for obj in page.get('Contents', []):
+                result[obj['Key'][len(self.prefix):]] = obj['LastModified'].timestamp()
+        return result
+
+
+class LocalStore:
+    """ Queue storage in a local directory, conditional writes are
+    serialized with a lock file. Modification times of written files are set
+    from time.time(), the clock of lease expiration times. """
+
+    def __init__(self, path: str):
+        self.path = os.path.abspath(path)
+        os.makedirs(os.path.join(self.path, ITEMS_PREFIX), exist_ok=True)
+        os.makedirs(os.path.join(self.path, DONE_PREFIX), exist_ok=True)
+        self.lock = filelock.FileLock(os.path.join(self.path, '.lock'))
+
+    @staticmethod
+    def _etag(body: str) -> str:
+        return hashlib.md5(body.encode()).hexdigest()
+
+    def get(self, key: str) -> Optional[Tuple[str, str]]:
+        try:
+            with open(os.path.join(self.path, key)) as f:
+                body = f.read()
+        except FileNotFoundError:
+            return None
+        return body, self._etag(body)
+
+    def put(self, key: str, body: str, etag: Optional[str] = None) -> Optional[str]:
+        fname = os.path.join(self.path, key)
+        with self.lock:
+            current = self.get(key)
+            if (current[1] if current else None) != etag:
+                return None
+            with open(fname + '.tmp', 'w') as f:
+                f.write(body)
+            now = time.time()
+            os.utime(fname + '.tmp', (now, now))
+            os.replace(fname + '.tmp', fname)
+        return self._etag(body)
+
+    def list(self, prefix: str) -> Dict[str, float]:
+        directory, _, name_prefix = prefix.rpartition('/')
+        try:
+            names = os.listdir(os.path.join(self.path, directory))
+        except FileNotFoundError:
+            return {}
+        result = {}
+        for name in names:
+            if name.startswith(name_prefix) and not name.endswith('.tmp'):
+                key = os.path.join(directory, name)
+                try:
+                    result[key] = os.path.getmtime(os.path.join(self.path, key))
+                except FileNotFoundError:
+                    pass
+        return result
+
+
+@dataclass
+class WorkItem:
+    """ Query batch claimed by a worker """
+    index: int
+    query: str
+    etag: str
+
+
+class WorkQueue:
+    """ Work queue of query batches shared by workers """
+
+    def __init__(self, location: str, worker_id: Optional[str] = None,
+                 lease_seconds: int = WORK_QUEUE_LEASE_SECONDS, client=None):
+        """ Initialize the queue
+        Arguments:
+            location: Queue location, s3://bucket/prefix or a local directory
+            worker_id: Identifier of this worker recorded in claimed items
+            lease_seconds: Time a claimed item stays reserved without renewal
+            client: boto3 S3 client for a queue in AWS S3
+        """
+        self.store: Union[S3Store, LocalStore]
+        if location.startswith('s3://'):
+            self.store = S3Store(location, client)
+        else:
+            self.store = LocalStore(location)
+        self.worker_id = worker_id or f'{socket.gethostname()}-{os.getpid()}-{uuid.uuid4().hex[:8]}'
+        self.lease_seconds = lease_seconds
+        self._batches: Optional[List[str]] = None
+
+    def init(self, batches: List[str]) -> bool:
+        """ Fill the queue with query batches, unless it is already filled
+        Returns:
+            True if this call filled the queue
+        """
+        return self.store.put(BATCHES_KEY, '\n'.join(batches) + '\n') is not None
+
+    def exists(self) -> bool:
+        """ Return True if the queue was filled """
+        return self.batches() is not None
+
+    def batches(self) -> Optional[List[str]]:
+        """ List of query batches in the queue, or None if it was not filled """
+        if self._batches is None:
+            item = self.store.get(BATCHES_KEY)
+            if item:
+                self._batches = item[0].split()
+        return self._batches
+
+    @staticmethod
+    def _key(index: int, prefix: str = ITEMS_PREFIX) -> str:
+        return f'{prefix}{index:06d}'
+
+    def _state(self, state: str) -> str:
+        return json.dumps({'state': state, 'worker': self.worker_id,
+                           'expires': time.time() + self.lease_seconds})
+
+    def claim(self) -> Optional[WorkItem]:
+        """ Claim the next query batch. Batches never claimed are tried
+        first, then batches whose lease expired.
+        Returns:
+            Claimed item, or None if no batch can be claimed now
+        """
+        batches = self.batches() or []
+        items = self.store.list(ITEMS_PREFIX)
+        for index, query in enumerate(batches):
+            if self._key(index) in items:
+                continue
+            etag = self.store.put(self._key(index), self._state(STATE_CLAIMED))
+            if etag:
+                return WorkItem(index, query, etag)
+        finished = self.store.list(DONE_PREFIX)
+        now = time.time()
+        for index, query in enumerate(batches):
+            key = self._key(index)
+            # an item not modified for the lease time has an expired lease,
+            # unless it is finished
+            if key not in items or self._key(index, DONE_PREFIX) in finished or \
+                    items[key] + self.lease_seconds > now:
+                continue
+            current = self.store.get(key)
+            if not current:
+                continue
+            body, etag = current
+            state = json.loads(body)
+            if state['state'] != STATE_CLAIMED:
+                # the worker that finished the item stopped before marking it
+                self.store.put(self._key(index, DONE_PREFIX), state['state'])
+                continue
+            if state['expires'] > now:
+                continue
+            etag = self.store.put(key, self._state(STATE_CLAIMED), etag)
+            if etag:
+                return WorkItem(index, query, etag)
+        return None
+
+    def renew(self, item: WorkItem) -> bool:
+        """ Extend the lease of a claimed item
+        Returns:
+            False if the item was claimed by another worker after its lease
+            expired
+        """
+        return self._update(item, STATE_CLAIMED)
+
+    def finish(self, item: WorkItem, failed: bool = False) -> bool:
+        """ Mark a claimed item as done or failed
+        Returns:
+            False if the item was claimed by another worker after its lease
+            expired
+        """
+        state = STATE_FAILED if failed else STATE_DONE
+        if not self._update(item, state):
+            return False
+        self.store.put(self._key(item.index, DONE_PREFIX), state)
+        return True
+
+    def _update(self, item: WorkItem, state: str) -> bool:
+        etag = self.store.put(self._key(item.index), self._state(state), item.etag)
+        if not etag:
+            return False
+        item.etag = etag
+        return True
+
+    def drained(self) -> bool:
+        """ Return True if every query batch is done or failed """
+        batches = self.batches() or []
+        finished = self.store.list(DONE_PREFIX)
+        return all(self._key(index, DONE_PREFIX) in finished for index in range(len(batches)))
@@ -35,6 +35,7 @@ import inspect
 from tempfile import NamedTemporaryFile
 from timeit import default_timer as timer
 import uuid
+from concurrent.futures import Future, ThreadPoolExecutor, as_completed
 
 from pprint import pformat
 from pathlib import Path
@@ -44,6 +45,7 @@ from typing import Any, Dict, List, Tuple, Optional
 import boto3  # type: ignore
 from botocore.exceptions import ClientError, NoCredentialsError, ParamValidationError, WaiterError # type: ignore
 
+from tenacity import retry, retry_if_exception, stop_after_attempt, wait_random_exponential
 from dataclasses_json import dataclass_json
 from dataclasses import dataclass, field
 from copy import deepcopy
@@ -52,11 +54,16 @@ from .util import convert_labels_to_aws_tags, convert_disk_size_to_gb
 from .util import convert_memory_to_mb, UserReportError
 from .util import ElbSupportedPrograms, get_usage_reporting, sanitize_aws_batch_job_name
 from .util import get_resubmission_error_msg
+from .util import TokenBucket
+from .db_metadata import get_db_version
 from .constants import BLASTDB_ERROR, CLUSTER_ERROR, ELB_QUERY_LENGTH, PERMISSIONS_ERROR
 from .constants import ELB_QUERY_BATCH_DIR, ELB_METADATA_DIR
 from .constants import ELB_DOCKER_IMAGE_AWS, INPUT_ERROR, ELB_QS_DOCKER_IMAGE_AWS
 from .constants import DEPENDENCY_ERROR, TIMEOUT_ERROR
 from .constants import ELB_AWS_JOB_IDS, ELB_S3_PREFIX, ELB_GCS_PREFIX
+from .constants import ELB_AWS_QUERY_BATCH_LIST, ELB_AWS_BATCH_MAX_ARRAY_SIZE
+from .constants import ELB_AWS_BATCH_SUBMIT_JOB_TPS, ELB_AWS_BATCH_SUBMIT_JOB_THREADS
+from .constants import ELB_AWS_BATCH_SUBMIT_JOB_RETRIES, ELB_AWS_JOB_STATE_COUNTS_KEY
 from .constants import ELB_DFLT_NUM_BATCHES_FOR_TESTING, ELB_UNKNOWN_NUMBER_OF_QUERY_SPLITS
 from .constants import ElbStatus, ELB_CJS_DOCKER_IMAGE_AWS
 from .constants import ELB_AWS_JANITOR_CFN_TEMPLATE, ELB_DFLT_JANITOR_SCHEDULE_AWS
@@ -66,6 +73,7 @@ from .constants import AWS_JANITOR_ROLE_NAME, ELB_JANITOR_SCHEDULE
 from .constants import STATUS_MESSAGE_ERROR, STATUS_MESSAGE_VERBOSE
 from .filehelper import parse_bucket_name_key
 from .aws_traits import get_machine_properties, create_aws_config, get_availability_zones_for
+from .aws_traits import get_boto_client, get_boto_resource
 from .object_storage_utils import write_to_s3
 from .base import DBSource
 from .elb_config import ElasticBlastConfig, sanitize_aws_tag
@@ -76,6 +84,7 @@ CF_TEMPLATE = os.path.join(os.path.dirname(__file__), 'templates', 'elastic-blas
 # the order of job states reflects state transitions and is important for
 # ElasticBlastAws.get_job_ids method
 AWS_BATCH_JOB_STATES = ['SUBMITTED', 'PENDING', 'RUNNABLE', 'STARTING', 'RUNNING', 'SUCCEEDED', 'FAILED']
+AWS_BATCH_TERMINAL_JOB_STATES = ['SUCCEEDED', 'FAILED']
 SECONDS2SLEEP = 10
 
 def handle_aws_error(f):
@@ -96,6 +105,14 @@ def handle_aws_error(f):
     return wrapper
 
 
+def is_aws_throttling_error(err: BaseException) -> bool:
+    """ Is the exception an AWS API request rate exceeded error """
+    if not isinstance(err, ClientError):
+        return False
+    code = err.response.get('Error', {}).get('Code', '')
+    return code in ('TooManyRequestsException', 'ThrottlingException', 'Throttling')
+
+
 def check_cluster(cfg: ElasticBlastConfig) -> bool:
     """ Check that cluster described in configuration is running
         Parameters:
@@ -106,7 +123,7 @@ def check_cluster(cfg: ElasticBlastConfig) -> bool:
     if cfg.cluster.dry_run:
         return False
     boto_cfg = create_aws_config(cfg.aws.region)
-    cf = boto3.resource('cloudformation', config=boto_cfg)
+    cf = get_boto_resource('cloudformation', boto_cfg)
     try:
         cf_stack = cf.Stack(cfg.cluster.name)
         status = cf_stack.stack_status  # Will throw exception if error/non-existant
@@ -170,11 +187,11 @@ class ElasticBlastAws(ElasticBlast):
         self.stack_name = self.cfg.cluster.name
         logging.debug(f'CloudFormation stack name: {self.stack_name}')
 
-        self.cf = boto3.resource('cloudformation', config=self.boto_cfg)
-        self.batch = boto3.client('batch', config=self.boto_cfg)
-        self.s3 = boto3.resource('s3', config=self.boto_cfg)
-        self.iam = boto3.resource('iam', config=self.boto_cfg)
-        self.ec2 = boto3.resource('ec2', config=self.boto_cfg)
+        self.cf = get_boto_resource('cloudformation', self.boto_cfg)
+        self.batch = get_boto_client('batch', self.boto_cfg)
+        self.s3 = get_boto_resource('s3', self.boto_cfg)
+        self.iam = get_boto_resource('iam', self.boto_cfg)
+        self.ec2 = get_boto_resource('ec2', self.boto_cfg)
 
         # Per EB-1554, to prevent role names from getting longer than 64 characters
         MAX_USERNAME_LENGTH=38 
@@ -185,6 +202,9 @@ class ElasticBlastAws(ElasticBlast):
         self._provide_subnets()
         self.cf_stack = None
         self.job_ids = JobIds()
+        # AWS Batch job state counts of jobs that reached a terminal state,
+        # by job id, so that they are not described again in check_status
+        self.terminal_job_states: Dict[str, Dict[str, int]] = {}
 
         initialized = True
 
@@ -316,8 +336,12 @@ class ElasticBlastAws(ElasticBlast):
 
             params.append({'ParameterKey': 'UseSSD',
                            'ParameterValue': str(use_ssd).lower()})
+            use_job_state_events = 'ELB_USE_JOB_STATE_EVENTS' in os.environ
+            params.append({'ParameterKey': 'UseJobStateEvents',
+                           'ParameterValue': str(use_job_state_events).lower()})
             capabilities = []
-            if not (instance_role and batch_service_role and job_role and spot_fleet_role):
+            if not (instance_role and batch_service_role and job_role and spot_fleet_role) or \
+                    use_job_state_events:
                 # this is needed if cloudformation template creates roles
                 capabilities = ['CAPABILITY_NAMED_IAM']
 
@@ -379,6 +403,7 @@ class ElasticBlastAws(ElasticBlast):
         self.qs_job_definition_name = None
         self.js_job_definition_name = None
         self.compute_env_name = None
+        self.job_state_table_name = None
         if not self.dry_run and self.cf_stack and \
                self.cf_stack.stack_status == 'CREATE_COMPLETE':
             for output in self.cf_stack.outputs:
@@ -392,6 +417,8 @@ class ElasticBlastAws(ElasticBlast):
                     self.js_job_definition_name = output['OutputValue']
                 elif output['OutputKey'] == 'ComputeEnvName':
                     self.compute_env_name = output['OutputValue']
+                elif output['OutputKey'] == 'JobStateTableName':
+                    self.job_state_table_name = output['OutputValue']
 
             if self.job_queue_name:
                 logging.debug(f'JobQueueName: {self.job_queue_name}')
@@ -418,6 +445,10 @@ class ElasticBlastAws(ElasticBlast):
             else:
                 logging.warning('ComputeEnvName could not be read from CloudFormation stack')
 
+            if self.job_state_table_name:
+                logging.debug(f'JobStateTableName: {self.job_state_table_name}')
+                self.dynamodb = get_boto_client('dynamodb', self.boto_cfg)
+
     def _provide_subnets(self):
         """ Read subnets from config file or if not set try to get them from default VPC """
         if self.dry_run:
@@ -811,6 +842,10 @@ class ElasticBlastAws(ElasticBlast):
 
         if self.cfg.blast.taxidlist:
             parameters['taxidlist'] = self.cfg.blast.taxidlist
+        # Passed as an environment variable, which older worker images ignore
+        if self.cfg.blast.db_metadata:
+            overrides['environment'] = [{'name': 'ELB_DB_VERSION',
+                                         'value': get_db_version(self.cfg.blast.db_metadata)}]
 
         no_search = 'ELB_NO_SEARCH' in os.environ
         if no_search:
@@ -840,38 +875,12 @@ class ElasticBlastAws(ElasticBlast):
             logging.debug(f'For testing purposes will only process a subset of query batches: {nbatches2test}')
 
         start = timer()
-        for i, q in enumerate(query_batches):
-            parameters['query-batch'] = q
-            parameters['split-part'] = str(i)
-            jname = f'elasticblast-{self.owner}-{prog}-batch-{self.db_label}-job-{i}'
-            # add random search id for ElasticBLAST usage reporting
-            # and pass BLAST_USAGE_REPORT environment var to container
-            if usage_reporting:
-                overrides['environment'] = [{'name': 'BLAST_ELB_JOB_ID',
-                                             'value': elb_job_id},
-                                            {'name': 'BLAST_USAGE_REPORT',
-                                             'value': 'true'},
-                                            {'name': 'BLAST_ELB_BATCH_NUM',
-                                             'value': str(i)}]
-            else:
-                overrides['environment'] = [{'name': 'BLAST_USAGE_REPORT',
-                                             'value': 'false'}]
-            if not self.dry_run:
-                submit_job_args = {
-                    "jobQueue": self.job_queue_name,
-                    "jobDefinition": self.blast_job_definition_name,
-                    "jobName": jname,
-                    "parameters": parameters,
-                    "containerOverrides": overrides
-                }
-                if self.job_ids.query_splitting:
-                    submit_job_args["dependsOn"] = [{'jobId': self.job_ids.query_splitting}]
-                job = self.batch.submit_job(**submit_job_args)
-                self.job_ids.search.append(job['jobId'])
-                logging.debug(f"Job definition parameters for job {job['jobId']} {parameters}")
-                logging.info(f"Submitted AWS Batch job {job['jobId']} with query {q}")
-            else:
-                logging.debug(f'dry-run: would have submitted {jname} with query {q}')
+        if len(query_batches) > 1 and 'ELB_DISABLE_ARRAY_JOBS' not in os.environ:
+            self._submit_array_jobs(query_batches, parameters, overrides,
+                                    usage_reporting, elb_job_id)
+        else:
+            self._submit_jobs(query_batches, parameters, overrides,
+                              usage_reporting, elb_job_id)
         end = timer()
         logging.debug(f'RUNTIME submit-jobs {end-start} seconds')
         logging.debug(f'SPEED to submit-jobs {len(query_batches)/(end-start):.2f} jobs/second')
@@ -880,27 +889,164 @@ class ElasticBlastAws(ElasticBlast):
             # upload AWS-Batch job ids to results bucket for better search
             # status checking
             self.upload_job_ids()
+            if self.job_state_table_name:
+                # job states are counted from AWS Batch events, jobs are
+                # pending until their first event is recorded
+                self.dynamodb.update_item(TableName=self.job_state_table_name,
+                                          Key={'jobId': {'S': ELB_AWS_JOB_STATE_COUNTS_KEY}},
+                                          UpdateExpression='ADD expected :n',
+                                          ExpressionAttributeValues={':n': {'N': str(len(query_batches))}})
+
+
+    def _submit_jobs(self, query_batches: List[str], parameters: Dict[str, str],
+                     overrides: Dict[str, Any], usage_reporting: bool,
+                     elb_job_id: str) -> None:
+        """ Submit one AWS Batch job per query batch. Jobs are submitted
+            concurrently at a rate that AWS Batch SubmitJob API allows, and
+            throttled requests are retried. Job ids are recorded in the order
+            of query batches.
+            Parameters:
+                query_batches - list of bucket names of queries to submit
+                parameters    - job definition parameters
+                overrides     - job definition container overrides
+                usage_reporting - is usage reporting enabled
+                elb_job_id    - search id for usage reporting
+        """
+        prog = self.cfg.blast.program
+        jobs = []
+        for i, q in enumerate(query_batches):
+            job_parameters = dict(parameters)
+            job_parameters['query-batch'] = q
+            job_parameters['split-part'] = str(i)
+            jname = f'elasticblast-{self.owner}-{prog}-batch-{self.db_label}-job-{i}'
+            job_overrides = dict(overrides)
+            # add random search id for ElasticBLAST usage reporting
+            # and pass BLAST_USAGE_REPORT environment var to container
+            environment = list(overrides.get('environment', []))
+            if usage_reporting:
+                environment += [{'name': 'BLAST_ELB_JOB_ID',
+                                 'value': elb_job_id},
+                                {'name': 'BLAST_USAGE_REPORT',
+                                 'value': 'true'},
+                                {'name': 'BLAST_ELB_BATCH_NUM',
+                                 'value': str(i)}]
+            else:
+                environment += [{'name': 'BLAST_USAGE_REPORT',
+                                 'value': 'false'}]
+            job_overrides['environment'] = environment
+            if self.dry_run:
+                logging.debug(f'dry-run: would have submitted {jname} with query {q}')
+                continue
+            submit_job_args = {
+                "jobQueue": self.job_queue_name,
+                "jobDefinition": self.blast_job_definition_name,
+                "jobName": jname,
+                "parameters": job_parameters,
+                "containerOverrides": job_overrides
+            }
+            if self.job_ids.query_splitting:
+                submit_job_args["dependsOn"] = [{'jobId': self.job_ids.query_splitting}]
+            jobs.append(submit_job_args)
+        if not jobs:
+            return
+
+        limiter = TokenBucket(ELB_AWS_BATCH_SUBMIT_JOB_TPS)
+
+        @retry(retry=retry_if_exception(is_aws_throttling_error), reraise=True,
+               stop=stop_after_attempt(ELB_AWS_BATCH_SUBMIT_JOB_RETRIES),
+               wait=wait_random_exponential(multiplier=0.5, max=20))
+        def submit_job(submit_job_args: Dict[str, Any]) -> str:
+            limiter.acquire()
+            job = self.batch.submit_job(**submit_job_args)
+            logging.debug(f"Job definition parameters for job {job['jobId']} {submit_job_args['parameters']}")
+            logging.info(f"Submitted AWS Batch job {job['jobId']} with query {submit_job_args['parameters']['query-batch']}")
+            return job['jobId']
+
+        job_ids: List[Optional[str]] = [None] * len(jobs)
+        futures: Dict[Future, int] = {}
+        try:
+            with ThreadPoolExecutor(max_workers=ELB_AWS_BATCH_SUBMIT_JOB_THREADS) as executor:
+                futures = {executor.submit(submit_job, job): i for i, job in enumerate(jobs)}
+                try:
+                    for future in as_completed(futures):
+                        job_ids[futures[future]] = future.result()
+                except:
+                    # only submissions that have not started are cancelled
+                    for future in futures:
+                        future.cancel()
+                    raise
+        finally:
+            # The executor has shut down, so submissions that were running
+            # when another one failed have completed. Keep track of all
+            # jobs that were submitted.
+            for future, i in futures.items():
+                if job_ids[i] is None and not future.cancelled() and future.exception() is None:
+                    job_ids[i] = future.result()
+            self.job_ids.search += [job_id for job_id in job_ids if job_id]
+
+
+    def _submit_array_jobs(self, query_batches: List[str], parameters: Dict[str, str],
+                           overrides: Dict[str, Any], usage_reporting: bool,
+                           elb_job_id: str) -> None:
+        """ Submit query batches as AWS Batch array jobs, so that a single
+            API call submits up to ELB_AWS_BATCH_MAX_ARRAY_SIZE searches.
+            The list of query batches is saved in the results bucket and each
+            child job picks its query batch from that list by its array index.
+            Parameters:
+                query_batches - list of bucket names of queries to submit
+                parameters    - job definition parameters
+                overrides     - job definition container overrides
+                usage_reporting - is usage reporting enabled
+                elb_job_id    - search id for usage reporting
+        """
+        prog = self.cfg.blast.program
+        batch_list = os.path.join(self.results_bucket, ELB_METADATA_DIR, ELB_AWS_QUERY_BATCH_LIST)
+        write_to_s3(batch_list, '\n'.join(query_batches) + '\n', self.boto_cfg, self.dry_run)
+        # Child jobs replace these with their query batch and split part
+        parameters['query-batch'] = batch_list
+        parameters['split-part'] = str(ELB_UNKNOWN_NUMBER_OF_QUERY_SPLITS)
+        environment = list(overrides.get('environment', []))
+        environment += [{'name': 'ELB_QUERY_BATCH_LIST', 'value': batch_list}]
+        if usage_reporting:
+            environment += [{'name': 'BLAST_ELB_JOB_ID', 'value': elb_job_id},
+                            {'name': 'BLAST_USAGE_REPORT', 'value': 'true'}]
+        else:
+            environment += [{'name': 'BLAST_USAGE_REPORT', 'value': 'false'}]
+
+        for first in range(0, len(query_batches), ELB_AWS_BATCH_MAX_ARRAY_SIZE):
+            size = min(ELB_AWS_BATCH_MAX_ARRAY_SIZE, len(query_batches) - first)
+            last = first + size - 1
+            jname = f'elasticblast-{self.owner}-{prog}-batch-{self.db_label}-job-{first}-{last}'
+            job_overrides = deepcopy(overrides)
+            job_overrides['environment'] = environment + [{'name': 'ELB_ARRAY_INDEX_OFFSET',
+                                                           'value': str(first)}]
+            if self.dry_run:
+                logging.debug(f'dry-run: would have submitted {jname} for query batches {first}-{last}')
+                continue
+            submit_job_args = {
+                "jobQueue": self.job_queue_name,
+                "jobDefinition": self.blast_job_definition_name,
+                "jobName": jname,
+                "parameters": parameters,
+                "containerOverrides": job_overrides
+            }
+            # AWS Batch array jobs must have at least 2 child jobs
+            if size > 1:
+                submit_job_args["arrayProperties"] = {'size': size}
+            if self.job_ids.query_splitting:
+                submit_job_args["dependsOn"] = [{'jobId': self.job_ids.query_splitting}]
+            job = self.batch.submit_job(**submit_job_args)
+            self.job_ids.search.append(job['jobId'])
+            logging.debug(f"Job definition parameters for job {job['jobId']} {parameters}")
+            logging.info(f"Submitted AWS Batch array job {job['jobId']} with query batches {first}-{last}")
 
 
     def get_job_ids(self) -> List[str]:
         """Get a list of batch job ids"""
         # we can only query for job ids by jobs states which can change
         # between calls, so order in which job states are processed matters
-        ids = defaultdict(int)
         logging.debug(f'Retrieving job IDs from job queue {self.job_queue_name}')
-        for status in AWS_BATCH_JOB_STATES:
-            batch_of_jobs = self.batch.list_jobs(jobQueue=self.job_queue_name,
-                                             jobStatus=status)
-            for j in batch_of_jobs['jobSummaryList']:
-                ids[j['jobId']] = 1
-
-            while 'nextToken' in batch_of_jobs:
-                batch_of_jobs = self.batch.list_jobs(jobQueue=self.job_queue_name,
-                                                     jobStatus=status,
-                                                     nextToken=batch_of_jobs['nextToken'])
-                for j in batch_of_jobs['jobSummaryList']:
-                    ids[j['jobId']] = 1
-
+        ids = self._list_jobs(jobQueue=self.job_queue_name)
         logging.debug(f'Retrieved {len(ids.keys())} job IDs')
         return list(ids.keys())
 
@@ -1000,17 +1146,33 @@ class ElasticBlastAws(ElasticBlast):
         if extended:
             return self._check_status_extended()
 
-        if not self.job_ids:
+        if self.job_state_table_name:
+            status = self._get_job_state_event_counts()
+            if status:
+                return status, {}
+
+        # search job ids may not be available yet, if jobs are submitted on the cloud
+        if not self.job_ids.search:
             self._load_job_ids_from_aws()
         job_ids = self.job_ids.to_list()
 
+        # jobs in terminal states are not described again
+        for job_id in job_ids:
+            for st, n in self.terminal_job_states.get(job_id, {}).items():
+                counts[st] += n
+        active_job_ids = [job_id for job_id in job_ids if job_id not in self.terminal_job_states]
+
         # check status of jobs in batches of JOB_BATCH_NUM
         JOB_BATCH_NUM = 100
-        for i in range(0, len(job_ids), JOB_BATCH_NUM):
-            job_batch = self.batch.describe_jobs(jobs=job_ids[i:i + JOB_BATCH_NUM])['jobs']
-            # get number for AWS Batch job states
-            for st in AWS_BATCH_JOB_STATES:
-                counts[st] += sum([j['status'] == st for j in job_batch])
+        for i in range(0, len(active_job_ids), JOB_BATCH_NUM):
+            job_batch = self.batch.describe_jobs(jobs=active_job_ids[i:i + JOB_BATCH_NUM])['jobs']
+            for j in job_batch:
+                job_states = self._get_job_state_counts(j)
+                for st, n in job_states.items():
+                    counts[st] += n
+                if j['status'] in AWS_BATCH_TERMINAL_JOB_STATES:
+                    self.terminal_job_states[j['jobId']] = job_states
+        logging.debug(f'Described {len(active_job_ids)} of {len(job_ids)} AWS Batch jobs')
 
         # compute numbers for elastic-blast job states
         status = {
@@ -1021,25 +1183,73 @@ class ElasticBlastAws(ElasticBlast):
         }
         return status, {}
 
-    def _check_status_extended(self) -> Tuple[Dict[str, int], Dict[str, str]]:
-        """ Internal check_status_extended, not protected against exceptions in AWS """
-        logging.debug(f'Retrieving jobs for queue {self.job_queue_name}')
+    def _get_job_state_event_counts(self) -> Dict[str, int]:
+        """ Get numbers of BLAST search jobs in elastic-blast job states from
+            job state counts recorded from AWS Batch events.
+
+        Returns:
+            Dictionary of job counts by elastic-blast job state, or an empty
+            dictionary if search jobs have not been submitted yet
+        """
+        item = self.dynamodb.get_item(TableName=self.job_state_table_name,
+                                      Key={'jobId': {'S': ELB_AWS_JOB_STATE_COUNTS_KEY}},
+                                      ConsistentRead=True).get('Item', {})
+        counts = {key: int(value['N']) for key, value in item.items() if 'N' in value}
+        expected = counts.pop('expected', 0)
+        if not expected:
+            return {}
+        status = {
+            'pending': sum(counts.get(st, 0) for st in ['SUBMITTED', 'PENDING', 'RUNNABLE', 'STARTING']),
+            'running':  counts.get('RUNNING', 0),
+            'succeeded': counts.get('SUCCEEDED', 0),
+            'failed': counts.get('FAILED', 0),
+        }
+        # jobs without any recorded events yet
+        status['pending'] += max(expected - sum(status.values()), 0)
+        logging.debug(f'Job state counts from AWS Batch events: {counts}, expected {expected} jobs')
+        return status
+
+    @staticmethod
+    def _get_job_state_counts(job: Dict[str, Any]) -> Dict[str, int]:
+        """ Get number of jobs in each AWS Batch job state for a job
+            description returned by describe_jobs. Array jobs are counted by
+            the states of their child jobs. """
+        array_props = job.get('arrayProperties', {})
+        if array_props.get('statusSummary'):
+            return {st: array_props['statusSummary'].get(st, 0) for st in AWS_BATCH_JOB_STATES}
+        return {job['status']: array_props.get('size', 1)}
+
+    def _list_jobs(self, **kwargs) -> Dict[str, Dict[str, Any]]:
+        """ List AWS Batch jobs in all job states, keyed by job id. Keyword
+        arguments select the jobs (jobQueue or arrayJobId) and are passed to
+        batch.list_jobs. """
         jobs = {}
         # As statuses in AWS_BATCH_JOB_STATES are ordered in job transition
         # succession, if job changes status between calls it will be reflected
         # in updated value in jobs dictionary
         for status in AWS_BATCH_JOB_STATES:
-            batch_of_jobs = self.batch.list_jobs(jobQueue=self.job_queue_name,
-                                            jobStatus=status)
+            batch_of_jobs = self.batch.list_jobs(jobStatus=status, **kwargs)
             for j in batch_of_jobs['jobSummaryList']:
                 jobs[j['jobId']] = j
 
             while 'nextToken' in batch_of_jobs:
-                batch_of_jobs = self.batch.list_jobs(jobQueue=self.job_queue_name,
-                                                    jobStatus=status,
-                                                    nextToken=batch_of_jobs['nextToken'])
+                batch_of_jobs = self.batch.list_jobs(jobStatus=status,
+                                                     nextToken=batch_of_jobs['nextToken'],
+                                                     **kwargs)
                 for j in batch_of_jobs['jobSummaryList']:
                     jobs[j['jobId']] = j
+        return jobs
+
+    def _check_status_extended(self) -> Tuple[Dict[str, int], Dict[str, str]]:
+        """ Internal check_status_extended, not protected against exceptions in AWS """
+        logging.debug(f'Retrieving jobs for queue {self.job_queue_name}')
+        jobs = self._list_jobs(jobQueue=self.job_queue_name)
+        # Array jobs are listed as a single parent job, their child jobs
+        # carry the states, exit codes, and run times
+        for job_id, job in list(jobs.items()):
+            if 'size' in job.get('arrayProperties', {}):
+                del jobs[job_id]
+                jobs.update(self._list_jobs(arrayJobId=job_id))
         counts : Dict[str, int] = defaultdict(int)
         detailed_info: Dict[str, List[str]] = defaultdict(list)
         pending_set = set(['SUBMITTED', 'PENDING', 'RUNNABLE', 'STARTING'])
@@ -27,10 +27,12 @@ from botocore.config import Config  # type: ignore
 import boto3 # type: ignore
 from botocore.exceptions import ClientError, NoCredentialsError # type: ignore
 import logging
-from typing import Optional, List, Any
+import threading
+from typing import Optional, List, Any, Dict, Tuple
 from .util import UserReportError, check_aws_region_for_invalid_characters
 from .base import InstanceProperties, PositiveInteger, MemoryStr
 from .constants import ELB_DFLT_AWS_REGION, INPUT_ERROR, PERMISSIONS_ERROR
+from .constants import ELB_BOTO_MAX_POOL_CONNECTIONS
 
 
 def create_aws_config(region: Optional[str] = None) -> Config:
@@ -43,6 +45,70 @@ def create_aws_config(region: Optional[str] = None) -> Config:
     return retval
 
 
+# boto3 clients shared by the whole process, keyed by service and
+# configuration. The dictionary is replaced to forget them, which also
+# invalidates the resources of every thread.
+_boto_objects: Dict[Tuple, Any] = {}
+_boto_lock = threading.Lock()
+# boto3 resources of the current thread, with the _boto_objects dictionary
+# they were created with
+_boto_resources = threading.local()
+
+
+def _boto_key(service: str, boto_cfg: Optional[Config]) -> Tuple[str, str]:
+    """ Cache key of a boto3 object: service and the value of every public
+        configuration option """
+    if not boto_cfg:
+        return service, ''
+    return service, repr([(name, getattr(boto_cfg, name)) for name in Config.OPTION_DEFAULTS])
+
+
+def _create_boto_object(factory, service: str, boto_cfg: Optional[Config]) -> Any:
+    pool_cfg = Config(max_pool_connections=ELB_BOTO_MAX_POOL_CONNECTIONS)
+    if boto_cfg:
+        pool_cfg = pool_cfg.merge(boto_cfg)
+    return factory(service, config=pool_cfg)
+
+
+def get_boto_client(service: str, boto_cfg: Config = None) -> Any:
+    """ Return a boto3 client for the service shared by the whole process.
+        Clients are cached by service, region and the rest of configuration,
+        so that credentials are resolved once and connections are reused.
+        boto3 clients are thread-safe.
+    """
+    key = _boto_key(service, boto_cfg)
+    with _boto_lock:
+        client = _boto_objects.get(key)
+        if client is None:
+            client = _create_boto_object(boto3.client, service, boto_cfg)
+            _boto_objects[key] = client
+    return client
+
+
+def get_boto_resource(service: str, boto_cfg: Config = None) -> Any:
+    """ Return a boto3 resource for the service, cached the same way as
+        clients in get_boto_client. boto3 resources are not thread-safe, so
+        each thread gets its own resource.
+    """
+    if getattr(_boto_resources, 'shared', None) is not _boto_objects:
+        _boto_resources.shared = _boto_objects
+        _boto_resources.cache = {}
+    key = _boto_key(service, boto_cfg)
+    resource = _boto_resources.cache.get(key)
+    if resource is None:
+        resource = _create_boto_object(boto3.resource, service, boto_cfg)
+        _boto_resources.cache[key] = resource
+    return resource
+
+
+def clear_boto_cache() -> None:
+    """ Forget all cached boto3 clients and resources, e.g.: after
+        credentials have changed """
+    global _boto_objects
+    with _boto_lock:
+        _boto_objects = {}
+
+
 def get_regions(boto_cfg: Config = None) -> List[str]:
     """ Retrieves a list of available AWS region names """
     ec2 = boto3.client('ec2') if boto_cfg == None else boto3.client('ec2', config=boto_cfg)
@@ -0,0 +1,409 @@
+#                           PUBLIC DOMAIN NOTICE
+#              National Center for Biotechnology Information
+#
+# This software is a "United States Government Work" under the
+# terms of the United States Copyright Act.  It was written as part of
+# the authors' official duties as United States Government employees and
+# thus cannot be copyrighted.  This software is freely available
+# to the public for use.  The National Library of Medicine and the U.S.
+# Government have not placed any restriction on its use or reproduction.
+#
+# Although all reasonable efforts have been taken to ensure the accuracy
+# and reliability of the software and data, the NLM and the U.S.
+# Government do not and cannot warrant the performance or results that
+# may be obtained by using this software or data.  The NLM and the U.S.
+# Government disclaim all warranties, express or implied, including
+# warranties of performance, merchantability or fitness for any particular
+# purpose.
+#
+# Please cite NCBI in any work or product based on this material.
+
+"""
+elb/commands/merge.py - merge BLAST results from all query batches into a
+single compressed file
+
+"""
+
+import io
+import os
+import json
+import re
+import gzip
+import shlex
+import shutil
+import logging
+from pathlib import Path
+from tempfile import TemporaryDirectory
+from timeit import default_timer as timer
+from typing import cast, Dict, IO, Iterable, Iterator, List, Optional, Set, Tuple, Union
+
+from elastic_blast.aws_traits import get_boto_resource
+from elastic_blast.elb_config import ElasticBlastConfig
+from elastic_blast.filehelper import check_for_read, open_for_read, open_for_read_parallel
+from elastic_blast.filehelper import parse_bucket_name_key, upload_file_to_gcs
+from elastic_blast.gcs import get_gcs_client
+from elastic_blast.split import read_query_order
+from elastic_blast.object_storage_utils import copy_file_to_s3
+from elastic_blast.util import check_positive_int, safe_exec, SafeExecError, UserReportError
+from elastic_blast.constants import ElbCommand, INPUT_ERROR
+from elastic_blast.constants import ELB_S3_PREFIX, ELB_GCS_PREFIX, ELB_METADATA_DIR
+from elastic_blast.constants import ELB_META_CONFIG_FILE, ELB_QUERY_BATCH_FILE_PREFIX
+from elastic_blast.constants import ELB_MERGED_RESULTS_PREFIX, ELB_MERGE_PREFETCH_FILES
+from elastic_blast.constants import ELB_READ_AHEAD_BLOCK_SIZE, ELB_QUERY_ORDER_FILE
+
+# BLAST output formats whose per-batch outputs can simply be concatenated
+MERGEABLE_OUTFMTS = (0, 1, 2, 3, 4, 6, 7, 10)
+# Tabular BLAST output formats supported by top-N re-ranking
+TABULAR_OUTFMTS = (6, 7)
+
+# Fields of the tabular output formats 6 and 7 selected by the 'std' keyword
+STD_FIELDS = ['qaccver', 'saccver', 'pident', 'length', 'mismatch', 'gapopen',
+              'qstart', 'qend', 'sstart', 'send', 'evalue', 'bitscore']
+QUERY_FIELDS = ('qseqid', 'qacc', 'qaccver', 'qgi')
+SUBJECT_FIELDS = ('sseqid', 'sacc', 'saccver', 'sgi', 'sallseqid', 'sallacc', 'sallgi')
+
+BATCH_RESULTS_RE = re.compile(f'^{ELB_QUERY_BATCH_FILE_PREFIX}(\\d+)(-.+\\.out\\.gz)$')
+HITS_FOUND_RE = re.compile(rb'^# \d+ hits found$')
+QUERIES_PROCESSED = b'# BLAST processed '
+
+
+def create_arg_parser(subparser, common_opts_parser):
+    """ Create the command line options subparser for the merge command. """
+    parser = subparser.add_parser('merge', parents=[common_opts_parser],
+                                  help='Merge the results of an ElasticBLAST search into a single file')
+    parser.add_argument('-o', '--output', type=str,
+                        help=f'Local path or bucket URI for the merged results, default: {ELB_MERGED_RESULTS_PREFIX}-<program>-<db>.out.gz in the results bucket')
+    parser.add_argument('--top-n', type=check_positive_int, metavar='N',
+                        help='Keep only hits to the N best subject sequences for each query, tabular output formats (6 and 7) only')
+    parser.set_defaults(func=_merge)
+
+
+def _merge(args, cfg: ElasticBlastConfig, clean_up_stack) -> int:
+    """ Entry point to merge the results of an ElasticBLAST search """
+    cfg.validate(ElbCommand.MERGE)
+    results = cfg.cluster.results
+    if cfg.cluster.dry_run:
+        logging.info(f'dry-run: would have merged BLAST results in {results}')
+        return 0
+
+    fnames, suffix = list_batch_results(results)
+    if not fnames:
+        raise UserReportError(returncode=INPUT_ERROR,
+                              message=f'No BLAST results were found in {results}')
+    output = args.output if args.output else os.path.join(results, f'{ELB_MERGED_RESULTS_PREFIX}{suffix}')
+    outfmt, fields = parse_outfmt(get_blast_options(results))
+    if args.top_n and outfmt not in TABULAR_OUTFMTS:
+        raise UserReportError(returncode=INPUT_ERROR,
+                              message=f'Top-N re-ranking is supported only for tabular BLAST output formats 6 and 7, this search used output format {outfmt}')
+    if outfmt not in MERGEABLE_OUTFMTS:
+        raise UserReportError(returncode=INPUT_ERROR,
+                              message=f'BLAST results in output format {outfmt} cannot be merged into a single file')
+
+    # Balanced query batches do not follow input order of queries
+    query_order = get_query_order(results)
+    if query_order and not (args.top_n and outfmt == 7):
+        logging.warning('Query batches were balanced, merged BLAST results are in query batch order, not in the order of queries in the input. Use --top-n with output format 7 to restore the input order.')
+        query_order = None
+
+    logging.info(f'Merging {len(fnames)} BLAST results files into {output}')
+    start = timer()
+    if output.startswith(ELB_S3_PREFIX) or output.startswith(ELB_GCS_PREFIX):
+        with TemporaryDirectory() as tmpdir:
+            local_output = os.path.join(tmpdir, os.path.basename(output))
+            nbytes = _write_merged_results(fnames, local_output, args.top_n, outfmt, fields, query_order)
+            if output.startswith(ELB_S3_PREFIX):
+                copy_file_to_s3(output, Path(local_output))
+            else:
+                upload_file_to_gcs(local_output, output)
+    else:
+        nbytes = _write_merged_results(fnames, output, args.top_n, outfmt, fields, query_order)
+    end = timer()
+    logging.debug(f'RUNTIME merge-results {end-start:.2f} seconds')
+    if end > start:
+        logging.debug(f'SPEED to merge-results {(nbytes/1000000)/(end-start):.2f} MB/second')
+    print(f'Merged BLAST results can be found in {output}')
+    return 0
+
+
+def _write_merged_results(fnames: List[str], output: str, top_n: Optional[int],
+                          outfmt: int, fields: List[str],
+                          query_order: Optional[List[Tuple[str, List[int]]]] = None) -> int:
+    """ Write merged results to a local file, return its size in bytes.
+    If query_order is provided, results of output format 7 are put back in
+    input order of queries. """
+    try:
+        if top_n:
+            with gzip.open(output, 'wb') as f, TemporaryDirectory() as tmpdir:
+                lines = _read_lines(fnames)
+                if query_order:
+                    lines = reorder_queries(fnames, query_order, os.path.join(tmpdir, 'blocks'))
+                rerank_tabular(lines, f, top_n, outfmt, fields)
+        else:
+            with open(output, 'wb') as f:
+                concatenate_results(fnames, f)
+    except (OSError, EOFError) as err:
+        # a results file that cannot be read must not be left out silently
+        raise UserReportError(returncode=INPUT_ERROR,
+                              message=f'Failed to merge BLAST results: {err}')
+    return os.path.getsize(output)
+
+
+def list_batch_results(results: str) -> Tuple[List[str], str]:
+    """ List per query batch BLAST results files directly in the results
+    bucket.
+
+    Arguments:
+        results: Results bucket URI
+
+    Returns:
+        A tuple of results file paths ordered by query batch number, and
+        the common part of their names that follows the batch name, for
+        example: -blastn-pdbnt.out.gz
+    """
+    if results.startswith(ELB_S3_PREFIX):
+        bucket_name, key = parse_bucket_name_key(results)
+        prefix = os.path.join(key, ELB_QUERY_BATCH_FILE_PREFIX) if key else ELB_QUERY_BATCH_FILE_PREFIX
+        s3_bucket = get_boto_resource('s3').Bucket(bucket_name)
+        names = [os.path.join(ELB_S3_PREFIX, bucket_name, obj.key)
+                 for obj in s3_bucket.objects.filter(Prefix=prefix)]
+    elif results.startswith(ELB_GCS_PREFIX):
+        gcs = get_gcs_client()
+        if gcs:
+            names = list(gcs.list(os.path.join(results, ELB_QUERY_BATCH_FILE_PREFIX), delimiter='/'))
+        else:
+            try:
+                p = safe_exec(['gsutil', 'ls', os.path.join(results, f'{ELB_QUERY_BATCH_FILE_PREFIX}*')])
+                names = p.stdout.decode().split()
+            except SafeExecError:
+                # gsutil ls fails when nothing matches
+                names = []
+    else:
+        raise UserReportError(returncode=INPUT_ERROR,
+                              message=f'BLAST results in {results} cannot be merged, results must be in AWS S3 or GCS')
+
+    batches = []
+    suffixes = set()
+    for name in names:
+        mo = BATCH_RESULTS_RE.match(os.path.basename(name))
+        if not mo or os.path.dirname(name).rstrip('/') != results.rstrip('/'):
+            continue
+        batches.append((int(mo.group(1)), name))
+        suffixes.add(mo.group(2))
+    if len(suffixes) > 1:
+        raise UserReportError(returncode=INPUT_ERROR,
+                              message=f'Results of more than one BLAST search were found in {results}: {", ".join(sorted(suffixes))}')
+    return [name for _, name in sorted(batches)], suffixes.pop() if suffixes else ''
+
+
+def get_blast_options(results: str) -> str:
+    """ Get BLAST options of an ElasticBLAST search from the configuration
+    saved in the results bucket metadata """
+    cfg_uri = os.path.join(results, ELB_METADATA_DIR, ELB_META_CONFIG_FILE)
+    try:
+        with open_for_read(cfg_uri) as f:
+            return json.load(f)['blast']['options']
+    except Exception as err:
+        raise UserReportError(returncode=INPUT_ERROR,
+                              message=f'Failed to read BLAST options from {cfg_uri}: {err}')
+
+
+def get_query_order(results: str) -> Optional[List[Tuple[str, List[int]]]]:
+    """ Read map of balanced query batches to input sequence numbers from
+    the results bucket metadata, or return None if query batches were not
+    balanced """
+    uri = os.path.join(results, ELB_METADATA_DIR, ELB_QUERY_ORDER_FILE)
+    try:
+        check_for_read(uri)
+    except FileNotFoundError:
+        return None
+    with open_for_read(uri) as f:
+        return read_query_order(f)
+
+
+def parse_outfmt(options: str) -> Tuple[int, List[str]]:
+    """ Get BLAST output format and the tabular output fields from BLAST
+    command line options. Fields are reported only for the tabular output
+    formats 6 and 7, with the 'std' keyword expanded.
+
+    Arguments:
+        options: BLAST command line options, for example:
+            -evalue 0.01 -outfmt "6 qseqid sseqid evalue bitscore"
+
+    Returns:
+        A tuple of output format number and a list of field names
+    """
+    tokens = shlex.split(options)
+    spec = ''
+    for i, token in enumerate(tokens[:-1]):
+        if token == '-outfmt':
+            spec = tokens[i + 1]
+    if not spec:
+        raise UserReportError(returncode=INPUT_ERROR,
+                              message=f'BLAST output format is missing from BLAST options: "{options}"')
+    fmt, *spec_fields = spec.split()
+    try:
+        outfmt = int(fmt)
+    except ValueError:
+        raise UserReportError(returncode=INPUT_ERROR,
+                              message=f'Invalid BLAST output format: "{spec}"')
+    fields: List[str] = []
+    if outfmt in TABULAR_OUTFMTS:
+        for field in spec_fields or ['std']:
+            fields += STD_FIELDS if field == 'std' else [field]
+    return outfmt, fields
+
+
+def concatenate_results(fnames: Iterable[str], out: IO[bytes]) -> None:
+    """ Concatenate compressed results files, in order, without
+    uncompressing them. A concatenation of gzip files is a valid multi-member
+    gzip file. Files are downloaded ahead in background threads. """
+    for f in open_for_read_parallel(fnames, num_files=ELB_MERGE_PREFETCH_FILES, uncompress=False):
+        shutil.copyfileobj(cast(IO[bytes], f), out, ELB_READ_AHEAD_BLOCK_SIZE)
+
+
+def _read_lines(fnames: Iterable[str]) -> Iterable[bytes]:
+    """ Read lines of uncompressed results files, in order """
+    for f in open_for_read_parallel(fnames, num_files=ELB_MERGE_PREFETCH_FILES):
+        yield from io.BufferedReader(f, ELB_READ_AHEAD_BLOCK_SIZE)
+
+
+def reorder_queries(fnames: List[str], query_order: List[Tuple[str, List[int]]],
+                    spool: str) -> Iterator[bytes]:
+    """ Read lines of uncompressed results files in output format 7 and
+    return them in input order of queries. Query batches have sequences in
+    input order, but are interleaved. Results of each query are saved in a
+    spool file and read back in input order.
+
+    Arguments:
+        fnames: Results files ordered by query batch number
+        query_order: Input sequence numbers in each query batch, see
+            split.read_query_order
+        spool: Path of a temporary file for results of all queries
+
+    Returns:
+        Lines of BLAST output with counts of processed queries from every
+        batch at the end
+    """
+    seqs_by_batch = {os.path.splitext(name)[0]: seqs for name, seqs in query_order}
+    blocks: Dict[int, Tuple[int, int]] = {}
+    processed: List[bytes] = []
+    with open(spool, 'w+b') as out:
+        for fname, f in zip(fnames, open_for_read_parallel(fnames, num_files=ELB_MERGE_PREFETCH_FILES)):
+            mo = BATCH_RESULTS_RE.match(os.path.basename(fname))
+            batch = f'{ELB_QUERY_BATCH_FILE_PREFIX}{mo.group(1)}' if mo else ''
+            if batch not in seqs_by_batch:
+                raise UserReportError(returncode=INPUT_ERROR,
+                                      message=f'Query batch of {fname} is missing from {ELB_QUERY_ORDER_FILE}')
+            seqs = seqs_by_batch[batch]
+            extents: List[Tuple[int, int]] = []
+            start = out.tell()
+            # results of a query start with a comment line that follows hits
+            # or the hit count line of the previous query
+            new_query = True
+            for line in io.BufferedReader(f, ELB_READ_AHEAD_BLOCK_SIZE):
+                if line.startswith(QUERIES_PROCESSED):
+                    processed.append(line)
+                    continue
+                is_comment = line.startswith(b'#')
+                if is_comment and new_query and out.tell() > start:
+                    extents.append((start, out.tell() - start))
+                    start = out.tell()
+                new_query = not is_comment or bool(HITS_FOUND_RE.match(line.rstrip()))
+                out.write(line if line.endswith(b'\n') else line + b'\n')
+            if out.tell() > start:
+                extents.append((start, out.tell() - start))
+            if len(extents) != len(seqs):
+                raise UserReportError(returncode=INPUT_ERROR,
+                                      message=f'{fname} has results for {len(extents)} queries, but its query batch has {len(seqs)} queries')
+            blocks.update(zip(seqs, extents))
+        for seq in sorted(blocks):
+            offset, length = blocks[seq]
+            out.seek(offset)
+            yield from io.BytesIO(out.read(length))
+    yield from processed
+
+
+def rerank_tabular(lines: Iterable[bytes], out: Union[IO[bytes], io.BufferedIOBase], top_n: int,
+                   outfmt: int, fields: List[str]) -> None:
+    """ Write tabular BLAST results keeping only hits to top_n best subject
+    sequences for each query. Hits are ranked by e-value and then by bit
+    score. All HSPs of a selected subject are kept. If subject is not among
+    the output fields, top_n best HSPs are kept. For output format 7, hit
+    counts in the comment lines are updated and a single count of processed
+    queries is written at the end.
+
+    Arguments:
+        lines: Lines of BLAST output in query order
+        out: Binary stream for the output
+        top_n: Number of subject sequences to keep for each query
+        outfmt: BLAST output format, 6 or 7
+        fields: Names of the output fields
+    """
+    query_col = _find_field(fields, QUERY_FIELDS)
+    subject_col = _find_field(fields, SUBJECT_FIELDS)
+    evalue_col = _find_field(fields, ('evalue',))
+    bitscore_col = _find_field(fields, ('bitscore',))
+    if query_col is None or evalue_col is None or bitscore_col is None:
+        raise UserReportError(returncode=INPUT_ERROR,
+                              message=f'Top-N re-ranking requires query sequence id, evalue, and bitscore output fields, got: {" ".join(fields)}')
+
+    comments: List[bytes] = []
+    hits: List[Tuple[List[bytes], bytes]] = []
+    num_queries: Optional[int] = None
+
+    def flush():
+        """ Write comments and selected hits for the current query """
+        selected = _top_hits(hits, top_n, subject_col, evalue_col, bitscore_col)
+        if hits and comments and HITS_FOUND_RE.match(comments[-1].rstrip()):
+            comments[-1] = f'# {len(selected)} hits found\n'.encode()
+        out.writelines(comments)
+        out.writelines(line for _, line in selected)
+        comments.clear()
+        hits.clear()
+
+    for line in lines:
+        if line.startswith(b'#'):
+            if hits:
+                flush()
+            if outfmt == 7 and line.startswith(QUERIES_PROCESSED):
+                num_queries = (num_queries or 0) + int(line.split()[3])
+            else:
+                comments.append(line)
+            continue
+        if not line.strip():
+            continue
+        if not line.endswith(b'\n'):
+            line += b'\n'
+        row = line.rstrip(b'\n').split(b'\t')
+        if hits and row[query_col] != hits[0][0][query_col]:
+            flush()
+        hits.append((row, line))
+    flush()
+    if num_queries is not None:
+        out.write(f'{QUERIES_PROCESSED.decode()}{num_queries} queries\n'.encode())
+
+
+def _find_field(fields: List[str], names: Iterable[str]) -> Optional[int]:
+    """ Return index of the first of the given fields or None """
+    for i, field in enumerate(fields):
+        if field in names:
+            return i
+    return None
+
+
+def _top_hits(hits: List[Tuple[List[bytes], bytes]], top_n: int, subject_col: Optional[int],
+              evalue_col: int, bitscore_col: int) -> List[Tuple[List[bytes], bytes]]:
+    """ Select hits to top_n best subjects, best first """
+    ranked = sorted(hits, key=lambda hit: (float(hit[0][evalue_col]), -float(hit[0][bitscore_col])))
+    if subject_col is None:
+        return ranked[:top_n]
+    subjects: Set[bytes] = set()
+    retval = []
+    for hit in ranked:
+        subject = hit[0][subject_col]
+        if subject not in subjects:
+            if len(subjects) >= top_n:
+                continue
+            subjects.add(subject)
+        retval.append(hit)
+    return retval
@@ -34,7 +34,7 @@ import re
 import argparse
 from pathlib import Path
 from dataclasses import dataclass, field
-from typing import DefaultDict, List, Tuple
+from typing import DefaultDict, Dict, List, Optional, Tuple
 from tempfile import NamedTemporaryFile
 from collections import defaultdict, namedtuple
 
@@ -325,6 +325,9 @@ re_query_split_start = re.compile(r'^Start query splitting')
 re_query_split_end = re.compile(r'^End query splitting')
 re_instance_id = re.compile(r'^INSTANCE_ID: (.*)$')
 re_cpu_stat = re.compile(r'^([.0-9]+)user ([.0-9]+)system ([.:0-9]+)elapsed ([0-9]+)%CPU')
+# printed before time output by the search job with the name of the phase the
+# timed command belongs to, as in the phase start and end messages
+re_timed_phase = re.compile(r'^Timed phase: (.*)$')
 run_phases = [
     (re_blastdbcmdstart, re_blastdbcmdend, PHASE_BLASTDB_SETUP),
     (re_blastcmdstart, re_blastcmdend, PHASE_BLAST),
@@ -345,15 +348,22 @@ class AwsLogParser:
         self.blast_max_time = 0
         self.njobs = 0
         self.exit_codes = []
-        self.phase_start_time = 0
+        # phases of a job may run concurrently, so their start times are
+        # tracked separately
+        self.phase_start_time: Dict[str, int] = {}
         self.phases = defaultdict(list)
-        self.last_cpu_stat = None
+        # CPU usage reported by time, by phase
+        self.cpu_stats: Dict[str, Tuple[str, ...]] = {}
+        # phase of the next time output, empty if the timed command is not
+        # a part of any tracked phase, None if not given
+        self.timed_phase: Optional[str] = None
         self.last_instance = None
 
     def init_job(self, exit_code):
         self.exit_codes.append(exit_code)
         self.njobs += 1
         self.last_instance = None
+        self.timed_phase = None
 
     def parse_line(self, line):
         """ Parse a line of saved log file """
@@ -380,10 +390,10 @@ class AwsLogParser:
                 pass
     
     def _register(self, phase, start, end):
-        cpu_info = CpuInfo(*self.last_cpu_stat) if self.last_cpu_stat else None
+        cpu_stat = self.cpu_stats.pop(phase, None)
+        cpu_info = CpuInfo(*cpu_stat) if cpu_stat else None
         self.phases[phase].append(JobInfo(start, end, self.last_instance, cpu_info))
-        self.phase_start_time = 0
-        self.last_cpu_stat = None
+        del self.phase_start_time[phase]
 
     def parse(self, ts, message):
         """ Parse timestamp and message of a log record """
@@ -398,22 +408,34 @@ class AwsLogParser:
         mo = re_instance_id.match(message)
         if mo:
             self.last_instance = mo.group(1)
+        mo = re_timed_phase.match(message)
+        if mo:
+            self.timed_phase = next((phase for re_start, _, phase in run_phases
+                                     if re_start.search(f'Start {mo.group(1)}')), '')
         mo = re_cpu_stat.match(message)
         if mo:
-            self.last_cpu_stat = mo.groups()
+            phase = self.timed_phase
+            self.timed_phase = None
+            if phase is None and self.phase_start_time:
+                # logs of search jobs that do not tag time output: phases
+                # started earlier run in the background, so time output
+                # likely belongs to the most recently started phase
+                phase = max(self.phase_start_time, key=lambda p: self.phase_start_time[p])
+            if phase:
+                self.cpu_stats[phase] = mo.groups()
         for re_start, re_end, phase in run_phases:
             mo = re_start.search(message)
             if mo:
-                self.phase_start_time = ts
+                self.phase_start_time[phase] = ts
             else:
                 mo = re_end.search(message)
                 if mo:
-                    if self.phase_start_time == 0:
+                    if not self.phase_start_time.get(phase):
                         logging.warning(f'Only found stop time {ts} for {phase}')
                         continue
-                    t = ts - self.phase_start_time
-                    #logging.debug(f'Got end of {phase}: start={self.phase_start_time} stop={ts} total={t}')
-                    self._register(phase, self.phase_start_time, ts)
+                    t = ts - self.phase_start_time[phase]
+                    #logging.debug(f'Got end of {phase}: start={self.phase_start_time[phase]} stop={ts} total={t}')
+                    self._register(phase, self.phase_start_time[phase], ts)
 
 
 class AwsCompEnv:
@@ -470,6 +492,20 @@ def _read_job_logs_aws_from_file(logfile):
     return run
 
 
+def _expand_array_jobs(batch, job_ids: List[str], page_size: int = 100) -> List[str]:
+    """ Replace AWS Batch array jobs with their child jobs. Only child jobs
+    have attempts, exit codes, and log streams. """
+    retval = []
+    for start in range(0, len(job_ids), page_size):
+        for job in batch.describe_jobs(jobs=job_ids[start:start+page_size])['jobs']:
+            size = job.get('arrayProperties', {}).get('size')
+            if size:
+                retval += [f'{job["jobId"]}:{i}' for i in range(size)]
+            else:
+                retval.append(job['jobId'])
+    return retval
+
+
 @handle_aws_error
 def _read_job_logs_aws(cfg, write_logs):
     """ return Run object with number of finished job, start, end, and exit codes,
@@ -494,7 +530,7 @@ def _read_job_logs_aws(cfg, write_logs):
     bucket, key = parse_bucket_name_key(fname)
     resp = s3.get_object(Bucket=bucket, Key=key)
     body = resp['Body']
-    job_list = JobIds.from_json(body.read().decode()).to_list()
+    job_list = _expand_array_jobs(batch, JobIds.from_json(body.read().decode()).to_list())
 
     write_logs.write('AWS job log dump\n')
 
@@ -35,16 +35,18 @@ from elastic_blast.elasticblast_factory import ElasticBlastFactory
 
 from elastic_blast.resources.quotas.quota_check import check_resource_quotas
 from elastic_blast.aws import check_cluster as aws_check_cluster
-from elastic_blast.filehelper import open_for_read, open_for_read_iter, open_for_write_immediate
+from elastic_blast.filehelper import open_for_read, open_for_read_parallel, open_for_write_immediate
 from elastic_blast.filehelper import check_for_read, check_dir_for_write, cleanup_temp_bucket_dirs
+from elastic_blast.filehelper import start_bucket_upload
 from elastic_blast.filehelper import get_length, harvest_query_splitting_results
-from elastic_blast.split import FASTAReader
+from elastic_blast.split import FASTAIndex, write_query_order
 from elastic_blast.gcp import check_cluster as gcp_check_cluster
 from elastic_blast.gcp_traits import get_machine_properties
+from elastic_blast.tuner import get_work_model
 from elastic_blast.util import get_blastdb_size, UserReportError
 from elastic_blast.util import get_resubmission_error_msg
 from elastic_blast.constants import ELB_AWS_JOB_IDS, ELB_METADATA_DIR, ELB_STATE_DISK_ID_FILE, QuerySplitMode
-from elastic_blast.constants import ELB_QUERY_BATCH_DIR, BLASTDB_ERROR, INPUT_ERROR
+from elastic_blast.constants import ELB_QUERY_BATCH_DIR, ELB_QUERY_ORDER_FILE, BLASTDB_ERROR, INPUT_ERROR
 from elastic_blast.constants import PERMISSIONS_ERROR, CLUSTER_ERROR, CSP, QUERY_LIST_EXT
 from elastic_blast.constants import ElbCommand, ELB_META_CONFIG_FILE
 from elastic_blast.constants import ELB_S3_PREFIX, ELB_GCS_PREFIX
@@ -239,16 +241,48 @@ def split_query(query_files: List[str], cfg: ElasticBlastConfig) -> Tuple[List[s
         logging.info(f'Splitting queries and writing batches to {out_path}')
     else:
         gcp_prj = None if cfg.cloud_provider.cloud == CSP.AWS else cfg.gcp.get_project_for_gcs_downloads()
-        reader = FASTAReader(open_for_read_iter(query_files, gcp_prj), batch_len, out_path)
-        query_length, queries = reader.read_and_cut()
-        logging.info(f'{len(queries)} batches, {query_length} base/residue total')
-        if len(queries) < num_concurrent_blast_jobs:
-            adjusted_batch_len = int(query_length/num_concurrent_blast_jobs)
-            msg = f'The provided elastic-blast configuration is sub-optimal as the query was split into {len(queries)} batch(es) and elastic-blast can run up to {num_concurrent_blast_jobs} concurrent BLAST jobs. elastic-blast changed the batch-len parameter to {adjusted_batch_len} to maximize resource utilization and improve performance.'
-            logging.info(msg)
-            reader = FASTAReader(open_for_read_iter(query_files, gcp_prj), adjusted_batch_len, out_path)
-            query_length, queries = reader.read_and_cut()
-            logging.info(f'Re-computed {len(queries)} batches, {query_length} base/residue total')
+        # Batches are uploaded as soon as they are written
+        start_bucket_upload()
+        # Input is read only once, batches are cut from a local spool after
+        # the final batch length is known. Query files are read and
+        # uncompressed ahead in background threads.
+        with FASTAIndex(open_for_read_parallel(query_files, gcp_prj)) as index:
+            query_length = index.read()
+            # batches are cut by estimated search cost instead of length,
+            # if requested
+            batch_limit: float = batch_len
+            seq_cost = None
+            total_cost = float(query_length)
+            if 'ELB_USE_WORK_MODEL' in os.environ and len(index.counts):
+                summaries = os.environ.get('ELB_WORK_MODEL_RUN_SUMMARIES', '')
+                model = get_work_model(cfg.blast.program, cfg.blast.db_metadata,
+                                       [f for f in summaries.split(os.pathsep) if f])
+                seq_cost = model.seq_cost
+                batch_limit = model.batch_cost(batch_len, query_length / len(index.counts))
+                total_cost = sum(map(seq_cost, index.counts))
+                if model.letters_per_second_per_cpu:
+                    logging.info(f'Estimated BLAST search time {total_cost / 3600:.2f} CPU hours')
+            num_batches = index.get_num_batches(batch_limit, seq_cost)
+            logging.info(f'{num_batches} batches, {query_length} base/residue total')
+            if 'ELB_BALANCE_QUERY_BATCHES' in os.environ:
+                # Same number of batches, but with sequences distributed so
+                # that batches have similar lengths, or estimated search
+                # costs if the work model is used
+                num_batches = max(num_batches, num_concurrent_blast_jobs)
+                order: List[List[int]] = []
+                queries = [batch.name for batch in index.iter_balanced_batches(num_batches, out_path, order, seq_cost)]
+                with open_for_write_immediate(os.path.join(cfg.cluster.results, ELB_METADATA_DIR, ELB_QUERY_ORDER_FILE)) as f:
+                    write_query_order(order, queries, f)
+                logging.info(f'Computed {len(queries)} balanced batches, {query_length} base/residue total')
+            elif num_batches < num_concurrent_blast_jobs:
+                adjusted_batch_len = int(query_length/num_concurrent_blast_jobs)
+                msg = f'The provided elastic-blast configuration is sub-optimal as the query was split into {num_batches} batch(es) and elastic-blast can run up to {num_concurrent_blast_jobs} concurrent BLAST jobs. elastic-blast changed the batch-len parameter to {adjusted_batch_len} to maximize resource utilization and improve performance.'
+                logging.info(msg)
+                adjusted_limit = total_cost / num_concurrent_blast_jobs if seq_cost else adjusted_batch_len
+                queries = index.write_batches(adjusted_limit, out_path, seq_cost)
+                logging.info(f'Re-computed {len(queries)} batches, {query_length} base/residue total')
+            else:
+                queries = index.write_batches(batch_limit, out_path, seq_cost)
     end = timer()
     logging.debug(f'RUNTIME split-queries {end-start} seconds')
     return (queries, query_length)
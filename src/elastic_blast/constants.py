@@ -42,6 +42,7 @@ class ElbCommand(Enum):
     STATUS = 'status'
     DELETE = 'delete'
     RUN_SUMMARY = 'run-summary'
+    MERGE = 'merge'
 
 
 class ElbStatus(Enum):
@@ -116,6 +117,51 @@ ELB_GCS_PREFIX = 'gs://'
 ELB_HTTP_PREFIX = 'http'
 ELB_FTP_PREFIX = 'ftp://'
 
+# Number of threads uploading files written with filehelper.open_for_write to
+# cloud buckets
+ELB_BUCKET_UPLOAD_THREADS = 16
+# Number of files uploaded to GCS with a single gsutil invocation
+ELB_GCS_UPLOAD_GROUP_SIZE = 100
+# Number of query files (list entries) opened, uncompressed, and read ahead
+# of the query splitter
+ELB_QUERY_PREFETCH_FILES = 4
+# Number of threads uncompressing members of a single query tar archive
+ELB_QUERY_PREFETCH_THREADS = 4
+# Number of uncompressed blocks each read ahead stream keeps in memory, and
+# their size
+ELB_READ_AHEAD_BLOCKS = 16
+ELB_READ_AHEAD_BLOCK_SIZE = 1024 * 1024
+# Query tar archive members up to this size are read into memory and
+# uncompressed concurrently, larger ones are streamed
+ELB_TAR_PREFETCH_MAX_MEMBER_SIZE = 64 * 1024 * 1024
+# Query files in S3 or GCS at least this large are read with concurrent
+# ranged GET requests, ELB_RANGED_READ_THREADS requests at a time, each for
+# ELB_RANGED_READ_BLOCK_SIZE bytes
+ELB_RANGED_READ_MIN_SIZE = 64 * 1024 * 1024
+ELB_RANGED_READ_THREADS = 8
+ELB_RANGED_READ_BLOCK_SIZE = 8 * 1024 * 1024
+# Number of BLAST results files downloaded ahead by elastic-blast merge
+ELB_MERGE_PREFETCH_FILES = 8
+# Maximum number of connections kept open by each shared boto3 client
+ELB_BOTO_MAX_POOL_CONNECTIONS = 50
+# GCS JSON API endpoint used by the in-process GCS client
+ELB_GCS_API_URL = 'https://storage.googleapis.com'
+# Maximum number of connections kept open by the in-process GCS client
+ELB_GCS_MAX_POOL_CONNECTIONS = 32
+# Files larger than this are uploaded to GCS as parallel composite uploads
+ELB_GCS_COMPOSITE_UPLOAD_THRESHOLD = 150 * 1024 * 1024
+# Maximum number of objects GCS can compose into one
+ELB_GCS_MAX_COMPOSE_COMPONENTS = 32
+
+# Maximum number of child jobs in an AWS Batch array job
+ELB_AWS_BATCH_MAX_ARRAY_SIZE = 10000
+# AWS Batch SubmitJob API request rate limit, requests per second
+ELB_AWS_BATCH_SUBMIT_JOB_TPS = 50
+# Number of threads submitting AWS Batch jobs concurrently
+ELB_AWS_BATCH_SUBMIT_JOB_THREADS = 16
+# Maximum number of attempts to submit an AWS Batch job when throttled
+ELB_AWS_BATCH_SUBMIT_JOB_RETRIES = 8
+
 ELB_UNKNOWN_NUMBER_OF_QUERY_SPLITS = -1
 ELB_UNKNOWN_MAX_NUMBER_OF_CONCURRENT_JOBS = -1
 
@@ -132,9 +178,19 @@ ELB_TAXIDLIST_FILE = 'taxidlist.txt'
 ELB_META_CONFIG_FILE = 'elastic-blast-config.json'
 ELB_AWS_JOB_IDS = 'job-ids-v2.json'
 ELB_QUERY_LENGTH = 'query_length.txt'
+# Input sequence numbers in each query batch, written when batches are
+# balanced by length (ELB_BALANCE_QUERY_BATCHES)
+ELB_QUERY_ORDER_FILE = 'query_order.txt'
 ELB_GCP_BATCH_LIST = 'batch_list.txt'
+# Prefix of the single results file written by elastic-blast merge
+ELB_MERGED_RESULTS_PREFIX = 'merged'
 # this file contents should match the number of lines in ELB_GCP_BATCH_LIST 
 ELB_NUM_JOBS_SUBMITTED = 'num_jobs_submitted.txt'
+# List of query batches searched by AWS Batch array jobs, one per line
+ELB_AWS_QUERY_BATCH_LIST = 'query_batch_list.txt'
+# Key of the item with BLAST search job counts by AWS Batch job state in the
+# job state table, when search job states are tracked with AWS Batch events
+ELB_AWS_JOB_STATE_COUNTS_KEY = '__counts__'
 
 # These values indicate that a field has not been configured by the end user
 ELB_NOT_INITIALIZED_NUM = 2**32
@@ -148,6 +204,10 @@ ELB_DFLT_BLASTDB_SOURCE = 'gcp'
 
 ELB_DFLT_BLAST_JOB_TEMPLATE = 'resource:templates/blast-batch-job.yaml.template'
 ELB_LOCAL_SSD_BLAST_JOB_TEMPLATE = 'resource:templates/blast-batch-job-local-ssd.yaml.template'
+ELB_INDEXED_BLAST_JOB_TEMPLATE = 'resource:templates/blast-batch-job-indexed.yaml.template'
+ELB_LOCAL_SSD_INDEXED_BLAST_JOB_TEMPLATE = 'resource:templates/blast-batch-job-indexed-local-ssd.yaml.template'
+# Number of retries for each query batch searched by a Kubernetes job
+K8S_JOB_BACKOFF_LIMIT = 3
 GCS_DFLT_BUCKET = 'gs://blast-db'
 
 GCP_APIS = ['compute', 'serviceusage', 'container', 'storage-api', 'storage-component']
@@ -167,6 +227,27 @@ ELB_K8S_JOB_SUBMISSION_MAX_RETRIES=5    # Try up to this many times
 ELB_K8S_JOB_SUBMISSION_TIMEOUT=600      # or a maximum of this many seconds
 ELB_K8S_JOB_SUBMISSION_MIN_WAIT=1       # Randomly wait between 1 and ...
 ELB_K8S_JOB_SUBMISSION_MAX_WAIT=5       # ... 5 seconds
+# Large numbers of jobs are submitted with one kubectl apply call per this
+# many job manifests ...
+ELB_K8S_JOB_SUBMISSION_CHUNK_SIZE = 50
+# ... running this many calls at a time
+ELB_K8S_JOB_SUBMISSION_THREADS = 4
+
+# Maximum number of connections kept open by the in-process Kubernetes API client
+ELB_K8S_API_MAX_POOL_CONNECTIONS = 16
+# Number of objects per page when listing Kubernetes objects via API
+ELB_K8S_API_PAGE_SIZE = 500
+# Field manager name for Kubernetes server-side apply
+ELB_K8S_FIELD_MANAGER = 'elastic-blast'
+# Timeout in seconds to connect to Kubernetes API server
+ELB_K8S_API_CONNECT_TIMEOUT = 30
+# Maximum duration in seconds of a single Kubernetes API watch request
+ELB_K8S_API_WATCH_TIMEOUT = 300
+# Kubernetes API watch events are read in chunks of up to this many bytes
+ELB_K8S_API_STREAM_CHUNK_SIZE = 64 * 1024
+# Number of Kubernetes objects created at a time via API, each retried up to
+# ELB_K8S_JOB_SUBMISSION_MAX_RETRIES times if the server is overloaded
+ELB_K8S_API_APPLY_THREADS = 8
 
 
 # Exit codes
@@ -204,7 +285,7 @@ ELB_DFLT_GCP_ZONE = 'us-east4-b'
 ELB_DFLT_AWS_REGION = 'us-east-1'
 ELB_UNKNOWN_GCP_PROJECT = 'elb-unknown-gcp-project'
 
-ELB_DOCKER_VERSION = '1.1.3'
+ELB_DOCKER_VERSION = '1.2.0'
 ELB_QS_DOCKER_VERSION = '0.1.4'
 ELB_JANITOR_DOCKER_VERSION = '0.3.0'
 ELB_JOB_SUBMIT_DOCKER_VERSION = '3.0.0'
@@ -300,6 +381,10 @@ K8S_JOB_RESULTS_EXPORT = 'results-export'
 K8S_JOB_INIT_PV = 'init-pv'
 K8S_JOB_CLOUD_SPLIT_SSD = 'cloud-split-ssd'
 
+# Values of app label of Kubernetes jobs whose states make up search status:
+# BLAST searches, storage initialization, and cloud job submission
+K8S_STATUS_APPS = ['blast', 'setup', 'submit']
+
 # Number of jobs per directory after which the jobs are submitted individually to minimize timeouts
 K8S_MAX_JOBS_PER_DIR = 100
 
@@ -26,6 +26,7 @@ Author: Greg Boratyn (boratyng@ncbi.nlm.nih.gov)
 
 import os
 import logging
+import hashlib
 from dataclasses import dataclass
 from dataclasses_json import dataclass_json, Undefined, LetterCase
 from json.decoder import JSONDecodeError
@@ -55,6 +56,19 @@ class DbMetadata:
     number_of_volumes: int
 
 
+def get_db_version(db_metadata: DbMetadata) -> str:
+    """
+    Version of BLAST database files: last update time and a digest of the
+    file list. Used by search jobs as a key for the database cache shared by
+    jobs running on the same node.
+
+    Arguments:
+        db_metadata: Database metadata
+    """
+    digest = hashlib.md5('\n'.join(sorted(db_metadata.files)).encode()).hexdigest()
+    return f'{db_metadata.last_updated}-{digest}'
+
+
 def get_db_metadata(db: str, dbtype: MolType, source: DBSource, dry_run: bool = False, gcp_prj: Optional[str] = None) -> DbMetadata:
     """
     Read database metadata.
@@ -32,25 +32,36 @@ Implemented variants:
 Author: Victor Joukov joukovv@ncbi.nlm.nih.gov
 """
 
-import subprocess, os, io, gzip, tarfile, re, tempfile, shutil, sys
+import subprocess, os, io, gzip, tarfile, re, tempfile, shutil, sys, zlib
+import threading, queue
 import logging
 import urllib.request
+from concurrent.futures import ThreadPoolExecutor, Future
 from string import digits
 from random import sample
 from timeit import default_timer as timer
 from contextlib import contextmanager
+from collections import deque
 from tenacity import retry, stop_after_attempt, wait_exponential
-from typing import Dict, IO, Tuple, Iterable, Generator, TextIO, List, Optional
+from typing import Dict, IO, Tuple, Iterable, Iterator, Generator, TextIO, List, Optional, Set
+from typing import Any, Callable, Deque
 
 import boto3  # type: ignore
 from botocore.exceptions import ClientError  # type: ignore
 from botocore.config import Config  # type: ignore
 from boto3.s3.transfer import TransferConfig # type: ignore
 from .base import QuerySplittingResults
+from .aws_traits import get_boto_client, get_boto_resource
+from .gcs import get_gcs_client, GCSClient
 from .util import safe_exec, SafeExecError
 from .constants import ELB_GCP_BATCH_LIST, ELB_METADATA_DIR, ELB_QUERY_LENGTH, ELB_QUERY_BATCH_DIR
 from .constants import ELB_S3_PREFIX, ELB_GCS_PREFIX, ELB_FTP_PREFIX, ELB_HTTP_PREFIX
 from .constants import ELB_QUERY_BATCH_FILE_PREFIX
+from .constants import ELB_BUCKET_UPLOAD_THREADS, ELB_GCS_UPLOAD_GROUP_SIZE
+from .constants import ELB_QUERY_PREFETCH_FILES, ELB_QUERY_PREFETCH_THREADS
+from .constants import ELB_READ_AHEAD_BLOCKS, ELB_READ_AHEAD_BLOCK_SIZE
+from .constants import ELB_TAR_PREFETCH_MAX_MEMBER_SIZE
+from .constants import ELB_RANGED_READ_MIN_SIZE, ELB_RANGED_READ_THREADS, ELB_RANGED_READ_BLOCK_SIZE
 
 
 def harvest_query_splitting_results(bucket_name: str, dry_run: bool = False, boto_cfg: Config = None, gcp_project: Optional[str] = None) -> QuerySplittingResults:
@@ -68,7 +79,7 @@ def harvest_query_splitting_results(bucket_name: str, dry_run: bool = False, bot
             qlen = int(ql.read())
         qbatches = os.path.join(bucket_name, ELB_QUERY_BATCH_DIR)
         bucket, key = parse_bucket_name_key(qbatches)
-        s3 = boto3.resource('s3') if boto_cfg == None else boto3.resource('s3', config=boto_cfg)
+        s3 = get_boto_resource('s3', boto_cfg)
         s3_bucket = s3.Bucket(bucket)
         # By adding the query batch prefix we filter out other things in query_batch directory,
         # e.g. taxidlist.txt
@@ -94,60 +105,160 @@ def upload_file_to_gcs(filename: str, gcs_location: str, dry_run: bool = False)
     cmd = f'gsutil -qm cp {filename} {gcs_location}'
     if dry_run:
         logging.info(cmd)
+        return
+    gcs = get_gcs_client()
+    if gcs:
+        if gcs_location.endswith('/'):
+            gcs_location += os.path.basename(filename)
+        gcs.upload_file(filename, gcs_location)
     else:
         safe_exec(cmd)
 
-# Write GS files to temp directory, then gsutil -mq cp temp_dir/* gs://chunks_path
-# mapping from gs bucket place to temp dir created by open_for_write
+# Write bucket files to temp directory, then upload them to the bucket
+# mapping from bucket place to temp dir created by open_for_write
 bucket_temp_dirs: Dict[str, str] = {}
 
+
+class BucketUploader:
+    """ Uploads files from temp local dirs created by open_for_write to
+        corresponding places in cloud buckets with a bounded pool of threads.
+        Local copies are removed once uploaded.
+    """
+    def __init__(self, num_threads: int = ELB_BUCKET_UPLOAD_THREADS):
+        self.executor = ThreadPoolExecutor(max_workers=num_threads)
+        self.futures: List[Future] = []
+        # local files scheduled for upload
+        self.files: Set[str] = set()
+        # local files waiting to be uploaded to GCS as a group, by bucket dir
+        self.gcs_files: Dict[str, List[str]] = {}
+        self.nbytes = 0
+
+    def upload(self, bucket_dir: str, filename: str) -> None:
+        """ Schedule upload of a local file into bucket_dir """
+        self.files.add(filename)
+        self.nbytes += os.path.getsize(filename)
+        if bucket_dir.startswith(ELB_GCS_PREFIX) and get_gcs_client():
+            self.futures.append(self.executor.submit(self._upload_file_to_gcs, bucket_dir, filename))
+        elif bucket_dir.startswith(ELB_GCS_PREFIX):
+            files = self.gcs_files.setdefault(bucket_dir, [])
+            files.append(filename)
+            if len(files) >= ELB_GCS_UPLOAD_GROUP_SIZE:
+                self._flush_gcs(bucket_dir)
+        elif bucket_dir.startswith(ELB_S3_PREFIX):
+            self.futures.append(self.executor.submit(self._upload_to_s3, bucket_dir, filename))
+        else:
+            raise ValueError(f'Incorrect bucket prefix {bucket_dir}')
+
+    def _flush_gcs(self, bucket_dir: str) -> None:
+        files = self.gcs_files.pop(bucket_dir)
+        self.futures.append(self.executor.submit(self._upload_to_gcs, bucket_dir, files))
+
+    def _upload_to_gcs(self, bucket_dir: str, files: List[str]) -> None:
+        dest = bucket_dir + ('/' if bucket_dir[-1] != '/' else '')
+        safe_exec(['gsutil', '-mq', 'cp'] + files + [dest])
+        for fn in files:
+            os.remove(fn)
+
+    def _upload_file_to_gcs(self, bucket_dir: str, filename: str) -> None:
+        gcs = get_gcs_client()
+        # only scheduled when the in-process GCS client is available
+        assert gcs is not None
+        dest = bucket_dir.rstrip('/') + '/' + os.path.basename(filename)
+        logging.debug(f'Uploading {filename} to {dest}')
+        gcs.upload_file(filename, dest)
+        os.remove(filename)
+
+    def _upload_to_s3(self, bucket_dir: str, filename: str) -> None:
+        # boto3 clients, unlike resources, can be shared between threads
+        s3 = get_boto_client('s3')
+        bucket_name, prefix = parse_bucket_name_key(bucket_dir)
+        key = os.path.basename(filename)
+        if prefix:
+            key = prefix + '/' + key
+        logging.debug(f'Uploading {filename} to {ELB_S3_PREFIX}{bucket_name}/{key}')
+        s3.upload_file(filename, bucket_name, key)
+        os.remove(filename)
+
+    def wait(self) -> int:
+        """ Wait for all scheduled uploads to finish and raise the first
+            error, if any. Returns the number of bytes uploaded.
+        """
+        for bucket_dir in list(self.gcs_files.keys()):
+            self._flush_gcs(bucket_dir)
+        try:
+            for future in self.futures:
+                future.result()
+        finally:
+            self.cancel()
+        return self.nbytes
+
+    def cancel(self) -> None:
+        """ Cancel scheduled uploads and wait for the running ones """
+        # Executor.shutdown has no cancel_futures parameter before python 3.9
+        for future in self.futures:
+            future.cancel()
+        self.executor.shutdown(wait=True)
+
+
+# Uploads files as soon as they are closed, if started with start_bucket_upload
+bucket_uploader: Optional[BucketUploader] = None
+
+
+def start_bucket_upload(num_threads: int = ELB_BUCKET_UPLOAD_THREADS) -> None:
+    """ Start uploading files written with open_for_write to cloud buckets as
+        soon as they are closed, so that writing and uploading overlap.
+        Uploads are completed with copy_to_bucket.
+        Parameters:
+            num_threads - number of concurrent uploads
+    """
+    global bucket_uploader # FIXME: remove global variables from library code
+    if not bucket_uploader:
+        bucket_uploader = BucketUploader(num_threads)
+
+
 def copy_to_bucket(dry_run: bool = False):
-    """ Copy files open in temp local dirs to corresponding places in gs.
-        Works in concert with open_for_write.
+    """ Copy files open in temp local dirs to corresponding places in buckets.
+        Works in concert with open_for_write, waits for uploads started with
+        start_bucket_upload and uploads the remaining files.
         Parameters:
             dry_run - simulate action, don't do anything, default False
     """
     global bucket_temp_dirs # FIXME: remove global variables from library code
-    s3 = boto3.resource('s3')
-    # NB: Here we need to provide stable list of keys in
-    # dictionary while deleting processed keys, hence list(keys())
+    global bucket_uploader
+    uploader = bucket_uploader
+    bucket_uploader = None
+    if not bucket_temp_dirs:
+        if uploader:
+            uploader.wait()
+        return
     start = timer()
-    query_bytes = 0
-    for bucket_key in list(bucket_temp_dirs.keys()):
-        tempdir = bucket_temp_dirs[bucket_key]
-        query_bytes += sum(os.path.getsize(os.path.join(tempdir,f)) for f in os.listdir(tempdir) if os.path.isfile(os.path.join(tempdir,f)))
-        # gsutil -mq cp tempdir/* bucket_key/
-        if bucket_key.startswith(ELB_GCS_PREFIX):
-            bucket_dir = bucket_key + ('/' if bucket_key[-1] != '/' else '')
-            cmd = ['gsutil', '-mq', 'cp', '-r', "%s/*" % tempdir, bucket_dir]
-            if dry_run:
-                logging.info(cmd)
+    if dry_run:
+        if uploader:
+            uploader.cancel()
+        for bucket_key, tempdir in bucket_temp_dirs.items():
+            if bucket_key.startswith(ELB_GCS_PREFIX):
+                bucket_dir = bucket_key + ('/' if bucket_key[-1] != '/' else '')
+                logging.info(['gsutil', '-mq', 'cp', '-r', "%s/*" % tempdir, bucket_dir])
             else:
-                safe_exec(cmd)
-        elif bucket_key.startswith(ELB_S3_PREFIX):
-            if dry_run:
                 logging.info(f'Copy to bucket prefix {bucket_key}')
-            else:
-                bucket_name, prefix = parse_bucket_name_key(bucket_key)
-                bucket = s3.Bucket(bucket_name)
-                num_files = len(os.listdir(path=tempdir))
-                for i, fn in enumerate(os.listdir(path=tempdir)):
-                    if prefix:
-                        full_name = prefix+'/'+fn
-                    else:
-                        full_name = fn
-                    perc_done = i / num_files * 100.
-                    logging.debug(f'Uploading {os.path.join(tempdir, fn)} to {ELB_S3_PREFIX}{bucket_name}/{full_name} file # {i} of {num_files} {perc_done:.2f}% done')
-                    bucket.upload_file(os.path.join(tempdir, fn), full_name)
-        else:
-            raise ValueError(f'Incorrect bucket prefix {bucket_key}')
+    else:
+        if not uploader:
+            uploader = BucketUploader()
+        # NB: Here we need to provide stable list of keys in
+        # dictionary while uploader may be adding keys, hence list(items())
+        for bucket_key, tempdir in list(bucket_temp_dirs.items()):
+            for fn in sorted(os.listdir(tempdir)):
+                filename = os.path.join(tempdir, fn)
+                if filename not in uploader.files and os.path.isfile(filename):
+                    uploader.upload(bucket_key, filename)
+        query_bytes = uploader.wait()
         end = timer()
-        if not dry_run:
-            logging.debug(f'RUNTIME upload-query-batches {end-start} seconds')
-            logging.debug(f'SPEED to upload-query-batches {(query_bytes/1000000)/(end-start):.2f} MB/second')
+        logging.debug(f'RUNTIME upload-query-batches {end-start} seconds')
+        logging.debug(f'SPEED to upload-query-batches {(query_bytes/1000000)/(end-start):.2f} MB/second')
+    for bucket_key in list(bucket_temp_dirs.keys()):
+        tempdir = bucket_temp_dirs.pop(bucket_key)
         logging.debug(f'Removing temp directory {tempdir}')
         shutil.rmtree(tempdir)
-        bucket_temp_dirs.pop(bucket_key)
 
 
 def remove_bucket_key(bucket_key: str, dry_run: bool = False) -> None:
@@ -155,7 +266,7 @@ def remove_bucket_key(bucket_key: str, dry_run: bool = False) -> None:
     bucket_key: bucket and key prefix as single path
     """
     if bucket_key.startswith(ELB_S3_PREFIX):
-        s3 = boto3.resource('s3')
+        s3 = get_boto_resource('s3')
         bname, prefix = parse_bucket_name_key(bucket_key)
         if not dry_run:
             s3_bucket = s3.Bucket(bname)
@@ -166,9 +277,17 @@ def remove_bucket_key(bucket_key: str, dry_run: bool = False) -> None:
     elif bucket_key.startswith(ELB_GCS_PREFIX):
         out_path = os.path.join(bucket_key, '*')
         cmd = f'gsutil -mq rm {out_path}'
+        gcs = get_gcs_client()
         if dry_run:
             logging.info(cmd)
             logging.debug(f'Deleted {out_path}')
+        elif gcs:
+            # Same as the gsutil wildcard: objects directly under bucket_key
+            try:
+                gcs.delete_many(list(gcs.list(os.path.join(bucket_key, ''), delimiter='/')),
+                                ignore_missing=True)
+            except OSError as exn:
+                logging.warning(str(exn))
         else:
             # This command is a part of clean-up process, there is no benefit in reporting
             # its failure except logging it
@@ -187,8 +306,12 @@ def cleanup_temp_bucket_dirs(dry_run: bool = False):
             dry_run - simulate action, don't do anything, default False
     """
     global bucket_temp_dirs # FIXME: remove global variables from library code
+    global bucket_uploader
     if dry_run:
         return
+    if bucket_uploader:
+        bucket_uploader.cancel()
+        bucket_uploader = None
     # NB: Here we need to provide stable list of keys in
     # dictionary while deleting processed keys, hence list(keys())
     for bucket_dir in list(bucket_temp_dirs.keys()):
@@ -211,6 +334,14 @@ def check_dir_for_write(dirname: str, dry_run=False) -> None:
         if dry_run:
             logging.info(f'echo test|gsutil cp - {test_file_name}')
             return
+        gcs = get_gcs_client()
+        if gcs:
+            try:
+                gcs.upload(test_file_name, b'test')
+                gcs.delete(test_file_name)
+            except OSError as e:
+                raise PermissionError(e.errno, e.strerror)
+            return
         try:
             proc = subprocess.Popen(['gsutil', 'cp', '-', test_file_name],
                 stdin=subprocess.PIPE, stderr=subprocess.PIPE)
@@ -239,14 +370,17 @@ def check_dir_for_write(dirname: str, dry_run=False) -> None:
 @contextmanager
 def open_for_write_immediate(fname):
     """ Open a file in a cloud bucket for write in text mode. """
-    if fname.startswith(ELB_GCS_PREFIX):
+    gcs = get_gcs_client() if fname.startswith(ELB_GCS_PREFIX) else None
+    if gcs:
+        f = io.TextIOWrapper(buffer=io.BytesIO(), encoding='utf-8')
+    elif fname.startswith(ELB_GCS_PREFIX):
         proc = subprocess.Popen(['gsutil', 'cp', '-', fname],
                                 stdin=subprocess.PIPE, stderr=subprocess.DEVNULL,
                                 universal_newlines=True)
         f = proc.stdin
     elif fname.startswith(ELB_S3_PREFIX):
         f = io.TextIOWrapper(buffer=io.BytesIO(), encoding='utf-8')
-        s3 = boto3.resource('s3')
+        s3 = get_boto_resource('s3')
         trans_conf = TransferConfig(multipart_threshold=1024*25, max_concurrency=10, multipart_chunksize=1024*25, use_threads=True)
 
     else:
@@ -256,11 +390,16 @@ def open_for_write_immediate(fname):
         yield f
 
     except:
-        if fname.startswith(ELB_S3_PREFIX):
+        if fname.startswith(ELB_S3_PREFIX) or gcs:
             f.close()
             raise
     else:
-        if fname.startswith(ELB_S3_PREFIX):
+        if gcs:
+            f.flush()
+            data = f.detach().getvalue()
+            gcs.upload(fname, data)
+            logging.debug(f'Uploaded {len(data)} bytes to {fname}')
+        elif fname.startswith(ELB_S3_PREFIX):
             f.flush()
             buffer = f.detach()
             buffer.seek(0)
@@ -276,16 +415,25 @@ def open_for_write_immediate(fname):
             logging.debug(f'Uploaded {fname} in {end - start:.2f} seconds')
 
 
+@contextmanager
+def _open_for_upload(bucket_dir: str, filename: str):
+    """ Open a local file for write in text mode and schedule its upload to
+        bucket_dir once it is closed """
+    with open(filename, 'wt') as f:
+        yield f
+    if bucket_uploader:
+        bucket_uploader.upload(bucket_dir, filename)
+
+
 def open_for_write(fname):
     """ Open file on either local (no prefix), GCS, or AWS S3
         filesystem for write in text mode. Postpones actual copy to buckets until
+        the file is closed, if start_bucket_upload was called, or until
         copy_to_bucket is called.
     """
     global bucket_temp_dirs
-    if fname.startswith(ELB_S3_PREFIX):
-        return open_for_write_immediate(fname)
-    if fname.startswith(ELB_GCS_PREFIX):
-        # for the same gs path open files in temp dir and put it into
+    if fname.startswith(ELB_S3_PREFIX) or fname.startswith(ELB_GCS_PREFIX):
+        # for the same bucket path open files in temp dir and put it into
         # bucket_temp_dirs dictionary, copy through to bucket in copy_to_bucket later
         last_slash = fname.rfind('/')
         if last_slash == -1:
@@ -298,6 +446,8 @@ def open_for_write(fname):
             tempdir = tempfile.mkdtemp()
             logging.debug(f'Create tempdir {tempdir} for bucket {bucket_dir}')
             bucket_temp_dirs[bucket_dir] = tempdir
+        if bucket_uploader:
+            return _open_for_upload(bucket_dir, os.path.join(tempdir, filename))
         return open(os.path.join(tempdir, filename), 'wt')
     # file on a regular filesystem
     last_sep = fname.rfind('/')
@@ -381,6 +531,15 @@ def check_for_read(fname: str, dry_run : bool = False, print_file_size: bool = F
         if dry_run:
             logging.info(cmd)
             return
+        gcs = get_gcs_client()
+        if gcs:
+            try:
+                size = gcs.get_size(fname, gcp_prj)
+            except OSError as e:
+                raise FileNotFoundError(e.errno, e.strerror)
+            if print_file_size:
+                logging.debug(f'{fname} size {size}')
+            return
         try:
             p = safe_exec(cmd)
             if print_file_size and p.stdout:
@@ -396,7 +555,7 @@ def check_for_read(fname: str, dry_run : bool = False, print_file_size: bool = F
         if dry_run:
             logging.info(f'Open S3 file {fname}')
             return
-        s3 = boto3.resource('s3')
+        s3 = get_boto_resource('s3')
         bucket, key = parse_bucket_name_key(fname)
         try:
             obj = s3.Object(bucket, key)
@@ -438,6 +597,12 @@ def get_length(fname: str, dry_run: bool = False, gcp_prj: Optional[str] = None)
         if dry_run:
             logging.info(cmd)
             return 10000  # Arbitrary fake length
+        gcs = get_gcs_client()
+        if gcs:
+            try:
+                return gcs.get_size(fname, gcp_prj)
+            except OSError as e:
+                raise FileNotFoundError(e.errno, e.strerror)
         try:
             p = safe_exec(cmd)
             for line in p.stdout.decode().split('\n'):
@@ -451,7 +616,7 @@ def get_length(fname: str, dry_run: bool = False, gcp_prj: Optional[str] = None)
         if dry_run:
             logging.info(f'Check length of S3 file {fname}')
             return 10000
-        s3 = boto3.resource('s3')
+        s3 = get_boto_resource('s3')
         bucket, key = parse_bucket_name_key(fname)
         try:
             obj = s3.Object(bucket, key)
@@ -471,17 +636,45 @@ def get_length(fname: str, dry_run: bool = False, gcp_prj: Optional[str] = None)
             raise FileNotFoundError(2, f'Length is not available for {fname}')
     return os.stat(fname).st_size
 
-error_report_funcs = {}
+error_report_funcs: Dict[Any, Callable[[], str]] = {}
 
-def open_for_read(fname: str, gcp_prj: Optional[str] = None):
+def open_for_read(fname: str, gcp_prj: Optional[str] = None, ranged: bool = False):
     """ Open path for read on local, GS, URL-available filesystem defined by prefix,
     or stdin. File can be gzipped, and archived with tar.
+    If ranged is True, large S3 and GCS objects are read with concurrent
+    ranged requests.
     """
     global error_report_funcs
     gzipped = fname[-3:] == ".gz"
     tarred = re.match(r'^.*\.(tar(|\.gz|\.bz2)|tgz)$', fname) is not None
     binary = gzipped or tarred
+    stream, error_func = _open_raw(fname, gcp_prj, binary, ranged)
+    fileobj = unpack_stream(stream, gzipped, tarred)
+    if error_func:
+        error_report_funcs[fileobj] = error_func
+    return fileobj
+
+
+def _open_raw(fname: str, gcp_prj: Optional[str], binary: bool,
+              ranged: bool = False) -> Tuple[IO, Optional[Callable[[], str]]]:
+    """ Open path for read without uncompressing/unarchiving it.
+    Returns:
+        stream and function returning error messages from the process that
+        reads the file, if any
+    """
     mode = 'rb' if binary else 'rt'
+    reader = _open_ranged(fname, gcp_prj) if ranged else None
+    if reader:
+        buffered = io.BufferedReader(reader, ELB_RANGED_READ_BLOCK_SIZE)
+        if binary:
+            return buffered, None
+        return io.TextIOWrapper(buffered), None
+    gcs = get_gcs_client() if fname.startswith(ELB_GCS_PREFIX) else None
+    if gcs:
+        stream = gcs.open(fname, user_project=gcp_prj)
+        if binary:
+            return stream, None
+        return io.TextIOWrapper(stream), None
     if fname.startswith(ELB_GCS_PREFIX):
         prj = f'-u {gcp_prj}' if gcp_prj else ''
         cmd = f'gsutil {prj} cat {fname}'
@@ -489,12 +682,10 @@ def open_for_read(fname: str, gcp_prj: Optional[str] = None):
             stdout=subprocess.PIPE,
             stderr=subprocess.PIPE,
             universal_newlines=not binary)
-        fileobj = unpack_stream(proc.stdout, gzipped, tarred)
-        if proc.stderr:
-            error_report_funcs[fileobj] = proc.stderr.read
-        return fileobj
+        assert proc.stdout is not None
+        return proc.stdout, ProcessErrors(proc)
     if fname.startswith('s3'):
-        s3 = boto3.client('s3')
+        s3 = get_boto_client('s3')
         bucket, key = parse_bucket_name_key(fname)
         resp = s3.get_object(Bucket=bucket, Key=key)
         body = resp['Body']
@@ -502,20 +693,177 @@ def open_for_read(fname: str, gcp_prj: Optional[str] = None):
         body.writable = lambda: False
         body.seekable = lambda: False
         body.flush = lambda: None
-        if tarred or gzipped:
-            fileobj = unpack_stream(body, gzipped, tarred)
-        else:
-            fileobj = io.TextIOWrapper(body)
-        return fileobj
+        if binary:
+            return body, None
+        return io.TextIOWrapper(body), None
     if fname.startswith(ELB_HTTP_PREFIX) or fname.startswith(ELB_FTP_PREFIX):
-        response = urllib.request.urlopen(fname)
-        return unpack_stream(response, gzipped, tarred)
+        return urllib.request.urlopen(fname), None
     # regular file or stdin
+    if is_stdin(fname) and binary:
+        return sys.stdin.buffer, None
     if is_stdin(fname):
-        f : IO = sys.stdin
+        return sys.stdin, None
+    return open(fname, mode), None
+
+
+class ProcessErrors:
+    """ Function returning error messages of a process that reads a file,
+    if the process failed. It waits for the process, so it must be called
+    after the output of the process was read to the end. """
+
+    def __init__(self, proc: subprocess.Popen):
+        self.proc = proc
+        self.message: Optional[str] = None
+
+    def __call__(self) -> str:
+        if self.message is None:
+            assert self.proc.stderr is not None
+            stderr = self.proc.stderr.read()
+            self.proc.stderr.close()
+            returncode = self.proc.wait()
+            message = stderr.decode() if isinstance(stderr, bytes) else stderr
+            self.message = message if returncode else ''
+        return self.message
+
+    def close(self) -> None:
+        """ Stop the process if its output was not read to the end, and
+        release its pipes """
+        if self.proc.poll() is None:
+            self.proc.kill()
+        for pipe in (self.proc.stdout, self.proc.stderr):
+            if pipe:
+                pipe.close()
+        self.proc.wait()
+
+
+def _read_error(fname: str, message: str) -> OSError:
+    """ Exception for a failure to read a file reported by the process that
+    read it """
+    if 'No URLs matched' in message or 'NotFound' in message:
+        return FileNotFoundError(message)
+    return OSError(f'Failed to read {fname}: {message}')
+
+
+def _open_ranged(fname: str, gcp_prj: Optional[str]) -> Optional['RangedReader']:
+    """ Open S3 or GCS object for reading with concurrent ranged requests.
+    Returns None for other files, objects smaller than
+    ELB_RANGED_READ_MIN_SIZE, and GCS objects if the in-process GCS client is
+    not used.
+    """
+    # Every request reads the object version found when it was opened, so
+    # that an object overwritten during the read is reported instead of
+    # being stitched from two versions
+    fetch: Callable[[int, int], bytes]
+    if fname.startswith(ELB_S3_PREFIX):
+        s3 = get_boto_client('s3')
+        bucket, key = parse_bucket_name_key(fname)
+        head = s3.head_object(Bucket=bucket, Key=key)
+        size = head['ContentLength']
+        etag = head['ETag']
+        def fetch(start: int, end: int) -> bytes:
+            try:
+                resp = s3.get_object(Bucket=bucket, Key=key, Range=f'bytes={start}-{end-1}',
+                                     IfMatch=etag)
+            except ClientError as exn:
+                if exn.response['Error']['Code'] in ('PreconditionFailed', '412'):
+                    raise OSError(f'{fname} was modified while it was read')
+                raise
+            return resp['Body'].read()
+    elif fname.startswith(ELB_GCS_PREFIX):
+        client = get_gcs_client()
+        if not client:
+            return None
+        gcs: GCSClient = client
+        metadata = gcs.stat(fname, gcp_prj)
+        size = int(metadata['size'])
+        generation = metadata.get('generation')
+        def fetch(start: int, end: int) -> bytes:
+            try:
+                return gcs.read(fname, start, end, gcp_prj, generation)
+            except FileNotFoundError:
+                raise OSError(f'{fname} was modified or removed while it was read')
     else:
-        f = open(fname, mode)
-    return unpack_stream(f, gzipped, tarred)
+        return None
+    if size < ELB_RANGED_READ_MIN_SIZE:
+        return None
+    logging.debug(f'Reading {fname} with {ELB_RANGED_READ_THREADS} concurrent ranged requests')
+    return RangedReader(fetch, size, ELB_RANGED_READ_THREADS, ELB_RANGED_READ_BLOCK_SIZE)
+
+
+class RangedReader(io.RawIOBase):
+    """ Binary stream of an object fetched with concurrent ranged requests.
+    Up to twice the number of threads blocks are requested ahead of the
+    reader, and blocks are returned in order. """
+
+    def __init__(self, fetch: Callable[[int, int], bytes], size: int,
+                 num_threads: int = ELB_RANGED_READ_THREADS,
+                 block_size: int = ELB_RANGED_READ_BLOCK_SIZE):
+        """ Initialize the stream and start fetching
+
+        Arguments:
+            fetch: Function returning object bytes from start to end (exclusive)
+            size: Object size in bytes
+            num_threads: Number of concurrent requests
+            block_size: Number of bytes fetched with a single request
+        """
+        super().__init__()
+        self.fetch = fetch
+        self.size = size
+        self.block_size = block_size
+        self.executor = ThreadPoolExecutor(num_threads)
+        self.pending: Deque[Future] = deque()
+        self.max_pending = 2 * num_threads
+        self.next_start = 0
+        self.block = b''
+        self.offset = 0
+        self._fill()
+
+    def _fill(self) -> None:
+        """ Request blocks until the ring of pending requests is full """
+        while len(self.pending) < self.max_pending and self.next_start < self.size:
+            end = min(self.next_start + self.block_size, self.size)
+            self.pending.append(self.executor.submit(self._fetch_block, self.next_start, end))
+            self.next_start = end
+
+    def _fetch_block(self, start: int, end: int) -> bytes:
+        """ Fetch a block, making sure that it is complete """
+        data = self.fetch(start, end)
+        if len(data) != end - start:
+            raise EOFError(f'Expected {end - start} bytes at offset {start}, received {len(data)}')
+        return data
+
+    def readable(self) -> bool:
+        return True
+
+    def read(self, size: int = -1) -> bytes:
+        """ Read up to size bytes, returns fewer bytes if the current block
+        is shorter, and an empty byte string at the end of object. """
+        if size is None or size < 0:
+            return self.readall()
+        if self.offset >= len(self.block):
+            if not self.pending:
+                return b''
+            self.block = self.pending.popleft().result()
+            self.offset = 0
+            self._fill()
+        if self.offset == 0 and size >= len(self.block):
+            data = self.block
+        else:
+            data = self.block[self.offset:self.offset + size]
+        self.offset += len(data)
+        return data
+
+    def readinto(self, b) -> int:
+        data = self.read(len(b))
+        b[:len(data)] = data
+        return len(data)
+
+    def close(self) -> None:
+        if not self.closed:
+            for future in self.pending:
+                future.cancel()
+            self.executor.shutdown(wait=False)
+        super().close()
 
 
 def open_for_read_iter(fnames: Iterable[str], gcp_prj: Optional[str] = None) -> Generator[TextIO, None, None]:
@@ -532,6 +880,237 @@ def open_for_read_iter(fnames: Iterable[str], gcp_prj: Optional[str] = None) ->
             yield f
 
 
+def open_for_read_parallel(fnames: Iterable[str], gcp_prj: Optional[str] = None,
+                           num_files: int = ELB_QUERY_PREFETCH_FILES,
+                           uncompress: bool = True) -> Generator[io.RawIOBase, None, None]:
+    """Generator function that opens paths/uris for reading, like
+    open_for_read_iter, but up to num_files files are read, uncompressed, and
+    unarchived ahead in background threads. Files are yielded in the order of
+    fnames as binary streams of uncompressed data. Each file is closed when the
+    next one is requested.
+
+    Arguments:
+        fnames: An iterable with paths to open
+        gcp_prj: GCP project
+        num_files: Number of files read ahead
+        uncompress: If False, files are yielded as stored, without
+            uncompressing or unarchiving
+
+    Returns:
+        Generator of binary streams open for reading"""
+    readers: Deque[ReadAheadReader] = deque()
+    names = iter(fnames)
+    try:
+        while True:
+            for fname in names:
+                readers.append(_open_read_ahead(fname, gcp_prj, uncompress))
+                if len(readers) >= max(num_files, 1):
+                    break
+            if not readers:
+                break
+            reader = readers.popleft()
+            try:
+                yield reader
+            finally:
+                reader.close()
+    finally:
+        for reader in readers:
+            reader.close()
+
+
+def _open_read_ahead(fname: str, gcp_prj: Optional[str], uncompress: bool = True) -> 'ReadAheadReader':
+    """ Open path for read with uncompressing and unarchiving done in a
+    background thread """
+    gzipped = uncompress and fname[-3:] == ".gz"
+    tarred = uncompress and re.match(r'^.*\.(tar(|\.gz|\.bz2)|tgz)$', fname) is not None
+    stream, error_func = _open_raw(fname, gcp_prj, True, ranged=True)
+    if tarred:
+        blocks = _tar_blocks(stream)
+    elif gzipped:
+        blocks = _gunzip_blocks(stream)
+    else:
+        blocks = _read_blocks(stream)
+    if error_func:
+        blocks = _check_read_errors(blocks, fname, error_func)
+    cleanup = error_func.close if isinstance(error_func, ProcessErrors) else None
+    return ReadAheadReader(blocks, stream, cleanup=cleanup)
+
+
+def _check_read_errors(blocks: Iterator[bytes], fname: str,
+                       error_func: Callable[[], str]) -> Iterator[bytes]:
+    """ Yield blocks of a file, and raise an exception if the process that
+    read the file reports an error, so that a failed read is not mistaken for
+    a short or empty file """
+    try:
+        yield from blocks
+    except EOFError:
+        # the whole output was read, so the process has ended
+        error = error_func()
+        if error:
+            raise _read_error(fname, error)
+        raise
+    error = error_func()
+    if error:
+        raise _read_error(fname, error)
+
+
+def _read_blocks(stream: IO[bytes]) -> Iterator[bytes]:
+    """ Read binary stream in blocks """
+    return iter(lambda: stream.read(ELB_READ_AHEAD_BLOCK_SIZE), b'')
+
+
+def _gunzip_blocks(stream: IO[bytes]) -> Iterator[bytes]:
+    """ Uncompress gzipped binary stream, possibly with multiple gzip members,
+    in blocks. zlib releases GIL, so this runs concurrently with
+    parsing in the main thread. """
+    decompressor = zlib.decompressobj(zlib.MAX_WBITS | 16)
+    for chunk in _read_blocks(stream):
+        while chunk:
+            if decompressor.eof:
+                decompressor = zlib.decompressobj(zlib.MAX_WBITS | 16)
+            data = decompressor.decompress(chunk)
+            if data:
+                yield data
+            chunk = decompressor.unused_data if decompressor.eof else b''
+    if not decompressor.eof:
+        raise EOFError('Compressed file ended before the end-of-stream marker was reached')
+
+
+def _uncompress_member(data: bytes, gzipped: bool) -> bytes:
+    """ Uncompress tar archive member in memory, if needed, and make sure it
+    ends with a new line """
+    if gzipped:
+        data = gzip.decompress(data)
+    if data and not data.endswith(b'\n'):
+        data += b'\n'
+    return data
+
+
+def _tar_blocks(stream: IO[bytes]) -> Iterator[bytes]:
+    """ Read all files in a tar archive as a single binary stream. Small
+    members are read sequentially and their uncompressing is done
+    concurrently in a thread pool. Uncompressed members are returned in
+    archive order. """
+    pending: Deque[Future] = deque()
+    with tarfile.open(fileobj=stream, mode='r|*') as tar, \
+            ThreadPoolExecutor(ELB_QUERY_PREFETCH_THREADS) as executor:
+        for tarinfo in tar:
+            if not tarinfo.isfile():
+                continue
+            f = tar.extractfile(tarinfo)
+            if f is None:
+                continue
+            gzipped = tarinfo.name.endswith('.gz')
+            if tarinfo.size <= ELB_TAR_PREFETCH_MAX_MEMBER_SIZE:
+                pending.append(executor.submit(_uncompress_member, f.read(), gzipped))
+                while len(pending) > ELB_QUERY_PREFETCH_THREADS:
+                    yield pending.popleft().result()
+                continue
+            # large member is streamed after all preceding members
+            while pending:
+                yield pending.popleft().result()
+            last = b''
+            for data in (_gunzip_blocks(f) if gzipped else _read_blocks(f)):
+                yield data
+                last = data
+            if last and not last.endswith(b'\n'):
+                yield b'\n'
+        while pending:
+            yield pending.popleft().result()
+
+
+class ReadAheadReader(io.RawIOBase):
+    """ Binary stream of blocks produced by a background thread. At most
+    ELB_READ_AHEAD_BLOCKS blocks are kept in memory. Exceptions raised while
+    producing blocks are re-raised by read. """
+
+    def __init__(self, blocks: Iterator[bytes], source: Optional[IO] = None,
+                 max_blocks: int = ELB_READ_AHEAD_BLOCKS,
+                 cleanup: Optional[Callable[[], None]] = None):
+        """ Initialize the stream and start the background thread
+
+        Arguments:
+            blocks: Iterator producing data blocks
+            source: Stream closed together with this object
+            max_blocks: Number of blocks read ahead
+            cleanup: Function called when this object is closed, for example
+                to stop the process producing source
+        """
+        super().__init__()
+        self.source = source
+        self.cleanup = cleanup
+        self.queue: queue.Queue = queue.Queue(max_blocks)
+        self.block = b''
+        self.offset = 0
+        self.eof = False
+        self.stop = threading.Event()
+        self.thread = threading.Thread(target=self._produce, args=(blocks,), daemon=True)
+        self.thread.start()
+
+    def _produce(self, blocks: Iterator[bytes]) -> None:
+        """ Put blocks in the queue, followed by None or an exception """
+        item: object = None
+        try:
+            for block in blocks:
+                if not self._put(block):
+                    return
+        except Exception as err:
+            item = err
+        self._put(item)
+
+    def _put(self, item: object) -> bool:
+        """ Put an item in the queue, unless the stream was closed """
+        while not self.stop.is_set():
+            try:
+                self.queue.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def readable(self) -> bool:
+        return True
+
+    def read(self, size: int = -1) -> bytes:
+        """ Read up to size bytes, returns fewer bytes if the current block
+        is shorter, and an empty byte string at the end of stream. """
+        if size is None or size < 0:
+            return self.readall()
+        while self.offset >= len(self.block) and not self.eof:
+            item = self.queue.get()
+            if item is None:
+                self.eof = True
+            elif isinstance(item, Exception):
+                self.eof = True
+                raise item
+            else:
+                self.block = item
+                self.offset = 0
+        if self.offset == 0 and size >= len(self.block):
+            # avoid copying whole blocks
+            data = self.block
+        else:
+            data = self.block[self.offset:self.offset + size]
+        self.offset += len(data)
+        return data
+
+    def readinto(self, b) -> int:
+        data = self.read(len(b))
+        b[:len(data)] = data
+        return len(data)
+
+    def close(self) -> None:
+        if not self.closed:
+            self.stop.set()
+            if self.eof:
+                self.thread.join()
+            if self.cleanup:
+                self.cleanup()
+            if self.source:
+                self.source.close()
+        super().close()
+
+
 def get_error(fileobj):
     global error_report_funcs
     func = error_report_funcs.get(fileobj)
@@ -43,15 +43,16 @@ from .base import MemoryStr, QuerySplittingResults
 from .subst import substitute_params
 
 from .filehelper import open_for_write_immediate
-from .jobs import read_job_template, write_job_files
+from .jobs import read_job_template, write_job_files, write_indexed_job_file
 from .util import ElbSupportedPrograms, safe_exec, UserReportError, SafeExecError
 from .util import validate_gcp_disk_name, get_blastdb_info, get_usage_reporting
 
 from . import kubernetes
+from . import k8s_api
 from .constants import CLUSTER_ERROR, ELB_NUM_JOBS_SUBMITTED, ELB_METADATA_DIR, K8S_JOB_SUBMIT_JOBS
 from .constants import ELB_STATE_DISK_ID_FILE, DEPENDENCY_ERROR
 from .constants import ELB_QUERY_BATCH_DIR, ELB_DFLT_MIN_NUM_NODES
-from .constants import K8S_JOB_CLOUD_SPLIT_SSD, K8S_JOB_INIT_PV
+from .constants import K8S_JOB_CLOUD_SPLIT_SSD, K8S_JOB_INIT_PV, K8S_STATUS_APPS
 from .constants import K8S_JOB_BLAST, K8S_JOB_GET_BLASTDB, K8S_JOB_IMPORT_QUERY_BATCHES
 from .constants import K8S_JOB_LOAD_BLASTDB_INTO_RAM, K8S_JOB_RESULTS_EXPORT, K8S_UNINITIALIZED_CONTEXT
 from .constants import ELB_DOCKER_IMAGE_GCP, ELB_QUERY_LENGTH, INPUT_ERROR
@@ -62,7 +63,7 @@ from .constants import GKE_CLUSTER_STATUS_STOPPING, GKE_CLUSTER_STATUS_ERROR
 from .constants import STATUS_MESSAGE_ERROR
 from .elb_config import ElasticBlastConfig
 from .elasticblast import ElasticBlast
-from .gcp_traits import enable_gcp_api
+from .gcp_traits import enable_gcp_api, get_machine_properties
 
 class ElasticBlastGcp(ElasticBlast):
     """ Implementation of core ElasticBLAST functionality in GCP. """
@@ -95,6 +96,19 @@ class ElasticBlastGcp(ElasticBlast):
         kubectl = f'kubectl --context={k8s_ctx}'
         job_to_wait = K8S_JOB_CLOUD_SPLIT_SSD if self.cfg.cluster.use_local_ssd else K8S_JOB_INIT_PV
 
+        client = None if self.dry_run else k8s_api.get_k8s_client(k8s_ctx)
+        if client:
+            # returns as soon as the job finishes instead of checking it periodically
+            logging.debug(f'Waiting for job {job_to_wait}')
+            for job in client.watch('batch/v1', 'Job', job_to_wait):
+                conditions = [c['type'] for c in job.get('status', {}).get('conditions', [])
+                              if c.get('status') == 'True']
+                if 'Failed' in conditions:
+                    raise UserReportError(returncode=CLUSTER_ERROR,
+                                          message=self._cloud_query_split_error(job_to_wait))
+                if 'Complete' in conditions:
+                    return
+
         while True:
             cmd = f"{kubectl} get job {job_to_wait} -o jsonpath=" "'{.items[?(@.status.active)].metadata.name}'"
             if self.dry_run:
@@ -110,20 +124,25 @@ class ElasticBlastGcp(ElasticBlast):
                 proc = safe_exec(cmd)
                 res = proc.stdout.decode()
                 if res:
-                    if job_to_wait == K8S_JOB_INIT_PV:
-                        # Assume BLASTDB error, as it is more likely to occur than copying files to PV when importing queries
-                        msg = 'BLASTDB initialization failed, please run '
-                        msg += f'"elastic-blast status --gcp-project {self.cfg.gcp.project} '
-                        msg += f'--gcp-region {self.cfg.gcp.region} --gcp-zone '
-                        msg += f'{self.cfg.gcp.zone} --results {self.cfg.cluster.name}" '
-                        msg += 'for further details'
-                    else:
-                        msg = 'Cloud query splitting or upload of its results from SSD failed'
-                    raise UserReportError(returncode=CLUSTER_ERROR, message=msg)
+                    raise UserReportError(returncode=CLUSTER_ERROR,
+                                          message=self._cloud_query_split_error(job_to_wait))
                 else:
                     return
             time.sleep(30)
 
+    def _cloud_query_split_error(self, job_name: str) -> str:
+        """ Error message for a failed cloud query split job """
+        if job_name == K8S_JOB_INIT_PV:
+            # Assume BLASTDB error, as it is more likely to occur than copying files to PV when importing queries
+            msg = 'BLASTDB initialization failed, please run '
+            msg += f'"elastic-blast status --gcp-project {self.cfg.gcp.project} '
+            msg += f'--gcp-region {self.cfg.gcp.region} --gcp-zone '
+            msg += f'{self.cfg.gcp.zone} --results {self.cfg.cluster.name}" '
+            msg += 'for further details'
+        else:
+            msg = 'Cloud query splitting or upload of its results from SSD failed'
+        return msg
+
     def upload_query_length(self, query_length: int) -> None:
         """ Save query length in a metadata file in GS """
         if query_length <= 0: return
@@ -157,7 +176,8 @@ class ElasticBlastGcp(ElasticBlast):
         # Can't use one stage cloud split for GCP, should never happen
         assert(not one_stage_cloud_query_split)
         if not self.cluster_initialized:
-            self._check_job_number_limit(query_batches, query_length)
+            if not self._use_indexed_job():
+                self._check_job_number_limit(query_batches, query_length)
             self.query_files = []  # No cloud split
             logging.debug("Initialize cluster with NO cloud split")
             self._initialize_cluster()
@@ -239,30 +259,20 @@ class ElasticBlastGcp(ElasticBlast):
                                 'It may be still initializing, please try checking status again in a few minutes.')
 
         k8s_ctx = self._get_gke_credentials()
-        selector = 'app=blast'
+        # all job counts come from a single listing of jobs
+        counts_by_app = self._job_status_snapshot(k8s_ctx)
+        counts = counts_by_app['blast']
         kubectl = f'kubectl --context={k8s_ctx}'
+        client = None if self.dry_run else k8s_api.get_k8s_client(k8s_ctx)
 
-        # if we need name of the job in the future add NAME:.metadata.name to custom-columns
-        # get status of jobs (pending/running, succeeded, failed)
-        cmd = f'{kubectl} get jobs -o custom-columns=STATUS:.status.conditions[0].type -l {selector}'.split()
-        if self.dry_run:
-            logging.debug(cmd)
-        else:
-            proc = safe_exec(cmd)
-            for line in proc.stdout.decode().split('\n'):
-                if not line or line.startswith('STATUS'):
-                    continue
-                if line.startswith('Complete'):
-                    counts['succeeded'] += 1
-                elif line.startswith('Failed'):
-                    counts['failed'] += 1
-                else:
-                    counts['pending'] += 1
-                
         # get number of running pods
-        cmd = f'{kubectl} get pods -o custom-columns=STATUS:.status.phase -l {selector}'.split()
+        cmd = f'{kubectl} get pods -o custom-columns=STATUS:.status.phase --no-headers ' \
+              '--field-selector=status.phase=Running -l app=blast'.split()
         if self.dry_run:
             logging.info(cmd)
+        elif client:
+            counts['running'] += sum(1 for _ in client.list('v1', 'Pod', label_selector='app=blast',
+                                                            field_selector='status.phase=Running'))
         else:
             proc = safe_exec(cmd)
             for line in proc.stdout.decode().split('\n'):
@@ -282,44 +292,61 @@ class ElasticBlastGcp(ElasticBlast):
         else:
             # check init-pv and submit-jobs status
             status = ElbStatus.SUBMITTING
-            pending, succeeded, failed = self._job_status_by_app('setup')
-            if failed > 0:
+            if counts_by_app['setup']['failed'] > 0:
                 status = ElbStatus.FAILURE
-            elif pending == 0:
-                pending, succeeded, failed = self._job_status_by_app('submit')
-                if failed > 0:
+            elif counts_by_app['setup']['pending'] == 0:
+                if counts_by_app['submit']['failed'] > 0:
                     status = ElbStatus.FAILURE
 
         return status, counts, {}
-    
-    def _job_status_by_app(self, app):
-        """ get status of jobs (pending/running, succeeded, failed) by app """
-        pending = 0
-        succeeded = 0
-        failed = 0
-        selector = f'app={app}'
-        k8s_ctx = self._get_gke_credentials()
-        kubectl = f'kubectl --context={k8s_ctx}'
-        cmd = f'{kubectl} get jobs -o custom-columns=STATUS:.status.conditions[0].type -l {selector}'.split()
+
+    def _job_status_snapshot(self, k8s_ctx: str) -> Dict[str, DefaultDict[str, int]]:
+        """ Get numbers of pending (including running), succeeded, and failed
+        jobs for each of K8S_STATUS_APPS from one listing of Kubernetes jobs,
+        that retrieves only the fields needed for counting.
+        Parameters:
+            k8s_ctx - Kubernetes context
+        Returns:
+            dictionary of job counts by app label, counts for BLAST searches
+            are numbers of query batches
+        """
+        counts_by_app: Dict[str, DefaultDict[str, int]] = {app: defaultdict(int) for app in K8S_STATUS_APPS}
+        selector = f'app in ({",".join(K8S_STATUS_APPS)})'
+        # the label selector has spaces, so the command is built as a list
+        cmd = ['kubectl', f'--context={k8s_ctx}', 'get', 'jobs', '-o',
+               'custom-columns=APP:.metadata.labels.app,STATUS:.status.conditions[0].type,'
+               'MODE:.spec.completionMode,COMPLETIONS:.spec.completions,SUCCEEDED:.status.succeeded',
+               '--no-headers', '-l', selector]
         if self.dry_run:
             logging.debug(cmd)
+            return counts_by_app
+        client = k8s_api.get_k8s_client(k8s_ctx)
+        if client:
+            rows = [_get_job_columns(job) for job in
+                    client.list('batch/v1', 'Job', label_selector=selector)]
         else:
-            try:
-                proc = safe_exec(cmd)
-            except SafeExecError as err:
-                logging.debug(f'Error "{err.message}" in command "{cmd}"')
-                return 0, 0, 0
-            for line in proc.stdout.decode().split('\n'):
-                if not line or line.startswith('STATUS'):
-                    continue
-                if line.startswith('Complete'):
-                    succeeded += 1
-                elif line.startswith('Failed'):
-                    failed += 1
+            rows = [line.split() for line in safe_exec(cmd).stdout.decode().split('\n')]
+        for fields in rows:
+            if len(fields) < 2 or fields[0] not in counts_by_app:
+                continue
+            counts = counts_by_app[fields[0]]
+            status = fields[1]
+            if len(fields) == 5 and fields[2] == 'Indexed':
+                # an indexed job searches one query batch per completion
+                completions = int(fields[3])
+                succeeded = int(fields[4]) if fields[4].isdigit() else 0
+                counts['succeeded'] += succeeded
+                if status == 'Failed':
+                    counts['failed'] += completions - succeeded
                 else:
-                    pending += 1
-        return pending, succeeded, failed
-
+                    counts['pending'] += completions - succeeded
+            elif status == 'Complete':
+                counts['succeeded'] += 1
+            elif status == 'Failed':
+                counts['failed'] += 1
+            else:
+                counts['pending'] += 1
+        return counts_by_app
 
     def delete(self):
         enable_gcp_api(self.cfg.gcp.project, self.cfg.cluster.dry_run)
@@ -433,12 +460,40 @@ class ElasticBlastGcp(ElasticBlast):
         return subs
 
 
+    def _use_indexed_job(self) -> bool:
+        """ Search all query batches with a single Kubernetes Indexed Job
+            instead of one job per query batch """
+        return 'ELB_USE_K8S_INDEXED_JOB' in os.environ
+
+    def _get_job_parallelism(self) -> int:
+        """ Get the number of BLAST searches that can run in the cluster
+            at the same time """
+        ncpus = get_machine_properties(self.cfg.cluster.machine_type).ncpus
+        return self.cfg.cluster.num_nodes * max(1, ncpus // int(self.cfg.cluster.num_cpus))
+
     def _generate_and_submit_jobs(self, queries: List[str]):
         cfg, clean_up_stack = self.cfg, self.cleanup_stack
+        # Should never happen, cfg.appstate.k8s_ctx should always be initialized properly
+        # by the time of this call 
+        assert(cfg.appstate.k8s_ctx)
         subs = self.job_substitutions()
-        job_template_text = read_job_template(cfg=cfg)
         with TemporaryDirectory() as job_path:
-            job_files = write_job_files(job_path, 'batch_', job_template_text, queries, **subs)
+            job_files = []
+            indexed_job = None
+            if self._use_indexed_job():
+                indexed_job = write_indexed_job_file(job_path, 'batch_', read_job_template(cfg=cfg, indexed=True),
+                                                     queries, self._get_job_parallelism(), **subs)
+                if indexed_job:
+                    job_files = [indexed_job]
+                else:
+                    logging.debug('Query batch numbers do not match their positions, submitting one job per query batch')
+            if not job_files:
+                job_template_text = read_job_template(cfg=cfg)
+                # Kubernetes API client submits all documents of a file
+                # without starting kubectl for each job
+                single_file = not self.dry_run and k8s_api.get_k8s_client(cfg.appstate.k8s_ctx) is not None
+                job_files = write_job_files(job_path, 'batch_', job_template_text, queries,
+                                            single_file=single_file, **subs)
             logging.debug(f'Generated {len(job_files)} job files')
             if len(job_files) > 0:
                 logging.debug(f'Job #1 file: {job_files[0]}')
@@ -451,9 +506,6 @@ class ElasticBlastGcp(ElasticBlast):
 
             logging.info('Submitting jobs to cluster')
             clean_up_stack.append(lambda: logging.debug('Before submission computational jobs'))
-            # Should never happen, cfg.appstate.k8s_ctx should always be initialized properly
-            # by the time of this call 
-            assert(cfg.appstate.k8s_ctx)
             start = timer()
             job_names = kubernetes.submit_jobs(cfg.appstate.k8s_ctx, Path(job_path), dry_run=self.dry_run)
             end = timer()
@@ -464,7 +516,8 @@ class ElasticBlastGcp(ElasticBlast):
                 logging.debug(f'Job #1 name: {job_names[0]}')
             # Signal janitor job to start checking for results
             with open_for_write_immediate(os.path.join(cfg.cluster.results, ELB_METADATA_DIR, ELB_NUM_JOBS_SUBMITTED)) as f:
-                f.write(str(len(job_names)))
+                # an indexed job runs one search per query batch
+                f.write(str(len(queries) if indexed_job else len(job_names)))
 
 
     def get_disk_quota(self) -> Tuple[float, float]:
@@ -502,6 +555,19 @@ class ElasticBlastGcp(ElasticBlast):
         return self.cfg.appstate.k8s_ctx
 
 
+def _get_job_columns(job: Dict[str, Any]) -> List[str]:
+    """ Get app label, condition type, completion mode, number of completions,
+    and number of succeeded pods of a Kubernetes job, as kubectl
+    custom-columns would show them """
+    spec = job.get('spec', {})
+    status = job.get('status', {})
+    conditions = status.get('conditions') or [{}]
+    values = [job.get('metadata', {}).get('labels', {}).get('app'),
+              conditions[0].get('type'), spec.get('completionMode'),
+              spec.get('completions'), status.get('succeeded')]
+    return ['<none>' if value is None else str(value) for value in values]
+
+
 def set_gcp_project(project: str) -> None:
     """Set current GCP project in gcloud environment, raises
     util.SafeExecError on problems with running command line gcloud"""
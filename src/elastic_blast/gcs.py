@@ -0,0 +1,353 @@
+#                           PUBLIC DOMAIN NOTICE
+#              National Center for Biotechnology Information
+#
+# This software is a "United States Government Work" under the
+# terms of the United States Copyright Act.  It was written as part of
+# the authors' official duties as United States Government employees and
+# thus cannot be copyrighted.  This software is freely available
+# to the public for use.  The National Library of Medicine and the U.S.
+# Government have not placed any restriction on its use or reproduction.
+#
+# Although all reasonable efforts have been taken to ensure the accuracy
+# and reliability of the software and data, the NLM and the U.S.
+# Government do not and cannot warrant the performance or results that
+# may be obtained by using this software or data.  The NLM and the U.S.
+# Government disclaim all warranties, express or implied, including
+# warranties of performance, merchantability or fitness for any particular
+# purpose.
+#
+# Please cite NCBI in any work or product based on this material.
+
+"""
+elb/gcs.py - In-process client for Google Cloud Storage
+
+Talks to the GCS JSON API over a pool of persistent connections, so that
+operations on gs:// paths do not start a gsutil process each. The client is
+used by default, and always when STORAGE_EMULATOR_HOST points to a GCS
+emulator (e.g.: fake-gcs-server). When ELB_USE_GSUTIL environment variable is
+set, or when no access token can be obtained, get_gcs_client returns None and
+callers fall back to gsutil.
+
+"""
+
+import os
+import io
+import json
+import math
+import errno
+import logging
+import threading
+import subprocess
+from timeit import default_timer as timer
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import quote, urlencode
+from typing import Any, Dict, IO, Iterator, List, Optional, Tuple, Union, cast
+
+import urllib3  # type: ignore
+
+from .constants import ELB_GCS_PREFIX, ELB_GCS_API_URL, ELB_GCS_MAX_POOL_CONNECTIONS
+from .constants import ELB_GCS_COMPOSITE_UPLOAD_THRESHOLD, ELB_GCS_MAX_COMPOSE_COMPONENTS
+
+# Access tokens issued by gcloud are valid for an hour, refresh them earlier
+ACCESS_TOKEN_LIFETIME = 45 * 60
+
+
+def split_gcs_uri(uri: str) -> Tuple[str, str]:
+    """ Split gs://bucket/key into bucket and key """
+    if not uri.startswith(ELB_GCS_PREFIX):
+        raise ValueError(f'Incorrect GCS path {uri}')
+    bucket, _, key = uri[len(ELB_GCS_PREFIX):].partition('/')
+    return bucket, key
+
+
+class AccessToken:
+    """ OAuth2 access token for GCS requests, obtained once per its lifetime
+    from GOOGLE_OAUTH_ACCESS_TOKEN environment variable or gcloud """
+    def __init__(self):
+        self.token = ''
+        self.expires = 0.0
+        self.lock = threading.Lock()
+
+    def get(self, refresh: bool = False) -> str:
+        """ Return a valid access token, fetch a new one if needed """
+        with self.lock:
+            if refresh or not self.token or timer() > self.expires:
+                self.token = self._fetch()
+                self.expires = timer() + ACCESS_TOKEN_LIFETIME
+            return self.token
+
+    @staticmethod
+    def _fetch() -> str:
+        token = os.environ.get('GOOGLE_OAUTH_ACCESS_TOKEN')
+        if token:
+            return token
+        p = subprocess.run(['gcloud', 'auth', 'print-access-token'], check=True,
+                           stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        token = p.stdout.decode().strip()
+        if not token:
+            raise PermissionError(errno.EACCES, 'gcloud returned an empty access token')
+        return token
+
+
+class _FilePart(io.RawIOBase):
+    """ Read-only view of a byte range of a file, used as request body """
+    def __init__(self, filename: str, offset: int, length: int):
+        self.f = open(filename, 'rb')
+        self.f.seek(offset)
+        self.remaining = length
+
+    def readable(self) -> bool:
+        return True
+
+    def readinto(self, b) -> int:
+        n = self.f.readinto(memoryview(b)[:min(len(b), self.remaining)])
+        self.remaining -= n
+        return n
+
+    def close(self) -> None:
+        self.f.close()
+        super().close()
+
+
+class GCSClient:
+    """ Thread-safe client for GCS JSON API. Methods take gs:// paths and
+    raise FileNotFoundError, PermissionError or OSError on failures. """
+
+    def __init__(self, endpoint: str = ELB_GCS_API_URL, token: Optional[AccessToken] = None):
+        """ Parameters:
+                endpoint - GCS JSON API URL
+                token - access token, None if the endpoint does not require authentication
+        """
+        self.endpoint = endpoint.rstrip('/')
+        self.token = token
+        retries = urllib3.Retry(total=3, backoff_factor=0.5,
+                                status_forcelist=[429, 500, 502, 503, 504],
+                                raise_on_status=False)
+        self.http = urllib3.PoolManager(maxsize=ELB_GCS_MAX_POOL_CONNECTIONS,
+                                        retries=retries)
+
+    def _object_path(self, bucket: str, key: str) -> str:
+        return f'/storage/v1/b/{quote(bucket, safe="")}/o/{quote(key, safe="")}'
+
+    def _request(self, method: str, path: str, uri: str,
+                 query: Optional[Dict[str, str]] = None,
+                 user_project: Optional[str] = None,
+                 body: Union[None, bytes, IO[bytes]] = None,
+                 headers: Optional[Dict[str, str]] = None,
+                 preload_content: bool = True) -> urllib3.HTTPResponse:
+        query = dict(query or {})
+        if user_project:
+            query['userProject'] = user_project
+        url = self.endpoint + path + ('?' + urlencode(query) if query else '')
+        # Retry once with a fresh token if it expired early, unless request
+        # body is a stream which cannot be resent
+        attempts = 1 if self.token is None or hasattr(body, 'read') else 2
+        for attempt in range(attempts):
+            hdrs = dict(headers or {})
+            if self.token:
+                hdrs['Authorization'] = f'Bearer {self.token.get(refresh=attempt > 0)}'
+            try:
+                resp = self.http.request(method, url, body=body, headers=hdrs,
+                                         preload_content=preload_content)
+            except urllib3.exceptions.HTTPError as e:
+                raise OSError(errno.EIO, f'{method} {uri} failed: {e}')
+            if resp.status != 401:
+                break
+        if resp.status >= 400:
+            message = resp.data.decode(errors='replace')
+            try:
+                message = json.loads(message)['error']['message']
+            except (ValueError, KeyError, TypeError):
+                pass
+            message = f'{method} {uri} failed with HTTP status {resp.status}: {message}'
+            if resp.status == 404:
+                raise FileNotFoundError(errno.ENOENT, message)
+            if resp.status in (401, 403):
+                raise PermissionError(errno.EACCES, message)
+            raise OSError(errno.EIO, message)
+        return resp
+
+    def stat(self, uri: str, user_project: Optional[str] = None) -> Dict[str, Any]:
+        """ Get object metadata """
+        bucket, key = split_gcs_uri(uri)
+        resp = self._request('GET', self._object_path(bucket, key), uri,
+                             user_project=user_project)
+        return json.loads(resp.data)
+
+    def get_size(self, uri: str, user_project: Optional[str] = None) -> int:
+        """ Get object size in bytes """
+        return int(self.stat(uri, user_project)['size'])
+
+    def open(self, uri: str, start: int = 0, end: Optional[int] = None,
+             user_project: Optional[str] = None, generation: Optional[str] = None) -> IO[bytes]:
+        """ Open an object for streaming read in binary mode
+        Parameters:
+            uri - object path
+            start - first byte to read
+            end - byte to stop reading at (exclusive), None to read to the end
+            user_project - GCP project billed for requester pays buckets
+            generation - object generation to read, FileNotFoundError is
+                         raised if it is no longer available
+        """
+        bucket, key = split_gcs_uri(uri)
+        headers = {}
+        if start or end is not None:
+            last = str(end - 1) if end is not None else ''
+            headers['Range'] = f'bytes={start}-{last}'
+        query = {'alt': 'media'}
+        if generation:
+            query['generation'] = generation
+        resp = self._request('GET', self._object_path(bucket, key), uri,
+                             query=query, user_project=user_project,
+                             headers=headers, preload_content=False)
+        resp.auto_close = False
+        return io.BufferedReader(resp)
+
+    def read(self, uri: str, start: int = 0, end: Optional[int] = None,
+             user_project: Optional[str] = None, generation: Optional[str] = None) -> bytes:
+        """ Read an object or a range of its bytes """
+        with self.open(uri, start, end, user_project, generation) as f:
+            return f.read()
+
+    def list(self, prefix: str, delimiter: Optional[str] = None,
+             user_project: Optional[str] = None) -> Iterator[str]:
+        """ List objects whose paths start with prefix
+        Parameters:
+            prefix - gs:// path prefix
+            delimiter - if provided, objects with delimiter in the path after
+                        prefix are skipped, like in a directory listing
+            user_project - GCP project billed for requester pays buckets
+        Returns:
+            gs:// paths of the objects
+        """
+        bucket, key = split_gcs_uri(prefix)
+        query = {'prefix': key, 'fields': 'items(name),nextPageToken'}
+        if delimiter:
+            query['delimiter'] = delimiter
+        while True:
+            resp = self._request('GET', f'/storage/v1/b/{quote(bucket, safe="")}/o',
+                                 prefix, query=query, user_project=user_project)
+            listing = json.loads(resp.data)
+            for item in listing.get('items', []):
+                yield f'{ELB_GCS_PREFIX}{bucket}/{item["name"]}'
+            if not listing.get('nextPageToken'):
+                break
+            query['pageToken'] = listing['nextPageToken']
+
+    def upload(self, uri: str, data: Union[bytes, IO[bytes]], size: Optional[int] = None) -> None:
+        """ Upload bytes or a binary stream of a given size to an object """
+        bucket, key = split_gcs_uri(uri)
+        if size is None:
+            if not isinstance(data, bytes):
+                raise ValueError('Size is required to upload a stream')
+            size = len(data)
+        headers = {'Content-Type': 'application/octet-stream',
+                   'Content-Length': str(size)}
+        self._request('POST', f'/upload/storage/v1/b/{quote(bucket, safe="")}/o', uri,
+                      query={'uploadType': 'media', 'name': key},
+                      body=data, headers=headers)
+
+    def upload_file(self, filename: str, uri: str) -> None:
+        """ Upload a local file. Files larger than
+        ELB_GCS_COMPOSITE_UPLOAD_THRESHOLD are uploaded in parallel as separate
+        components which are then composed into the object. """
+        size = os.path.getsize(filename)
+        if size <= ELB_GCS_COMPOSITE_UPLOAD_THRESHOLD:
+            with open(filename, 'rb') as f:
+                self.upload(uri, f, size)
+            return
+        start = timer()
+        num_parts = ELB_GCS_MAX_COMPOSE_COMPONENTS
+        part_size = math.ceil(size / num_parts)
+        num_parts = math.ceil(size / part_size)
+        parts = [f'{uri}.elb-component-{i:02d}' for i in range(num_parts)]
+
+        def upload_part(i: int) -> None:
+            length = min(part_size, size - i * part_size)
+            with _FilePart(filename, i * part_size, length) as body:
+                self.upload(parts[i], cast(IO[bytes], body), length)
+
+        try:
+            with ThreadPoolExecutor(max_workers=num_parts) as executor:
+                for future in [executor.submit(upload_part, i) for i in range(num_parts)]:
+                    future.result()
+            self.compose(uri, parts)
+        finally:
+            self.delete_many(parts, ignore_missing=True)
+        end = timer()
+        logging.debug(f'SPEED to upload {filename} to {uri} {(size/1000000)/(end-start):.2f} MB/second')
+
+    def compose(self, uri: str, sources: List[str]) -> None:
+        """ Concatenate objects from the same bucket into one """
+        bucket, key = split_gcs_uri(uri)
+        request = {'sourceObjects': [{'name': split_gcs_uri(src)[1]} for src in sources],
+                   'destination': {'contentType': 'application/octet-stream'}}
+        self._request('POST', self._object_path(bucket, key) + '/compose', uri,
+                      body=json.dumps(request).encode(),
+                      headers={'Content-Type': 'application/json'})
+
+    def delete(self, uri: str) -> None:
+        """ Delete an object """
+        bucket, key = split_gcs_uri(uri)
+        self._request('DELETE', self._object_path(bucket, key), uri)
+
+    def delete_many(self, uris: List[str], ignore_missing: bool = False) -> None:
+        """ Delete objects concurrently, raise the first error, if any """
+        def delete(uri: str) -> None:
+            try:
+                self.delete(uri)
+            except FileNotFoundError:
+                if not ignore_missing:
+                    raise
+        if not uris:
+            return
+        with ThreadPoolExecutor(max_workers=min(len(uris), ELB_GCS_MAX_POOL_CONNECTIONS)) as executor:
+            for future in [executor.submit(delete, uri) for uri in uris]:
+                future.result()
+
+
+_gcs_client: Optional[GCSClient] = None
+_gcs_client_initialized = False
+_gcs_client_lock = threading.Lock()
+
+
+def use_native_gcs() -> bool:
+    """ Is the in-process GCS client allowed """
+    return 'ELB_USE_GSUTIL' not in os.environ or 'STORAGE_EMULATOR_HOST' in os.environ
+
+
+def get_gcs_client() -> Optional[GCSClient]:
+    """ Get the GCS client shared by the process.
+    Returns None if gsutil is requested or the in-process client is not
+    available, because no access token can be obtained, in which case gsutil
+    should be used.
+    """
+    global _gcs_client, _gcs_client_initialized
+    if not use_native_gcs():
+        return None
+    with _gcs_client_lock:
+        if not _gcs_client_initialized:
+            _gcs_client_initialized = True
+            emulator = os.environ.get('STORAGE_EMULATOR_HOST')
+            if emulator:
+                if not emulator.startswith('http'):
+                    emulator = 'http://' + emulator
+                logging.debug(f'Using GCS emulator at {emulator}')
+                _gcs_client = GCSClient(emulator)
+            else:
+                token = AccessToken()
+                try:
+                    token.get()
+                    _gcs_client = GCSClient(ELB_GCS_API_URL, token)
+                except (OSError, subprocess.CalledProcessError) as e:
+                    logging.debug(f'In-process GCS client is not available, using gsutil: {e}')
+        return _gcs_client
+
+
+def clear_gcs_client() -> None:
+    """ Forget the shared GCS client, so that the next get_gcs_client call
+    re-reads the configuration """
+    global _gcs_client, _gcs_client_initialized
+    with _gcs_client_lock:
+        _gcs_client = None
+        _gcs_client_initialized = False
@@ -28,23 +28,34 @@ Author: Victor Joukov joukovv@ncbi.nlm.nih.gov
 
 import os
 import re
-from typing import List
+import logging
+from timeit import default_timer as timer
+from typing import Dict, Iterable, List
 from pkg_resources import resource_string
 from typing import Optional
 
 from .filehelper import open_for_read, open_for_write
-from .subst import substitute_params
+from .subst import substitute_params, Template
 from .constants import ELB_DFLT_BLAST_JOB_TEMPLATE, ELB_LOCAL_SSD_BLAST_JOB_TEMPLATE
+from .constants import ELB_INDEXED_BLAST_JOB_TEMPLATE, ELB_LOCAL_SSD_INDEXED_BLAST_JOB_TEMPLATE
+from .constants import K8S_JOB_BACKOFF_LIMIT
 from .elb_config import ElasticBlastConfig
 
-def read_job_template(template_name=ELB_DFLT_BLAST_JOB_TEMPLATE, cfg: Optional[ElasticBlastConfig] = None):
+def read_job_template(template_name=ELB_DFLT_BLAST_JOB_TEMPLATE, cfg: Optional[ElasticBlastConfig] = None,
+                      indexed: bool = False):
     """ Read job template file or resource
     Parameters:
         template_name - name of file to read or default resource
+        cfg - elastic-blast configuration, selects local SSD template
+        indexed - read template for a single Kubernetes Indexed Job
     Returns:
         string with job template text
     """
-    if cfg and cfg.cluster.use_local_ssd:
+    if indexed:
+        template_name = ELB_INDEXED_BLAST_JOB_TEMPLATE
+        if cfg and cfg.cluster.use_local_ssd:
+            template_name = ELB_LOCAL_SSD_INDEXED_BLAST_JOB_TEMPLATE
+    elif cfg and cfg.cluster.use_local_ssd:
         template_name = ELB_LOCAL_SSD_BLAST_JOB_TEMPLATE
     resource_prefix = 'resource:'
     resource_prefix_len = len(resource_prefix)
@@ -58,22 +69,19 @@ def read_job_template(template_name=ELB_DFLT_BLAST_JOB_TEMPLATE, cfg: Optional[E
 re_batch_num = re.compile(r'[^0-9]+([0-9]{3,})')
 
 
-def _write_job_file(job_path, job_prefix, job_template, query_fqn, njob, **subs):
-    """ Write YAML job file from template making substitutions
+# Variables that have a different value in each job
+JOB_VARIABLES = {'QUERY', 'QUERY_FQN', 'QUERY_PATH', 'QUERY_NUM', 'JOB_NUM', 'BLAST_ELB_BATCH_NUM'}
+
+
+def _job_variables(query_fqn: str, njob: int) -> Dict[str, str]:
+    """ Get values of per job variables
         internal function
     Parameters:
-        job_path: path to which write job files
-        job_prefix: name prefix for job file
-        job_template: string with contents of job file with variables to substitute
         query_fqn: fully qualified name of query file
         njob: ordinal number of a job
-        subs: other substitution variables
     Result:
-        Job file name
+        Dictionary of JOB_VARIABLES values
     """
-    if not job_template:
-        return None
-    job_file_name = os.path.join(job_path, f'{job_prefix}{njob:03d}.yaml')
     query_path = os.path.dirname(query_fqn)
     query = os.path.splitext(os.path.basename(query_fqn))[0]
     # Try to recover batch number from file name, if not available use njob
@@ -82,39 +90,91 @@ def _write_job_file(job_path, job_prefix, job_template, query_fqn, njob, **subs)
         query_num = mo.group(1)
     else:
         query_num = f'{njob:03d}'
-
-    map_obj = {}
-    for k, v in subs.items():
-        map_obj[k] = v
-    map_obj['QUERY'] = query
-    map_obj['QUERY_FQN'] = query_fqn
-    map_obj['QUERY_PATH'] = query_path
-    map_obj['QUERY_NUM'] = query_num
-    map_obj['JOB_NUM'] = query_num
-
-    s = substitute_params(job_template, map_obj)
-    with open_for_write(job_file_name) as f:
-        f.write(s)
-    return job_file_name
+    return {'QUERY': query, 'QUERY_FQN': query_fqn, 'QUERY_PATH': query_path,
+            'QUERY_NUM': query_num, 'JOB_NUM': query_num,
+            'BLAST_ELB_BATCH_NUM': str(njob)}
 
 
-def write_job_files(job_path: str, job_prefix: str, job_template: str, queries: List[str], **subs):
+def write_job_files(job_path: str, job_prefix: str, job_template: str, queries: Iterable[str],
+                    single_file: bool = False, **subs) -> List[str]:
     """ Write YAML job files from template making substitutions
     Parameters:
         job_path: path to which write job files
         job_prefix: name prefix for job file
         job_template: string with contents of job file with variables to substitute
-        queries: list of query file names to substitute in job files
+        queries: query file names to substitute in job files, may be a
+            generator producing them while the query is split
+        single_file: write all jobs to one multi-document YAML file, for
+            consumers that accept it
         subs: other substitution variables
     Result:
         List of job file names
     """
     if not job_template:
         return []
-    jobs = []
-    for njob, query in enumerate(queries):
-        subs['BLAST_ELB_BATCH_NUM'] = str(njob)
-        job = _write_job_file(job_path, job_prefix,
-                              job_template, query, njob, **subs)
-        jobs.append(job)
+    # the template is parsed and variables common to all jobs are substituted
+    # once, so that only per job variables are substituted for each job
+    template = Template(job_template).bind(subs, keep=JOB_VARIABLES)
+    start = timer()
+    num_jobs = 0
+    if single_file:
+        job_file_name = os.path.join(job_path, f'{job_prefix}all.yaml')
+        with open_for_write(job_file_name) as f:
+            for njob, query in enumerate(queries):
+                num_jobs += 1
+                doc = template.render(_job_variables(query, njob))
+                if not doc.startswith('---'):
+                    f.write('---\n')
+                f.write(doc)
+                if not doc.endswith('\n'):
+                    f.write('\n')
+        jobs = [job_file_name] if num_jobs else []
+    else:
+        jobs = []
+        for njob, query in enumerate(queries):
+            job_file_name = os.path.join(job_path, f'{job_prefix}{njob:03d}.yaml')
+            with open_for_write(job_file_name) as f:
+                f.write(template.render(_job_variables(query, njob)))
+            jobs.append(job_file_name)
+        num_jobs = len(jobs)
+    end = timer()
+    logging.debug(f'RUNTIME write-job-files {end-start:.2f} seconds')
+    if end > start:
+        logging.debug(f'SPEED to write-job-files {num_jobs/(end-start):.2f} jobs/second')
     return jobs
+
+
+def write_indexed_job_file(job_path: str, job_prefix: str, job_template: str, queries: List[str],
+                           parallelism: int, **subs) -> Optional[str]:
+    """ Write YAML file for a single Kubernetes Indexed Job that searches all
+    query batches. The pod with completion index N searches query batch N, so
+    query batch numbers must match their positions in the list of queries.
+    Parameters:
+        job_path: path to which write job file
+        job_prefix: name prefix for job file
+        job_template: string with contents of indexed job template
+        queries: list of query file names
+        parallelism: maximum number of query batches searched at the same time
+        subs: other substitution variables
+    Result:
+        Job file name or None if query batch numbers do not match their
+        positions in the list of queries
+    """
+    if not job_template or not queries:
+        return None
+    for njob, query_fqn in enumerate(queries):
+        query = os.path.splitext(os.path.basename(query_fqn))[0]
+        mo = re_batch_num.match(query)
+        if not mo or int(mo.group(1)) != njob:
+            return None
+
+    map_obj = dict(subs)
+    map_obj['ELB_NUM_JOBS'] = str(len(queries))
+    map_obj['ELB_JOB_PARALLELISM'] = str(max(1, min(parallelism, len(queries))))
+    # the limit applies to all pods of the job
+    map_obj['ELB_JOB_BACKOFF_LIMIT'] = str(K8S_JOB_BACKOFF_LIMIT * len(queries))
+
+    job_file_name = os.path.join(job_path, f'{job_prefix}indexed.yaml')
+    with open_for_write(job_file_name) as f:
+        f.write(substitute_params(job_template, map_obj))
+    return job_file_name
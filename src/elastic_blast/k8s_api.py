@@ -0,0 +1,499 @@
+#                           PUBLIC DOMAIN NOTICE
+#              National Center for Biotechnology Information
+#
+# This software is a "United States Government Work" under the
+# terms of the United States Copyright Act.  It was written as part of
+# the authors' official duties as United States Government employees and
+# thus cannot be copyrighted.  This software is freely available
+# to the public for use.  The National Library of Medicine and the U.S.
+# Government have not placed any restriction on its use or reproduction.
+#
+# Although all reasonable efforts have been taken to ensure the accuracy
+# and reliability of the software and data, the NLM and the U.S.
+# Government do not and cannot warrant the performance or results that
+# may be obtained by using this software or data.  The NLM and the U.S.
+# Government disclaim all warranties, express or implied, including
+# warranties of performance, merchantability or fitness for any particular
+# purpose.
+#
+# Please cite NCBI in any work or product based on this material.
+
+"""
+elb/k8s_api.py - In-process client for Kubernetes API
+
+Talks to the Kubernetes API server over a pool of persistent connections
+authenticated once per process, so that functions in elastic_blast.kubernetes
+do not start a kubectl process and reload kubeconfig for each call. The client
+is used when ELB_USE_K8S_API environment variable is set. Otherwise, or when
+the cluster credentials cannot be used by the client, get_k8s_client returns
+None and callers fall back to kubectl.
+
+Kubernetes objects are created with server-side apply, so YAML manifests are
+sent to the server as they are and only their apiVersion, kind, and
+metadata.name are read here.
+
+"""
+
+import os
+import re
+import json
+import math
+import base64
+import logging
+import pathlib
+import threading
+import subprocess
+from timeit import default_timer as timer
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+from urllib.parse import quote, urlencode
+from typing import Any, Dict, Iterator, List, Optional, Tuple, Union
+
+import urllib3  # type: ignore
+from tenacity import retry, retry_if_exception, stop_after_attempt, wait_random_exponential
+
+from .util import safe_exec, SafeExecError
+from .gcs import AccessToken, ACCESS_TOKEN_LIFETIME
+from .constants import ELB_K8S_API_MAX_POOL_CONNECTIONS, ELB_K8S_API_PAGE_SIZE
+from .constants import ELB_K8S_FIELD_MANAGER, ELB_K8S_API_CONNECT_TIMEOUT
+from .constants import ELB_K8S_API_WATCH_TIMEOUT, ELB_K8S_API_STREAM_CHUNK_SIZE
+from .constants import ELB_K8S_API_APPLY_THREADS, ELB_K8S_JOB_SUBMISSION_MAX_RETRIES
+
+# Plural resource names and whether the resource is namespaced, by kind
+K8S_RESOURCES = {
+    'Job': ('jobs', True),
+    'CronJob': ('cronjobs', True),
+    'Pod': ('pods', True),
+    'PersistentVolumeClaim': ('persistentvolumeclaims', True),
+    'PersistentVolume': ('persistentvolumes', False),
+    'StorageClass': ('storageclasses', False),
+    'VolumeSnapshot': ('volumesnapshots', True),
+    'VolumeSnapshotClass': ('volumesnapshotclasses', False),
+    'ServiceAccount': ('serviceaccounts', True),
+    'ClusterRoleBinding': ('clusterrolebindings', False),
+}
+
+K8S_DEFAULT_NAMESPACE = 'default'
+
+
+class K8sApiError(SafeExecError):
+    """ Error returned by Kubernetes API server. It is a SafeExecError, so
+    that callers handle it the same way as kubectl errors.
+    Attributes:
+        returncode: HTTP status code
+        message: Error message"""
+    pass
+
+
+def is_transient_error(e: BaseException) -> bool:
+    """ Return True if a Kubernetes API request failed because the server
+    was overloaded or unreachable and may be retried """
+    return isinstance(e, K8sApiError) and (e.returncode == 429 or e.returncode >= 500 or e.returncode < 0)
+
+
+re_doc_separator = re.compile(r'^---\s*$', re.MULTILINE)
+re_top_level = re.compile(r'^(apiVersion|kind):\s*(\S+)', re.MULTILINE)
+re_metadata = re.compile(r'^metadata:[ \t]*\n((?:[ \t]+.*\n?|\s*\n)*)', re.MULTILINE)
+re_metadata_field = re.compile(r'^([ \t]+)(name|namespace):\s*(\S+)', re.MULTILINE)
+
+
+def split_manifests(text: str) -> List[str]:
+    """ Split YAML text into documents, skipping empty ones """
+    docs = []
+    for doc in re_doc_separator.split(text):
+        if any(line.strip() and not line.lstrip().startswith('#') for line in doc.split('\n')):
+            docs.append(doc)
+    return docs
+
+
+def parse_manifest_header(manifest: str) -> Tuple[str, str, str, Optional[str]]:
+    """ Get apiVersion, kind, name, and namespace of an object from its YAML
+    manifest
+
+    Raises:
+        ValueError if the manifest does not have these fields """
+    top = {key: value.strip('\'"') for key, value in re_top_level.findall(manifest)}
+    mo = re_metadata.search(manifest)
+    fields: Dict[str, str] = {}
+    if mo:
+        # only direct children of metadata, not e.g. labels.name
+        indent = None
+        for field_indent, key, value in re_metadata_field.findall(mo.group(1)):
+            if indent is None or len(field_indent) < len(indent):
+                indent = field_indent
+                fields = {}
+            if field_indent == indent:
+                fields.setdefault(key, value.strip('\'"'))
+    if 'apiVersion' not in top or 'kind' not in top or 'name' not in fields:
+        raise ValueError('Kubernetes manifest must have apiVersion, kind, and metadata.name')
+    return top['apiVersion'], top['kind'], fields['name'], fields.get('namespace')
+
+
+def read_manifests(path: pathlib.Path) -> List[str]:
+    """ Read YAML manifests from a file or all files in a directory """
+    files = sorted(path.iterdir()) if path.is_dir() else [path]
+    manifests: List[str] = []
+    for f in files:
+        manifests += split_manifests(f.read_text())
+    return manifests
+
+
+class ExecToken:
+    """ Access token from a kubeconfig exec credential plugin, for example
+    gke-gcloud-auth-plugin, obtained once per its lifetime """
+    def __init__(self, command: str, args: List[str], env: Dict[str, str]):
+        self.cmd = [command] + args
+        self.env = dict(os.environ, **env)
+        self.token = ''
+        self.expires = 0.0
+        self.lock = threading.Lock()
+
+    def get(self, refresh: bool = False) -> str:
+        """ Return a valid access token, fetch a new one if needed """
+        with self.lock:
+            if refresh or not self.token or timer() > self.expires:
+                p = subprocess.run(self.cmd, env=self.env, check=True,
+                                   stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+                status = json.loads(p.stdout.decode())['status']
+                self.token = status['token']
+                lifetime = float(ACCESS_TOKEN_LIFETIME)
+                if 'expirationTimestamp' in status:
+                    expiration = datetime.fromisoformat(status['expirationTimestamp'].replace('Z', '+00:00'))
+                    lifetime = min(lifetime, (expiration - datetime.now(timezone.utc)).total_seconds() - 60)
+                self.expires = timer() + lifetime
+            return self.token
+
+
+class StaticToken:
+    """ Access token given in kubeconfig """
+    def __init__(self, token: str):
+        self.token = token
+
+    def get(self, refresh: bool = False) -> str:
+        return self.token
+
+
+class K8sApiClient:
+    """ Thread-safe client for Kubernetes API. Methods raise K8sApiError on
+    failures. """
+
+    def __init__(self, server: str,
+                 token: Union[None, AccessToken, ExecToken, StaticToken] = None,
+                 ca_data: Optional[str] = None, verify: bool = True,
+                 namespace: str = K8S_DEFAULT_NAMESPACE):
+        """ Parameters:
+                server - Kubernetes API server URL
+                token - access token, None if the server does not require authentication
+                ca_data - PEM encoded certificate of the cluster certificate authority
+                verify - verify server certificate
+                namespace - namespace of namespaced objects
+        """
+        self.server = server.rstrip('/')
+        self.token = token
+        self.namespace = namespace
+        retries = urllib3.Retry(total=3, backoff_factor=0.5,
+                                status_forcelist=[429, 500, 502, 503, 504],
+                                raise_on_status=False)
+        kwargs: Dict[str, Any] = {'maxsize': ELB_K8S_API_MAX_POOL_CONNECTIONS, 'retries': retries}
+        if self.server.startswith('https'):
+            kwargs['cert_reqs'] = 'CERT_REQUIRED' if verify else 'CERT_NONE'
+            if ca_data:
+                kwargs['ca_cert_data'] = ca_data
+        self.http = urllib3.PoolManager(**kwargs)
+
+    def _request(self, method: str, path: str, query: Optional[Dict[str, Any]] = None,
+                 body: Optional[bytes] = None, content_type: str = 'application/json',
+                 accept: str = 'application/json', preload_content: bool = True,
+                 timeout: Optional[float] = None) -> urllib3.HTTPResponse:
+        url = self.server + path + ('?' + urlencode(query) if query else '')
+        attempts = 1 if self.token is None else 2
+        for attempt in range(attempts):
+            headers = {'Accept': accept}
+            if body is not None:
+                headers['Content-Type'] = content_type
+            if self.token:
+                # retry once with a fresh token if it expired early
+                headers['Authorization'] = f'Bearer {self.token.get(refresh=attempt > 0)}'
+            try:
+                resp = self.http.request(method, url, body=body, headers=headers,
+                                         preload_content=preload_content,
+                                         timeout=urllib3.Timeout(connect=ELB_K8S_API_CONNECT_TIMEOUT, read=timeout))
+            except urllib3.exceptions.HTTPError as e:
+                raise K8sApiError(returncode=-1, message=f'{method} {path} failed: {e}')
+            if resp.status != 401:
+                break
+        if resp.status >= 400:
+            message = resp.data.decode(errors='replace') if preload_content else resp.read().decode(errors='replace')
+            try:
+                message = json.loads(message)['message']
+            except (ValueError, KeyError, TypeError):
+                pass
+            raise K8sApiError(returncode=resp.status,
+                              message=f'{method} {path} failed with HTTP status {resp.status}: {message}')
+        return resp
+
+    def _json(self, method: str, path: str, **kwargs) -> Dict[str, Any]:
+        resp = self._request(method, path, **kwargs)
+        return json.loads(resp.data) if resp.data else {}
+
+    def resource_path(self, api_version: str, kind: str, name: Optional[str] = None,
+                      namespace: Optional[str] = None) -> str:
+        """ Get API path of a Kubernetes object or collection """
+        if kind not in K8S_RESOURCES:
+            raise ValueError(f'Unsupported Kubernetes object kind {kind}')
+        plural, namespaced = K8S_RESOURCES[kind]
+        path = '/api/v1' if api_version == 'v1' else f'/apis/{api_version}'
+        if namespaced:
+            path += f'/namespaces/{quote(namespace or self.namespace, safe="")}'
+        path += f'/{plural}'
+        if name:
+            path += f'/{quote(name, safe="")}'
+        return path
+
+    def version(self) -> Dict[str, Any]:
+        """ Get Kubernetes server version """
+        return self._json('GET', '/version')
+
+    def get(self, api_version: str, kind: str, name: str) -> Dict[str, Any]:
+        """ Get a Kubernetes object """
+        return self._json('GET', self.resource_path(api_version, kind, name))
+
+    def list(self, api_version: str, kind: str, label_selector: Optional[str] = None,
+             field_selector: Optional[str] = None) -> Iterator[Dict[str, Any]]:
+        """ List Kubernetes objects selected by labels and fields on the
+        server, page by page """
+        query: Dict[str, Any] = {'limit': ELB_K8S_API_PAGE_SIZE}
+        if label_selector:
+            query['labelSelector'] = label_selector
+        if field_selector:
+            query['fieldSelector'] = field_selector
+        path = self.resource_path(api_version, kind)
+        while True:
+            page = self._json('GET', path, query=query)
+            for item in page.get('items') or []:
+                yield item
+            token = page.get('metadata', {}).get('continue')
+            if not token:
+                break
+            query['continue'] = token
+
+    def watch(self, api_version: str, kind: str, name: str,
+              timeout: Optional[float] = None) -> Iterator[Dict[str, Any]]:
+        """ Yield the current state of a Kubernetes object, if it exists, and
+        then its every new state as soon as the server reports a change, until
+        timeout seconds pass
+
+        Parameters:
+            api_version, kind, name - identify the object
+            timeout - time limit in seconds, None for no limit
+        """
+        deadline = None if timeout is None else timer() + timeout
+        path = self.resource_path(api_version, kind)
+        selector = f'metadata.name={name}'
+        resource_version = None
+        while deadline is None or timer() < deadline:
+            if resource_version is None:
+                listing = self._json('GET', path, query={'fieldSelector': selector})
+                for item in listing.get('items') or []:
+                    yield item
+                resource_version = listing.get('metadata', {}).get('resourceVersion', '')
+                continue
+            # the server ends each watch after timeoutSeconds, then it is
+            # resumed from the last seen resource version
+            remaining = ELB_K8S_API_WATCH_TIMEOUT if deadline is None else max(1, math.ceil(deadline - timer()))
+            remaining = min(remaining, ELB_K8S_API_WATCH_TIMEOUT)
+            query = {'watch': 'true', 'fieldSelector': selector, 'timeoutSeconds': remaining,
+                     'allowWatchBookmarks': 'true', 'resourceVersion': resource_version}
+            resp = self._request('GET', path, query=query, preload_content=False,
+                                 timeout=remaining + ELB_K8S_API_CONNECT_TIMEOUT)
+            try:
+                for event in _read_json_lines(resp):
+                    obj = event.get('object', {})
+                    if event.get('type') == 'ERROR':
+                        # events since resource version are gone, list again
+                        logging.debug(f'Watch of {kind} {name} restarted: {obj.get("message")}')
+                        resource_version = None
+                        break
+                    resource_version = obj.get('metadata', {}).get('resourceVersion', resource_version)
+                    if event.get('type') in ['ADDED', 'MODIFIED']:
+                        yield obj
+                    if deadline is not None and timer() >= deadline:
+                        break
+            except urllib3.exceptions.HTTPError as e:
+                logging.debug(f'Watch of {kind} {name} interrupted: {e}')
+            finally:
+                resp.release_conn()
+
+    def watch_file(self, path: pathlib.Path, timeout: Optional[float] = None) -> Iterator[Dict[str, Any]]:
+        """ Watch the Kubernetes object described by the first manifest in a
+        file, see watch """
+        api_version, kind, name, _ = parse_manifest_header(read_manifests(path)[0])
+        return self.watch(api_version, kind, name, timeout)
+
+    def apply(self, manifest: str) -> Dict[str, Any]:
+        """ Create or update a Kubernetes object from its YAML manifest with
+        server-side apply """
+        api_version, kind, name, namespace = parse_manifest_header(manifest)
+        return self._json('PATCH', self.resource_path(api_version, kind, name, namespace),
+                          query={'fieldManager': ELB_K8S_FIELD_MANAGER, 'force': 'true'},
+                          body=manifest.encode(), content_type='application/apply-patch+yaml')
+
+    @retry(retry=retry_if_exception(is_transient_error), reraise=True,
+           stop=stop_after_attempt(ELB_K8S_JOB_SUBMISSION_MAX_RETRIES),
+           wait=wait_random_exponential(multiplier=0.5, max=10))
+    def apply_with_retries(self, manifest: str) -> Dict[str, Any]:
+        """ Apply a YAML manifest, retry if the server is overloaded or
+        unreachable. Server-side apply is idempotent, so a retry is safe even
+        if the failed request took effect. """
+        return self.apply(manifest)
+
+    def apply_file(self, path: pathlib.Path) -> List[Dict[str, Any]]:
+        """ Apply all YAML manifests in a file or directory, up to
+        ELB_K8S_API_APPLY_THREADS at a time
+
+        Returns:
+            Applied objects in the order of manifests """
+        manifests = read_manifests(path)
+        if len(manifests) < 2:
+            return [self.apply_with_retries(manifest) for manifest in manifests]
+        with ThreadPoolExecutor(max_workers=min(ELB_K8S_API_APPLY_THREADS, len(manifests))) as executor:
+            return list(executor.map(self.apply_with_retries, manifests))
+
+    def get_file(self, path: pathlib.Path) -> Dict[str, Any]:
+        """ Get the Kubernetes object described by the first manifest in a
+        file """
+        api_version, kind, name, namespace = parse_manifest_header(read_manifests(path)[0])
+        return self._json('GET', self.resource_path(api_version, kind, name, namespace))
+
+    def patch(self, api_version: str, kind: str, name: str, patch: Dict[str, Any]) -> Dict[str, Any]:
+        """ Update a Kubernetes object with a JSON merge patch """
+        return self._json('PATCH', self.resource_path(api_version, kind, name),
+                          body=json.dumps(patch).encode(),
+                          content_type='application/merge-patch+json')
+
+    def delete(self, api_version: str, kind: str, name: str, ignore_not_found: bool = True) -> bool:
+        """ Delete a Kubernetes object and objects it owns
+
+        Returns:
+            True if the object was deleted
+        """
+        try:
+            self._request('DELETE', self.resource_path(api_version, kind, name),
+                          query={'propagationPolicy': 'Background'})
+        except K8sApiError as err:
+            if ignore_not_found and err.returncode == 404:
+                return False
+            raise
+        return True
+
+    def delete_collection(self, api_version: str, kind: str,
+                          label_selector: Optional[str] = None) -> List[str]:
+        """ Delete Kubernetes objects selected by labels, or all objects of
+        a kind, and objects they own
+
+        Returns:
+            Names of deleted objects
+        """
+        names = [item['metadata']['name'] for item in self.list(api_version, kind, label_selector)]
+        query = {'propagationPolicy': 'Background'}
+        if label_selector:
+            query['labelSelector'] = label_selector
+        if names:
+            self._request('DELETE', self.resource_path(api_version, kind), query=query)
+        return names
+
+    def logs(self, pod: str, container: str, since_seconds: Optional[int] = None,
+             timestamps: bool = False) -> str:
+        """ Get logs of a container in a pod """
+        query: Dict[str, Any] = {'container': container}
+        if since_seconds is not None:
+            query['sinceSeconds'] = since_seconds
+        if timestamps:
+            query['timestamps'] = 'true'
+        resp = self._request('GET', self.resource_path('v1', 'Pod', pod) + '/log',
+                             query=query, accept='text/plain')
+        return resp.data.decode(errors='replace')
+
+
+def _read_json_lines(resp: urllib3.HTTPResponse) -> Iterator[Dict[str, Any]]:
+    """ Parse a stream of newline delimited JSON objects as they arrive """
+    buf = b''
+    for chunk in resp.stream(ELB_K8S_API_STREAM_CHUNK_SIZE):
+        buf += chunk
+        *lines, buf = buf.split(b'\n')
+        for line in lines:
+            if line.strip():
+                yield json.loads(line)
+    if buf.strip():
+        yield json.loads(buf)
+
+
+def _load_kubeconfig(k8s_ctx: str) -> Dict[str, Any]:
+    """ Get cluster and user entries of a kubeconfig context with embedded
+    credentials """
+    cmd = f'kubectl config view --raw --minify --flatten -o json --context={k8s_ctx}'
+    return json.loads(safe_exec(cmd).stdout.decode())
+
+
+def _client_from_kubeconfig(config: Dict[str, Any]) -> K8sApiClient:
+    """ Create Kubernetes API client from kubeconfig
+
+    Raises:
+        NotImplementedError for unsupported authentication methods """
+    cluster = config['clusters'][0]['cluster']
+    user = config['users'][0].get('user', {})
+    namespace = config.get('contexts', [{}])[0].get('context', {}).get('namespace', K8S_DEFAULT_NAMESPACE)
+    token: Union[None, AccessToken, ExecToken, StaticToken] = None
+    if 'token' in user:
+        token = StaticToken(user['token'])
+    elif 'exec' in user:
+        env = {e['name']: e['value'] for e in user['exec'].get('env') or []}
+        token = ExecToken(user['exec']['command'], user['exec'].get('args') or [], env)
+    elif user.get('auth-provider', {}).get('name') == 'gcp':
+        token = AccessToken()
+    elif user:
+        raise NotImplementedError(f'Unsupported Kubernetes authentication method: {", ".join(user.keys())}')
+    if token:
+        token.get()
+    ca_data = None
+    if 'certificate-authority-data' in cluster:
+        ca_data = base64.b64decode(cluster['certificate-authority-data']).decode()
+    return K8sApiClient(cluster['server'], token, ca_data,
+                        verify=not cluster.get('insecure-skip-tls-verify', False),
+                        namespace=namespace)
+
+
+_k8s_clients: Dict[str, Optional[K8sApiClient]] = {}
+_k8s_clients_lock = threading.Lock()
+
+
+def use_k8s_api() -> bool:
+    """ Is the in-process Kubernetes API client requested """
+    return 'ELB_USE_K8S_API' in os.environ
+
+
+def get_k8s_client(k8s_ctx: str) -> Optional[K8sApiClient]:
+    """ Get the Kubernetes API client for a context, shared by the process.
+    Returns None if the in-process client is not requested or not available,
+    in which case kubectl should be used.
+    """
+    if not use_k8s_api():
+        return None
+    with _k8s_clients_lock:
+        if k8s_ctx not in _k8s_clients:
+            client = None
+            try:
+                client = _client_from_kubeconfig(_load_kubeconfig(k8s_ctx))
+                logging.debug(f'Using Kubernetes API server {client.server} for context {k8s_ctx}')
+            except (SafeExecError, KeyError, IndexError, ValueError, NotImplementedError,
+                    OSError, subprocess.CalledProcessError) as e:
+                logging.debug(f'In-process Kubernetes API client is not available, using kubectl: {e}')
+            _k8s_clients[k8s_ctx] = client
+        return _k8s_clients[k8s_ctx]
+
+
+def clear_k8s_clients() -> None:
+    """ Forget the shared Kubernetes API clients, so that the next
+    get_k8s_client call re-reads kubeconfig """
+    with _k8s_clients_lock:
+        _k8s_clients.clear()
@@ -24,6 +24,7 @@ Help functions to access and manipulate Kubernetes clusters
 """
 
 import os
+import re
 import json
 import logging
 import pathlib
@@ -32,7 +33,8 @@ from tenacity import retry, stop_after_delay, stop_after_attempt, wait_random
 from timeit import default_timer as timer
 from pkg_resources import resource_string, resource_filename, set_extraction_path
 from tempfile import TemporaryDirectory
-from typing import List, Optional
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, Iterator, List, Optional, Tuple
 
 from .util import safe_exec, gcp_get_blastdb_latest_path, ElbSupportedPrograms, SafeExecError
 from .util import get_blastdb_info, UserReportError
@@ -44,6 +46,7 @@ from .constants import ELB_K8S_JOB_SUBMISSION_MAX_WAIT
 from .constants import ELB_K8S_JOB_SUBMISSION_MIN_WAIT
 from .constants import ELB_K8S_JOB_SUBMISSION_MAX_RETRIES
 from .constants import ELB_K8S_JOB_SUBMISSION_TIMEOUT, ELB_METADATA_DIR
+from .constants import ELB_K8S_JOB_SUBMISSION_CHUNK_SIZE, ELB_K8S_JOB_SUBMISSION_THREADS
 from .constants import K8S_MAX_JOBS_PER_DIR, ELB_STATE_DISK_ID_FILE, ELB_QUERY_BATCH_DIR
 from .constants import ELB_CJS_DOCKER_IMAGE_GCP
 from .constants import ElbExecutionMode, ELB_JANITOR_SCHEDULE
@@ -51,6 +54,7 @@ from .constants import ELB_DFLT_JANITOR_SCHEDULE_GCP, PERMISSIONS_ERROR, DEPENDE
 from .constants import CLUSTER_ERROR
 from .filehelper import open_for_write_immediate
 from .elb_config import ElasticBlastConfig
+from . import k8s_api
 
 
 def get_maximum_number_of_allowed_k8s_jobs(dry_run: bool = False) -> int:
@@ -88,6 +92,9 @@ def get_persistent_volumes(k8s_ctx: str) -> List[str]:
     Raises:
         util.SafeExecError on problems communicating with the cluster
         RuntimeError when kubectl result cannot be parsed"""
+    client = k8s_api.get_k8s_client(k8s_ctx)
+    if client:
+        return [i['metadata']['name'] for i in client.list('v1', 'PersistentVolume')]
     cmd = f'kubectl --context={k8s_ctx} get pv -o json'
     p = safe_exec(cmd)
     try:
@@ -110,6 +117,9 @@ def get_persistent_disks(k8s_ctx: str, dry_run: bool = False) -> List[str]:
     if dry_run:
         logging.info(cmd)
     else:
+        client = k8s_api.get_k8s_client(k8s_ctx)
+        if client:
+            return [i['spec']['csi']['volumeHandle'].split('/')[-1] for i in client.list('v1', 'PersistentVolume')]
         p = safe_exec(cmd)
         if p.stdout:
             pds = json.loads(p.stdout.decode())
@@ -139,19 +149,21 @@ def submit_jobs(k8s_ctx: str, path: pathlib.Path, dry_run=False) -> List[str]:
     retval = list()
     if not path.exists():
         raise RuntimeError(f'Path with kubernetes jobs "{path}" does not exist')
+    client = None if dry_run else k8s_api.get_k8s_client(k8s_ctx)
     if path.is_dir():
         num_files = len(os.listdir(str(path)))
         if num_files == 0 and not dry_run:
             raise RuntimeError(f'Job directory {str(path)} is empty')
-        elif num_files > K8S_MAX_JOBS_PER_DIR:
-            files = os.listdir(str(path))
-            for i, f in enumerate(sorted(files, key=lambda x: int(os.path.splitext(x)[0].split('_')[1]))):
-                retval += submit_jobs_with_retries(k8s_ctx, pathlib.Path(os.path.join(path, f)), dry_run)
-                perc_done = i / num_files * 100.
-                if i % 50 == 0:
-                    logging.debug(f'Submitted job file # {i} of {num_files} {perc_done:.2f}% done')
-            return retval
-
+    if not client:
+        files = sorted(path.iterdir(), key=_job_file_order) if path.is_dir() else [path]
+        manifests = []
+        for f in files:
+            manifests += k8s_api.split_manifests(f.read_text())
+        if len(manifests) > K8S_MAX_JOBS_PER_DIR:
+            return _submit_jobs_in_chunks(k8s_ctx, manifests, dry_run)
+
+    if client:
+        return [obj['metadata']['name'] for obj in client.apply_file(path)]
     cmd = f'kubectl --context={k8s_ctx} apply -f {path} -o json'
     if dry_run:
         logging.info(cmd)
@@ -166,6 +178,56 @@ def submit_jobs(k8s_ctx: str, path: pathlib.Path, dry_run=False) -> List[str]:
     return retval
 
 
+def _job_file_order(path: pathlib.Path) -> Tuple[int, str]:
+    """ Sort key for job files, so that batch_1000.yaml comes after
+    batch_999.yaml """
+    mo = re.search(r'([0-9]+)$', path.stem)
+    return (int(mo.group(1)) if mo else -1, path.name)
+
+
+def _submit_jobs_in_chunks(k8s_ctx: str, manifests: List[str], dry_run: bool = False) -> List[str]:
+    """Submit kubernetes jobs with one kubectl apply call per
+    ELB_K8S_JOB_SUBMISSION_CHUNK_SIZE job manifests, running
+    ELB_K8S_JOB_SUBMISSION_THREADS calls at a time. Only the chunks that
+    failed are retried.
+
+    Arguments:
+        k8s_ctx: The kubernetes context to which the jobs should be submitted
+        manifests: YAML manifests of jobs
+
+    Returns:
+        A list of submitted job names, in the order of manifests
+
+    Raises:
+        util.SafeExecError if submission of a chunk failed after retries"""
+    chunks = [manifests[i:i+ELB_K8S_JOB_SUBMISSION_CHUNK_SIZE]
+              for i in range(0, len(manifests), ELB_K8S_JOB_SUBMISSION_CHUNK_SIZE)]
+    num_chunks = len(chunks)
+
+    def submit_chunk(chunk_path: pathlib.Path, num_jobs: int) -> List[str]:
+        start = timer()
+        names = submit_jobs_with_retries(k8s_ctx, chunk_path, dry_run)
+        end = timer()
+        if end > start:
+            logging.debug(f'SPEED to submit-jobs {num_jobs/(end-start):.2f} jobs/second, chunk {chunk_path.stem}')
+        return names
+
+    retval: List[str] = []
+    with TemporaryDirectory() as chunk_dir:
+        chunk_paths = []
+        for i, chunk in enumerate(chunks):
+            chunk_path = pathlib.Path(chunk_dir, f'chunk_{i:05d}.yaml')
+            chunk_path.write_text(''.join('---\n' + doc.strip('\n') + '\n' for doc in chunk))
+            chunk_paths.append(chunk_path)
+        with ThreadPoolExecutor(max_workers=ELB_K8S_JOB_SUBMISSION_THREADS) as executor:
+            futures = [executor.submit(submit_chunk, p, len(chunk)) for p, chunk in zip(chunk_paths, chunks)]
+            for i, future in enumerate(futures):
+                retval += future.result()
+                if i % 10 == 0:
+                    logging.debug(f'Submitted job chunk # {i} of {num_chunks} {i / num_chunks * 100.:.2f}% done')
+    return retval
+
+
 def delete_all(k8s_ctx: str, dry_run: bool = False) -> List[str]:
     """Delete all kubernetes jobs, persistent volume claims, and persistent volumes.
 
@@ -177,6 +239,10 @@ def delete_all(k8s_ctx: str, dry_run: bool = False) -> List[str]:
 
     Raises:
         util.SafeExecError on problems with command line kubectl"""
+    client = None if dry_run else k8s_api.get_k8s_client(k8s_ctx)
+    if client:
+        return _delete_all_with_api(client)
+
     commands1 = [f'kubectl --context={k8s_ctx} delete jobs --ignore-not-found=true -l app=setup',
                 f'kubectl --context={k8s_ctx} delete jobs --ignore-not-found=true -l app=blast']
     commands2 = [f'kubectl --context={k8s_ctx} delete pvc --all --force=true',
@@ -248,6 +314,46 @@ def delete_all(k8s_ctx: str, dry_run: bool = False) -> List[str]:
     return deleted1 + deleted2
 
 
+def _delete_all_with_api(client: k8s_api.K8sApiClient) -> List[str]:
+    """ Delete all kubernetes jobs, persistent volume claims, persistent
+    volumes, and volume snapshots with Kubernetes API client.
+
+    Returns:
+        A list of deleted kubernetes objects """
+    # Delete the jobs first, wait, then delete the pvc and  pv
+    deleted = client.delete_collection('batch/v1', 'Job', 'app=setup')
+    deleted += client.delete_collection('batch/v1', 'Job', 'app=blast')
+    secs2sleep = int(os.getenv('ELB_PAUSE_AFTER_INIT_PV', str(ELB_PAUSE_AFTER_INIT_PV)))
+    time.sleep(secs2sleep)
+    # Delete finalizers to ensure PV and PVC get deleted
+    for kind in ['PersistentVolume', 'PersistentVolumeClaim']:
+        for obj in client.list('v1', kind):
+            name = obj['metadata']['name']
+            logging.debug(f'{kind} {name} Status: {obj.get("status", {}).get("phase")} '
+                          f'Finalizers: {obj["metadata"].get("finalizers")}')
+            try:
+                client.patch('v1', kind, name, {'metadata': {'finalizers': None}})
+            except k8s_api.K8sApiError as err:
+                if err.returncode != 404:
+                    raise
+    deleted += client.delete_collection('v1', 'PersistentVolumeClaim')
+    deleted += client.delete_collection('v1', 'PersistentVolume')
+    deleted += _delete_volume_snapshots_with_api(client)
+    return deleted
+
+
+def _delete_volume_snapshots_with_api(client: k8s_api.K8sApiClient) -> List[str]:
+    """ Delete all volume snapshots with Kubernetes API client, returns
+    names of deleted snapshots """
+    try:
+        return client.delete_collection('snapshot.storage.k8s.io/v1', 'VolumeSnapshot')
+    except k8s_api.K8sApiError as err:
+        # volume snapshot resource is not installed in the cluster
+        if err.returncode != 404:
+            raise
+    return []
+
+
 def delete_volume_snapshots(k8s_ctx: str, dry_run: bool = False):
     """Delete all volume snapshots associated with the kubernetes cluster"""
     # We are not using --force=true here to do a graceful deletion. Volume
@@ -258,6 +364,10 @@ def delete_volume_snapshots(k8s_ctx: str, dry_run: bool = False):
     if dry_run:
         logging.info(cmd)
         return
+    client = k8s_api.get_k8s_client(k8s_ctx)
+    if client:
+        _delete_volume_snapshots_with_api(client)
+        return
     safe_exec(cmd)
 
 
@@ -279,6 +389,9 @@ def get_jobs(k8s_ctx: str, selector: Optional[str] = None, dry_run: bool = False
         logging.info(cmd)
         return list()
 
+    client = k8s_api.get_k8s_client(k8s_ctx)
+    if client:
+        return [i['metadata']['name'] for i in client.list('batch/v1', 'Job', label_selector=selector)]
     p = safe_exec(cmd)
     if not p.stdout:
         # a small JSON structure is always returned, even if there are no jobs
@@ -287,9 +400,33 @@ def get_jobs(k8s_ctx: str, selector: Optional[str] = None, dry_run: bool = False
     return [i['metadata']['name'] for i in out['items']]
 
 
+def _watch_until(objects: Iterator[Dict[str, Any]], done: Callable[[Dict[str, Any]], bool]) -> bool:
+    """ Follow the states of a Kubernetes object reported by K8sApiClient.watch
+    until done returns True for one of them.
+    Returns:
+        True if done returned True, False if the watch timed out"""
+    start = timer()
+    for obj in objects:
+        if done(obj):
+            end = timer()
+            logging.debug(f'RUNTIME wait for {obj["metadata"]["name"]} {end-start:.2f} seconds')
+            return True
+    return False
+
+
 def _wait_for_job(k8s_ctx: str, job_file: pathlib.Path, attempts: int = 30, secs2wait: int = 60, dry_run: bool = False) -> None:
     """ Wait for the job to return successfully or raise a TimeoutError after specified number of attempts """
 
+    client = None if dry_run else k8s_api.get_k8s_client(k8s_ctx)
+    if client:
+        if not job_file.exists():
+            raise FileNotFoundError(str(job_file))
+        # returns as soon as the job finishes, with the same overall time limit
+        if not _watch_until(client.watch_file(job_file, attempts * secs2wait),
+                            lambda job: _job_status_succeeded(job, job_file)):
+            raise TimeoutError(f'{job_file} timed out')
+        return
+
     for counter in range(attempts):
         if _job_succeeded(k8s_ctx, job_file, dry_run):
             break
@@ -312,15 +449,24 @@ def _job_succeeded(k8s_ctx: str, k8s_job_file: pathlib.Path, dry_run: bool = Fal
         logging.info(cmd)
         return True
 
-    p = safe_exec(cmd)
-    if not p.stdout:
-        return False
+    client = k8s_api.get_k8s_client(k8s_ctx)
+    if client:
+        json_output = client.get_file(k8s_job_file)
+    else:
+        p = safe_exec(cmd)
+        if not p.stdout:
+            return False
+        json_output = json.loads(p.stdout.decode())
+
+    return _job_status_succeeded(json_output, k8s_job_file)
 
-    retval = 0
-    if not p.stdout:
-        return False
 
-    json_output = json.loads(p.stdout.decode())
+def _job_status_succeeded(json_output: Dict[str, Any], k8s_job_file: pathlib.Path) -> bool:
+    """ Checks whether a job described by Kubernetes API object has succeeded.
+    Returns true if the job succeeded, false otherwise.
+    If the job failed, a RuntimeError is raised.
+    """
+    retval = 0
     if 'status' not in json_output:
         return False
 
@@ -353,6 +499,13 @@ def _ensure_successful_job(k8s_ctx: str, k8s_job_file: pathlib.Path, dry_run: bo
         logging.info(cmd)
         return
 
+    client = k8s_api.get_k8s_client(k8s_ctx)
+    if client:
+        status = client.get_file(k8s_job_file)['status'].get('succeeded', 0)
+        if int(status) != 1:
+            raise RuntimeError(f'{k8s_job_file} failed')
+        return
+
     p = safe_exec(cmd)
     status = json.loads(p.stdout.decode())['status']['succeeded']
     if int(status) != 1:
@@ -377,11 +530,21 @@ def _snapshot_ready(k8s_ctx: str, k8s_spec_file: pathlib.Path, dry_run: bool = F
         logging.info(cmd)
         return True
 
-    p = safe_exec(cmd)
-    if not p.stdout:
-        return False
+    client = k8s_api.get_k8s_client(k8s_ctx)
+    if client:
+        json_output = client.get_file(k8s_spec_file)
+    else:
+        p = safe_exec(cmd)
+        if not p.stdout:
+            return False
+        json_output = json.loads(p.stdout.decode())
 
-    json_output = json.loads(p.stdout.decode())
+    return _snapshot_status_ready(json_output)
+
+
+def _snapshot_status_ready(json_output: Dict[str, Any]) -> bool:
+    """ Check whether a volume snapshot described by Kubernetes API object is
+    ready """
     if 'status' not in json_output or 'readyToUse' not in json_output['status']:
         return False
 
@@ -400,6 +563,15 @@ def _wait_for_snapshot(k8s_ctx: str, spec_file: pathlib.Path, attempts: int = 30
         attempts: Numnber of attempts
         secs2wait: Time between attempts
         dry_run: Dry run if true"""
+    client = None if dry_run else k8s_api.get_k8s_client(k8s_ctx)
+    if client:
+        if not spec_file.exists():
+            raise FileNotFoundError(str(spec_file))
+        if not _watch_until(client.watch_file(spec_file, attempts * secs2wait),
+                            _snapshot_status_ready):
+            raise TimeoutError(f'{spec_file} timed out')
+        return
+
     for counter in range(attempts):
         if _snapshot_ready(k8s_ctx, spec_file, dry_run):
             break
@@ -424,11 +596,21 @@ def _pvc_bound(k8s_ctx: str, pvc_name: str, dry_run: bool = False) -> bool:
         logging.info(cmd)
         return True
 
-    p = safe_exec(cmd)
-    if not p.stdout:
-        return False
+    client = k8s_api.get_k8s_client(k8s_ctx)
+    if client:
+        json_output = client.get('v1', 'PersistentVolumeClaim', pvc_name)
+    else:
+        p = safe_exec(cmd)
+        if not p.stdout:
+            return False
+        json_output = json.loads(p.stdout.decode())
 
-    json_output = json.loads(p.stdout.decode())
+    return _pvc_status_bound(json_output, pvc_name)
+
+
+def _pvc_status_bound(json_output: Dict[str, Any], pvc_name: str) -> bool:
+    """ Check whether a persistent volume claim described by Kubernetes API
+    object is bound """
     if 'status' not in json_output or 'phase' not in json_output['status']:
         return False
 
@@ -439,6 +621,13 @@ def _pvc_bound(k8s_ctx: str, pvc_name: str, dry_run: bool = False) -> bool:
 def wait_for_pvc(k8s_ctx: str, pvc_name: str, attempts: int = 30, secs2wait: int = 20, dry_run: bool = False) -> None:
     """Wait for the persistent volume claim to be bound to an instance. A bound
     PVC means that a persistent disk has been created."""
+    client = None if dry_run else k8s_api.get_k8s_client(k8s_ctx)
+    if client:
+        if not _watch_until(client.watch('v1', 'PersistentVolumeClaim', pvc_name, attempts * secs2wait),
+                            lambda pvc: _pvc_status_bound(pvc, pvc_name)):
+            raise TimeoutError(f'Waiting for PVC {pvc_name} timed out')
+        return
+
     for counter in range(attempts):
         if _pvc_bound(k8s_ctx, pvc_name, dry_run):
             break
@@ -812,7 +1001,11 @@ def check_server(k8s_ctx: str, dry_run: bool = False):
     if dry_run:
         logging.info(cmd)
     else:
-        safe_exec(cmd)
+        client = k8s_api.get_k8s_client(k8s_ctx)
+        if client:
+            client.version()
+        else:
+            safe_exec(cmd)
 
 
 def get_logs(k8s_ctx: str, label: str, containers: List[str], dry_run: bool = False):
@@ -822,6 +1015,8 @@ def get_logs(k8s_ctx: str, label: str, containers: List[str], dry_run: bool = Fa
         containers - list of Kubernetes containers to get logs from
         dry_run - report command only, don't execute it.
     """
+    client = None if dry_run else k8s_api.get_k8s_client(k8s_ctx)
+    pods = list(client.list('v1', 'Pod', label_selector=label)) if client else []
     for c in containers:
         cmd = f'kubectl --context={k8s_ctx} logs -l {label} -c {c} --timestamps --since=24h --tail=-1'
         if dry_run:
@@ -832,7 +1027,10 @@ def get_logs(k8s_ctx: str, label: str, containers: List[str], dry_run: bool = Fa
                 #  We can't combine it into one try-except-finally, because safe_exec should report
                 #  the command used in DEBUG level using old format with timestamps. New bare format
                 #  is used only after successful invocation of kubectl logs.
-                proc = safe_exec(cmd)
+                if client:
+                    output = _get_container_logs(client, pods, c)
+                else:
+                    output = safe_exec(cmd).stdout.decode()
                 try:
                     # Temporarily modify format for logging because we import true timestamps
                     # from Kubernetes and don't need logging timestamps, so we just copy logs
@@ -840,7 +1038,7 @@ def get_logs(k8s_ctx: str, label: str, containers: List[str], dry_run: bool = Fa
                     root_logger = logging.getLogger()
                     orig_formatter = root_logger.handlers[0].formatter
                     root_logger.handlers[0].setFormatter(logging.Formatter(fmt='%(message)s'))
-                    for line in proc.stdout.decode().split('\n'):
+                    for line in output.split('\n'):
                         if line:
                             logging.info(line)
                 finally:
@@ -853,6 +1051,23 @@ def get_logs(k8s_ctx: str, label: str, containers: List[str], dry_run: bool = Fa
                 pass
 
 
+def _get_container_logs(client: k8s_api.K8sApiClient, pods: List[dict], container: str) -> str:
+    """ Get logs from the last 24 hours of a container in all pods that
+    have it, with timestamps """
+    output = ''
+    for pod in pods:
+        spec = pod.get('spec', {})
+        if container not in [c['name'] for c in spec.get('containers', []) + spec.get('initContainers', [])]:
+            continue
+        try:
+            output += client.logs(pod['metadata']['name'], container,
+                                  since_seconds=24 * 3600, timestamps=True)
+        except k8s_api.K8sApiError as err:
+            # container may not have started or pod may be gone
+            logging.debug(err.message)
+    return output
+
+
 def collect_k8s_logs(cfg: ElasticBlastConfig):
     """ Collect logs from Kubernetes logs for several label/container combinations.
       Parameters:
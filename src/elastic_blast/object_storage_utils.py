@@ -31,6 +31,7 @@ import os
 import errno
 from pathlib import Path
 from .filehelper import parse_bucket_name_key
+from .aws_traits import get_boto_resource
 
 
 def write_to_s3(dest: str, contents: str, boto_cfg: Config = None, dry_run: bool = False) -> None:
@@ -45,7 +46,7 @@ def write_to_s3(dest: str, contents: str, boto_cfg: Config = None, dry_run: bool
     if dry_run: 
         logging.debug(f'Would have written "{contents}" to {dest}')
         return
-    s3 = boto3.resource('s3') if boto_cfg == None else boto3.resource('s3', config=boto_cfg)
+    s3 = get_boto_resource('s3', boto_cfg)
     bucket_name, key = parse_bucket_name_key(dest)
     bucket = s3.Bucket(bucket_name)
     bucket.put_object(Body=contents.encode(), Key=key)
@@ -63,7 +64,7 @@ def copy_file_to_s3(dest: str, file_object: Path, boto_cfg: Config = None, dry_r
     if dry_run: 
         logging.debug(f'Would have copied "{file_object.resolve()}" to {dest}')
         return
-    s3 = boto3.resource('s3') if boto_cfg == None else boto3.resource('s3', config=boto_cfg)
+    s3 = get_boto_resource('s3', boto_cfg)
     bucket_name, key = parse_bucket_name_key(dest)
     bucket = s3.Bucket(bucket_name)
     bucket.upload_file(Filename=str(file_object.resolve()), Key=key)
@@ -82,7 +83,7 @@ def delete_from_s3(object_name: str, boto_cfg: Config = None, dry_run: bool = Fa
         logging.debug(f'dry-run: would have removed {bname}/{prefix}')
         return
 
-    s3 = boto3.resource('s3') if boto_cfg == None else boto3.resource('s3', config=boto_cfg)
+    s3 = get_boto_resource('s3', boto_cfg)
     s3_bucket = s3.Bucket(bname)
     s3_bucket.objects.filter(Prefix=prefix).delete()
     return
@@ -97,7 +98,7 @@ def download_from_s3(object_name: str, local_file: Path, boto_cfg: Config = None
     if dry_run: 
         logging.debug(f'Would have saved "{object_name}" to "{str(local_file)}"')
         return
-    s3 = boto3.resource('s3') if boto_cfg == None else boto3.resource('s3', config=boto_cfg)
+    s3 = get_boto_resource('s3', boto_cfg)
     bname, prefix = parse_bucket_name_key(object_name)
     # https://boto3.amazonaws.com/v1/documentation/api/1.9.42/guide/s3-example-download-file.html
     try:
@@ -29,31 +29,206 @@ Author: Victor Joukov joukovv@ncbi.nlm.nih.gov
 import os
 import io
 import logging
+import heapq
+import tempfile
+from abc import ABCMeta, abstractmethod
+from array import array
+from itertools import islice
 from timeit import default_timer as timer
 from .filehelper import open_for_write, get_error
-from typing import Union, List, Iterable, TextIO, Tuple
+from typing import Callable, Union, List, Iterable, Iterator, IO, TextIO, BinaryIO, Tuple, Optional, NamedTuple, Sequence
 from .constants import ELB_QUERY_BATCH_FILE_PREFIX
 
+# Size of blocks the input is read in, in bytes
+FASTA_BLOCK_SIZE = 4 * 1024 * 1024
+# Number of lines joined into a block for streams that can only be read by lines
+FASTA_BLOCK_LINES = 65536
+NEWLINE = ord('\n')
+
+# Query input: text or binary streams, including read ahead binary streams
+# from filehelper.open_for_read_parallel
+QueryStream = Union[IO, io.RawIOBase]
+
+
+class QueryBatch(NamedTuple):
+    """Query batch written to a file:
+        name: batch file name
+        residues: number of bases/residues in the batch
+        sequences: number of sequences in the batch"""
+    name: str
+    residues: int
+    sequences: int
+
+
 def make_full_name(out_path, nchunk, suffix):
     """ Generate full name for chunk in a uniform manner """
     return os.path.join(out_path, f'{ELB_QUERY_BATCH_FILE_PREFIX}{nchunk:03d}.{suffix}')
 
 
 def write_chunk(out_path, nchunk, buffer) -> str:
-    """ Write buffer into a batch file, return file name """
+    """ Write buffer (list of bytes-like objects) into a batch file,
+    return file name """
     full_name = make_full_name(out_path, nchunk, 'fa')
     with open_for_write(full_name) as outf:
-        outf.write(''.join(buffer))
+        outf.write(b''.join(buffer).decode())
     return full_name
 
 
-class FASTAReader():
+def read_blocks(f, block_size: Optional[int] = None) -> Iterator[bytes]:
+    """ Read a stream in blocks of bytes.
+    Binary streams and text streams backed by a binary buffer are read
+    directly with line endings translated the same way text mode does.
+    Other text streams (e.g. archive readers or StringIO) are read by lines,
+    which are joined and encoded.
+    """
+    if not block_size:
+        block_size = FASTA_BLOCK_SIZE
+    raw: Union[BinaryIO, io.RawIOBase, io.BufferedIOBase, None] = None
+    if isinstance(f, io.TextIOWrapper):
+        raw = f.buffer
+    elif isinstance(f, (io.RawIOBase, io.BufferedIOBase)):
+        raw = f
+    if raw is None:
+        it = iter(f)
+        while True:
+            lines = list(islice(it, FASTA_BLOCK_LINES))
+            if not lines:
+                break
+            yield ''.join(lines).encode()
+        return
+    while True:
+        block = raw.read(block_size)
+        if not block:
+            break
+        if b'\r' in block:
+            # do not split '\r\n' between blocks
+            if block.endswith(b'\r'):
+                block += raw.read(1) or b''
+            block = block.replace(b'\r\n', b'\n').replace(b'\r', b'\n')
+        yield block
+
+
+class FASTAScanner(metaclass=ABCMeta):
+    """ Base class for byte-oriented FASTA parsing. Input is read in large
+    blocks, sequence boundaries are found with bytes.find, and bases/residues
+    are counted per sequence without creating objects for each line.
+    Subclasses receive sequence boundaries as positions in the current block
+    through process_new_sequence, and the block itself through
+    process_block_end once it is scanned.
+    """
+    def __init__(self, f: Union[Iterable[QueryStream], QueryStream]):
+        """Initialize an object
+        Arguments:
+            f: Open file handle or stream or an Iterable of open file handles
+               or streams.
+        """
+        self.file: Union[Iterable[QueryStream], QueryStream]
+        if isinstance(f, io.IOBase):
+            self.file = [f]
+        else:
+            self.file = f
+        self.view = memoryview(b'') # current block
+        self.seq_count = 0 # base/residue counter in current sequence
+        self.in_header = False # inside a definition line
+
+    @abstractmethod
+    def process_new_sequence(self, pos: int):
+        """ Finish the current sequence, a new one starts at position pos
+        in the current block """
+
+    @abstractmethod
+    def process_block_end(self):
+        """ Finish the current block """
+
+    def scan_block(self, data: bytes, line_start: bool):
+        """ Find sequence boundaries in a block and count bases/residues.
+        Each line except definition lines counts as its length without
+        the end of line.
+        Arguments:
+            data: block of input
+            line_start: True if the block starts at the beginning of a line
+        """
+        self.view = memoryview(data)
+        size = len(data)
+        seg = 0 # start of the part of the block not counted yet
+        pos = 0
+        header = -1
+        if self.in_header:
+            # definition line continues from the previous block
+            pos = data.find(b'\n')
+            if pos < 0:
+                pos = size
+            else:
+                self.in_header = False
+            self.seq_count -= pos
+        elif line_start and data.startswith(b'>'):
+            header = 0
+        while pos < size:
+            if header < 0:
+                # '>' is rare outside of definition lines, so single byte
+                # search is faster than looking for '\n>'
+                header = data.find(b'>', pos + 1)
+                while header > 0 and data[header - 1] != NEWLINE:
+                    header = data.find(b'>', header + 1)
+                if header < 0:
+                    break
+            self.seq_count += header - seg - data.count(b'\n', seg, header)
+            self.process_new_sequence(header)
+            self.seq_count = 0
+            seg = header
+            # definition line does not count towards sequence length
+            pos = data.find(b'\n', header)
+            if pos < 0:
+                pos = size
+                self.in_header = True
+            self.seq_count -= pos - header
+            header = -1
+        self.seq_count += size - seg - data.count(b'\n', seg, size)
+        self.process_block_end()
+
+    def scan(self) -> None:
+        """ Read all input streams and pass the sequence boundaries to
+        process_new_sequence.
+        """
+        for _ in self.scan_blocks():
+            pass
+
+    def scan_blocks(self) -> Iterator[None]:
+        """ Same as scan, but yields after each block of input, so that the
+        caller can act on the sequences seen so far.
+        """
+        nbytes = 0
+        f = None
+        for f in self.file:
+            line_start = True
+            for block in read_blocks(f):
+                nbytes += len(block)
+                self.scan_block(block, line_start)
+                line_start = block.endswith(b'\n')
+                yield
+            if not line_start:
+                # last line of a file without end of line is counted one
+                # base/residue short, and end of line is added
+                if not self.in_header:
+                    self.seq_count -= 1
+                self.in_header = False
+                self.scan_block(b'\n', False)
+        self.process_new_sequence(0)
+        self.seq_count = 0
+        if not nbytes:
+            error = get_error(f)
+            if error:
+                raise FileNotFoundError(error)
+            raise Exception("Empty input file")
+
+
+class FASTAReader(FASTAScanner):
     """ Class for reading single file with FASTA sequences and cutting
     into chunks (batches) of length no longer than threshold, if possible.
     Sequences longer than threshold are written in their own chunks without
     breaks mid-sequence.
     """
-    def __init__(self, f: Union[Iterable[TextIO], TextIO], batch_len: int,
+    def __init__(self, f: Union[Iterable[QueryStream], QueryStream], batch_len: int,
                  out_path: str):
         """Initialize an object
         Arguments:
@@ -62,41 +237,64 @@ class FASTAReader():
             batch_len: Batch length in bases/residues
             out_path: Output directory to save query batches
         """
-        self.file: Union[Iterable[TextIO], TextIO]
-        if isinstance(f, io.TextIOBase):
-            self.file = [f]
-        else:
-            self.file = f
+        super().__init__(f)
         self.batch_len = batch_len
         self.out_path = out_path
         self.queries: List[str] = []
 
         self.nchunk = 0
-        self.buffer: List[str] = []
-        self.seq_buffer: List[str] = []
+        # parts of the chunk and the current sequence from previous blocks
+        self.buffer: List[memoryview] = []
+        self.seq_buffer: List[memoryview] = []
+        # parts of the chunk and the current sequence in the current block
+        # are [chunk_pos, seq_pos) and [seq_pos, ...)
+        self.chunk_pos = 0
+        self.seq_pos = 0
         self.total_count = 0 # count of base/residue in all processed files
         self.chunk_count = 0 # running base/residue count for chunk
-        self.seq_count   = 0 # base/residue counter in current sequence
+        self.chunk_seqs = 0 # number of sequences in chunk
+        # a sequence with a definition line is being read, the text before
+        # the first definition line is not a sequence
+        self.seq_started = False
+        # batches written, but not yet returned by iter_batches
+        self.finished: List[QueryBatch] = []
 
     def process_chunk(self):
         if not self.buffer: return
         query_fqn = write_chunk(self.out_path, self.nchunk, self.buffer)
         self.queries.append(query_fqn)
+        self.finished.append(QueryBatch(query_fqn, self.chunk_count, self.chunk_seqs))
         self.nchunk += 1
         self.buffer = []
         self.total_count += self.chunk_count
         self.chunk_count = 0
+        self.chunk_seqs = 0
 
-    def process_new_sequence(self):
+    def process_new_sequence(self, pos: int):
+        nseqs = 1 if self.seq_started else 0
         if self.chunk_count + self.seq_count > self.batch_len:
+            if self.seq_pos > self.chunk_pos:
+                self.buffer.append(self.view[self.chunk_pos:self.seq_pos])
             self.process_chunk()
             self.buffer = self.seq_buffer
+            self.chunk_pos = self.seq_pos
             self.chunk_count = self.seq_count
+            self.chunk_seqs = nseqs
         else:
             self.buffer += self.seq_buffer
             self.chunk_count += self.seq_count
+            self.chunk_seqs += nseqs
         self.seq_buffer = []
-        self.seq_count  = 0
+        self.seq_pos = pos
+        self.seq_started = True
+
+    def process_block_end(self):
+        if self.seq_pos > self.chunk_pos:
+            self.buffer.append(self.view[self.chunk_pos:self.seq_pos])
+        if len(self.view) > self.seq_pos:
+            self.seq_buffer.append(self.view[self.seq_pos:])
+        self.chunk_pos = 0
+        self.seq_pos = 0
 
     def read_and_cut(self) -> Tuple[int, List[str]]:
         """ Raed a stream, parse it as FASTA, and write sequences into
@@ -104,26 +302,222 @@ class FASTAReader():
         Return the total number
         of bases/residues in the input and list of query files written
         """
+        for _ in self.iter_batches():
+            pass
+        return self.total_count, self.queries
+
+    def iter_batches(self) -> Iterator[QueryBatch]:
+        """ Read a stream, parse it as FASTA, and write sequences into
+        batches approximately of batch_len size. Each batch is yielded as
+        soon as its file is written, so that jobs for it can be created
+        while the rest of the input is read. total_count has the total
+        number of bases/residues once the generator is exhausted.
+        """
         start = timer()
-        nline = 0
-        for f in self.file:
-            for line in f:
-                nline += 1
-                if not line: continue
-                if line[0] == '>':
-                    self.process_new_sequence()
-                else:
-                    self.seq_count += len(line) - 1
-                self.seq_buffer.append(line)
-            if len(self.seq_buffer) and not self.seq_buffer[-1].endswith('\n'):
-                self.seq_buffer.append('\n')
-        self.process_new_sequence()
+        for _ in self.scan_blocks():
+            yield from self.finished
+            self.finished = []
         self.process_chunk()
+        yield from self.finished
+        self.finished = []
         end = timer()
         logging.debug(f'Splitting: {end - start:.2f} seconds')
-        if not nline:
-            error = get_error(f)
-            if error:
-                raise FileNotFoundError(error)
-            raise Exception("Empty input file")
-        return self.total_count, self.queries
+
+
+class FASTAIndex(FASTAScanner):
+    """ Class for reading FASTA sequences once and cutting them into batches
+    of any length later. Input is spooled into a local file while sequence
+    boundaries and lengths are recorded, so that batch length can be chosen
+    after the total query length is known, without reading the source again.
+    Batches are identical to the ones produced by FASTAReader for the same
+    batch length.
+    """
+    def __init__(self, f: Union[Iterable[QueryStream], QueryStream],
+                 spool_dir: Optional[str] = None):
+        """Initialize an object
+        Arguments:
+            f: Open file handle or stream or an Iterable of open file handles
+               or streams.
+            spool_dir: Directory for the local spool file, system temporary
+               directory if None
+        """
+        super().__init__(f)
+        self.spool = tempfile.TemporaryFile(dir=spool_dir)
+        self.offset = 0 # position of the current block in spool file
+        # offsets[i] is the position of i-th sequence in spool file,
+        # offsets[-1] is the spool file size
+        self.offsets = array('Q', [0])
+        # counts[i] is the number of bases/residues in i-th sequence
+        self.counts = array('Q')
+        self.total_count = 0 # count of base/residue in all processed files
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        """ Remove the spool file """
+        self.spool.close()
+
+    def process_new_sequence(self, pos: int):
+        """ Record a sequence that ends at position pos in the current block """
+        offset = self.offset + pos
+        if offset == self.offsets[-1]: return
+        self.offsets.append(offset)
+        self.counts.append(self.seq_count)
+        self.total_count += self.seq_count
+
+    def process_block_end(self):
+        self.offset += self.spool.write(self.view)
+
+    def read(self) -> int:
+        """ Read a stream, parse it as FASTA, and record sequence
+        boundaries and lengths. Return the total number of bases/residues
+        in the input.
+        """
+        start = timer()
+        self.scan()
+        self.spool.flush()
+        end = timer()
+        logging.debug(f'Indexing: {end - start:.2f} seconds')
+        return self.total_count
+
+    def cut(self, batch_len: float,
+            seq_cost: Optional[Callable[[int], float]] = None) -> Iterator[Tuple[int, int]]:
+        """ Generate ranges of sequence numbers [first, last) for batches
+        approximately of batch_len size, same way FASTAReader does.
+        If seq_cost is given, it maps sequence length to estimated search
+        cost, and batch_len is the batch cost limit instead of length.
+        """
+        first = 0
+        chunk_count = 0.0
+        counts = self.counts if seq_cost is None else map(seq_cost, self.counts)
+        for i, count in enumerate(counts):
+            if chunk_count + count > batch_len and i > first:
+                yield first, i
+                first = i
+                chunk_count = count
+            else:
+                chunk_count += count
+        if len(self.counts) > first:
+            yield first, len(self.counts)
+
+    def get_num_batches(self, batch_len: float,
+                        seq_cost: Optional[Callable[[int], float]] = None) -> int:
+        """ Return the number of batches the input would be cut into """
+        return sum(1 for _ in self.cut(batch_len, seq_cost))
+
+    def write_batches(self, batch_len: float, out_path: str,
+                      seq_cost: Optional[Callable[[int], float]] = None) -> List[str]:
+        """ Write sequences from spool file into batches approximately of
+        batch_len size (or cost, see cut). Return list of query files written.
+        """
+        return [batch.name for batch in self.iter_batches(batch_len, out_path, seq_cost)]
+
+    def iter_batches(self, batch_len: float, out_path: str,
+                     seq_cost: Optional[Callable[[int], float]] = None) -> Iterator[QueryBatch]:
+        """ Write sequences from spool file into batches approximately of
+        batch_len size (or cost, see cut), yield each batch as soon as it is
+        written.
+        """
+        start = timer()
+        for nchunk, (first, last) in enumerate(self.cut(batch_len, seq_cost)):
+            self.spool.seek(self.offsets[first])
+            data = self.spool.read(self.offsets[last] - self.offsets[first])
+            yield QueryBatch(write_chunk(out_path, nchunk, [data]),
+                             sum(self.counts[first:last]), last - first)
+        end = timer()
+        logging.debug(f'Splitting: {end - start:.2f} seconds')
+
+    def balance(self, num_batches: int,
+                seq_cost: Optional[Callable[[int], float]] = None) -> List[List[int]]:
+        """ Distribute sequences among num_batches batches so that the
+        largest batch is as small as possible, regardless of input order.
+        Sequences are assigned longest first, each to the batch with the
+        fewest bases/residues so far (LPT), which gives the largest batch at
+        most 4/3 of optimal. If seq_cost is given, it maps sequence length to
+        estimated search cost, and batches are balanced by cost instead.
+        Returns:
+            Sequence numbers in each batch, in input order. Batches are
+            ordered by their first sequence number.
+        """
+        num_batches = max(1, min(num_batches, len(self.counts)))
+        loads = [(0.0, i) for i in range(num_batches)]
+        batches: List[List[int]] = [[] for _ in range(num_batches)]
+        counts: Sequence[float] = self.counts
+        if seq_cost is not None:
+            counts = array('d', map(seq_cost, self.counts))
+        for seq in sorted(range(len(counts)), key=lambda x: counts[x], reverse=True):
+            load, i = loads[0]
+            batches[i].append(seq)
+            heapq.heapreplace(loads, (load + counts[seq], i))
+        for batch in batches:
+            batch.sort()
+        return sorted((b for b in batches if b), key=lambda b: b[0])
+
+    def iter_balanced_batches(self, num_batches: int, out_path: str,
+                              order: Optional[List[List[int]]] = None,
+                              seq_cost: Optional[Callable[[int], float]] = None) -> Iterator[QueryBatch]:
+        """ Write sequences from spool file into num_batches batches of
+        approximately equal size (or cost), see balance, yield each batch as
+        soon as it is written.
+        Arguments:
+            num_batches: Target number of batches
+            out_path: Output directory to save query batches
+            order: If not None, sequence numbers in each batch are appended
+               to it, so that results can be put back in input order
+            seq_cost: Estimated search cost of a sequence by its length
+        """
+        start = timer()
+        for nchunk, seqs in enumerate(self.balance(num_batches, seq_cost)):
+            buffer = []
+            # consecutive sequences are read together
+            first = last = seqs[0]
+            for seq in seqs[1:] + [-1]:
+                if seq == last + 1:
+                    last = seq
+                    continue
+                self.spool.seek(self.offsets[first])
+                buffer.append(self.spool.read(self.offsets[last + 1] - self.offsets[first]))
+                first = last = seq
+            if order is not None:
+                order.append(seqs)
+            yield QueryBatch(write_chunk(out_path, nchunk, buffer),
+                             sum(self.counts[i] for i in seqs), len(seqs))
+        end = timer()
+        logging.debug(f'Splitting: {end - start:.2f} seconds')
+
+
+def write_query_order(order: List[List[int]], batch_names: List[str], f: TextIO) -> None:
+    """ Write map of query batches to input sequence numbers, one line per
+    batch: batch file name, tab, and comma separated sequence number ranges,
+    e.g. "batch_000.fa\t0-4,9,12"
+    """
+    for name, seqs in zip(batch_names, order):
+        ranges = []
+        first = last = seqs[0]
+        for seq in seqs[1:] + [-1]:
+            if seq == last + 1:
+                last = seq
+                continue
+            ranges.append(str(first) if first == last else f'{first}-{last}')
+            first = last = seq
+        f.write(f'{os.path.basename(name)}\t{",".join(ranges)}\n')
+
+
+def read_query_order(f: TextIO) -> List[Tuple[str, List[int]]]:
+    """ Read map of query batches to input sequence numbers written by
+    write_query_order """
+    order = []
+    for line in f:
+        if not line.strip():
+            continue
+        name, _, ranges = line.rstrip('\n').partition('\t')
+        seqs: List[int] = []
+        for r in ranges.split(','):
+            first, _, last = r.partition('-')
+            seqs += range(int(first), int(last or first) + 1)
+        order.append((name, seqs))
+    return order
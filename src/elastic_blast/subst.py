@@ -24,6 +24,7 @@ Module elastic_blast.subst - substitute variables of form ${VAR_NAME} or $VAR_NA
 Author: Victor Joukov joukovv@ncbi.nlm.nih.gov
 """
 import re
+from typing import List, Optional, Set
 
 re_sub = re.compile(r'\$(?:\{([A-Za-z_][A-Za-z0-9_]*)\}|([A-Za-z_][A-Za-z0-9_]*))')
 def substitute_params(job_template: str, map_obj) -> str:
@@ -43,3 +44,71 @@ def substitute_params(job_template: str, map_obj) -> str:
             v = mo.group(2)
         return map_obj.get(v, mo.group(0))
     return re_sub.sub(_subs_var, job_template)
+
+
+class Template:
+    """ Text with variables of form ${VAR_NAME} and $VAR_NAME, parsed once
+    into literal text and variables, so that it can be rendered many times
+    without scanning the text again. Rendering gives the same result as
+    substitute_params. """
+
+    def __init__(self, text: str = ''):
+        """ Parameters:
+                text: text to substitute variables in
+        """
+        # literal text segments, variable names, and original variable text,
+        # variable i is between literals i and i+1
+        self.literals: List[str] = []
+        self.names: List[str] = []
+        self.originals: List[str] = []
+        pos = 0
+        for mo in re_sub.finditer(text):
+            self.literals.append(text[pos:mo.start()])
+            self.names.append(mo.group(1) or mo.group(2))
+            self.originals.append(mo.group(0))
+            pos = mo.end()
+        self.literals.append(text[pos:])
+
+    @property
+    def variables(self) -> Set[str]:
+        """ Names of variables in the template """
+        return set(self.names)
+
+    def bind(self, map_obj, keep: Optional[Set[str]] = None) -> 'Template':
+        """ Substitute some variables and return a new template with the
+        remaining ones.
+
+        Params:
+            map_obj: object with get method to use for substitutions
+            keep: names of variables to leave in the template even if map_obj
+                has them
+        Returns: template with fewer variables
+        """
+        keep = keep or set()
+        bound = Template()
+        bound.literals = []
+        literal = self.literals[0]
+        for name, original, next_literal in zip(self.names, self.originals, self.literals[1:]):
+            value = None if name in keep else map_obj.get(name)
+            if value is None:
+                bound.literals.append(literal)
+                bound.names.append(name)
+                bound.originals.append(original)
+                literal = next_literal
+            else:
+                literal += value + next_literal
+        bound.literals.append(literal)
+        return bound
+
+    def render(self, map_obj) -> str:
+        """ Substitute variables with values from map object
+
+        Params:
+            map_obj: object with get method to use for substitutions
+        Returns: text with substitutions
+        """
+        parts = [self.literals[0]]
+        for name, original, literal in zip(self.names, self.originals, self.literals[1:]):
+            parts.append(map_obj.get(name, original))
+            parts.append(literal)
+        return ''.join(parts)
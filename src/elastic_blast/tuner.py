@@ -29,7 +29,7 @@ from enum import Enum
 from dataclasses import dataclass
 from bisect import bisect_left
 import math
-from typing import Optional
+from typing import Any, Dict, Iterable, Optional
 from .constants import BLASTDB_ERROR, INPUT_ERROR
 from .constants import UNKNOWN_ERROR, MolType, CSP
 from .constants import ELB_S3_PREFIX, ELB_GCS_PREFIX
@@ -220,6 +220,98 @@ def get_batch_length(cloud_provider: CSP, program: str, mt_mode: MTMode,
     return batch_len
 
 
+# Fixed cost of searching a single query sequence (setting up query data
+# structures, traceback, and formatting results), expressed in query letters,
+# by BLAST program
+SEQUENCE_OVERHEAD_LETTERS = {
+    'blastn': 1000,
+    'blastp': 100,
+    'blastx': 300,
+    'tblastn': 100,
+    'tblastx': 300,
+    'psiblast': 100,
+    'rpsblast': 100,
+    'rpstblastn': 300,
+}
+
+
+@dataclass
+class WorkModel:
+    """Model of BLAST search CPU time for a query sequence. Search time grows
+    with the length of the sequence plus a fixed per sequence overhead, and
+    with the length of the database, as all of it is scanned for each query
+    batch. Translated searches (blastx, tblastn, tblastx, rpstblastn) differ
+    in throughput and overhead, which are given per program.
+
+    Throughput comes from lettersPerSecondPerCpu of run-summary outputs for
+    the same program, scaled to database length. Without it costs are in
+    relative units, which is enough to even out batches."""
+    program: str
+    db_length: int
+    # query letters searched per second per CPU against this database,
+    # None if not calibrated
+    letters_per_second_per_cpu: Optional[float] = None
+
+    @property
+    def overhead_letters(self) -> int:
+        """Per sequence overhead in query letters"""
+        return SEQUENCE_OVERHEAD_LETTERS.get(self.program.lower(), 0)
+
+    def seq_cost(self, length: int) -> float:
+        """Estimated CPU time in seconds to search a sequence of given length,
+        or relative cost if the model is not calibrated"""
+        return (length + self.overhead_letters) / (self.letters_per_second_per_cpu or 1.0)
+
+    def batch_cost(self, batch_len: int, mean_seq_length: float) -> float:
+        """Estimated cost of searching a batch of batch_len letters made of
+        sequences of mean_seq_length letters"""
+        num_seqs = batch_len / max(mean_seq_length, 1.0)
+        return (batch_len + num_seqs * self.overhead_letters) / (self.letters_per_second_per_cpu or 1.0)
+
+    def calibrate(self, run_summaries: Iterable[Dict[str, Any]]) -> None:
+        """Set throughput from run-summary outputs of earlier searches with
+        the same BLAST program. Each throughput is scaled from the database
+        it was measured with to this model's database and the median is
+        used. Summaries without lettersPerSecondPerCpu are ignored."""
+        rates = []
+        for summary in run_summaries:
+            rate = summary.get('lettersPerSecondPerCpu')
+            if not rate or rate <= 0:
+                continue
+            db_length = summary.get('blastData', {}).get('databaseLength')
+            if db_length and self.db_length:
+                rate *= db_length / self.db_length
+            rates.append(rate)
+        if rates:
+            rates.sort()
+            mid = len(rates) // 2
+            self.letters_per_second_per_cpu = rates[mid] if len(rates) % 2 else (rates[mid - 1] + rates[mid]) / 2
+            logging.debug(f'Calibrated {self.program} throughput: {self.letters_per_second_per_cpu:.2f} letters per second per CPU')
+
+
+def get_work_model(program: str, db_metadata: Optional[DbMetadata] = None,
+                   run_summary_files: Iterable[str] = []) -> WorkModel:
+    """Create a BLAST search work model and calibrate it with run-summary
+    output files
+
+    Arguments:
+        program: BLAST program
+        db_metadata: BLAST database metadata
+        run_summary_files: Local paths to JSON outputs of elastic-blast run-summary
+    """
+    model = WorkModel(program, db_metadata.number_of_letters if db_metadata else 0)
+    summaries = []
+    for path in run_summary_files:
+        try:
+            with open(path) as f:
+                summaries.append(json.load(f))
+        except (OSError, ValueError) as err:
+            raise UserReportError(returncode=INPUT_ERROR,
+                                  message=f'Cannot read run summary "{path}": {err}')
+    model.calibrate(summaries)
+    return model
+
+
 def aws_get_mem_limit(num_cpus: PositiveInteger, 
         machine_type: str,
         db: Optional[DbData] = None, 
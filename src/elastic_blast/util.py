@@ -33,7 +33,10 @@ import subprocess
 import datetime
 import json
 import inspect
+import threading
+import time
 from functools import reduce
+from timeit import default_timer as timer
 from pkg_resources import resource_exists
 from typing import List, Union, Callable, Optional
 from .constants import MolType, GCS_DFLT_BUCKET
@@ -41,6 +44,7 @@ from .constants import DEPENDENCY_ERROR, AWS_MAX_TAG_LENGTH, GCP_MAX_LABEL_LENGT
 from .constants import AWS_MAX_JOBNAME_LENGTH, CSP, ELB_GCS_PREFIX
 from .constants import ELB_DFLT_LOGLEVEL, ELB_DFLT_LOGFILE
 from .base import DBSource
+from .gcs import get_gcs_client
 
 RESOURCES = [
     'job-cloud-split-local-ssd.yaml.template',
@@ -225,15 +229,9 @@ def get_blastdb_info(blastdb: str, gcp_prj: Optional[str] = None):
     db_path = ''
     if db.startswith(ELB_GCS_PREFIX):
         # Custom database, just check the presence
-        try:
-            prj = f'-u {gcp_prj}' if gcp_prj else ''
-            proc = safe_exec(f'gsutil {prj} ls {db}.*')
-        except SafeExecError:
-            raise ValueError(f'Error requesting for {db}.*')
-        output = proc.stdout.decode()
-        if not output:
+        fnames: List[str] = _gcs_ls_db_files(db, gcp_prj)
+        if not fnames:
             raise ValueError(f'There are no files at the bucket {db}.*')
-        fnames: List[str] = output.split('\n')
         res = reduce(lambda x, y: x or y.endswith('tar.gz'), fnames, False)
         if res:
             db_path = db + '.tar.gz'
@@ -243,6 +241,22 @@ def get_blastdb_info(blastdb: str, gcp_prj: Optional[str] = None):
     return db, db_path, sanitize_for_k8s(db)
 
 
+def _gcs_ls_db_files(db: str, gcp_prj: Optional[str]) -> List[str]:
+    """List files of a BLAST database in GCS, raises ValueError on failure"""
+    gcs = get_gcs_client()
+    if gcs:
+        try:
+            return list(gcs.list(db + '.', delimiter='/', user_project=gcp_prj))
+        except OSError:
+            raise ValueError(f'Error requesting for {db}.*')
+    try:
+        prj = f'-u {gcp_prj}' if gcp_prj else ''
+        proc = safe_exec(f'gsutil {prj} ls {db}.*')
+    except SafeExecError:
+        raise ValueError(f'Error requesting for {db}.*')
+    return [fname for fname in proc.stdout.decode().split('\n') if fname]
+
+
 def get_blastdb_size(db: str, db_source: DBSource, gcp_prj: Optional[str] = None) -> float:
     """Request blast database size from GCP using gcp module
     If applied to custom db, just check the presence
@@ -253,9 +267,8 @@ def get_blastdb_size(db: str, db_source: DBSource, gcp_prj: Optional[str] = None
     if db.startswith(ELB_GCS_PREFIX):
         # Custom database, just check the presence
         try:
-            prj = f'-u {gcp_prj}' if gcp_prj else ''
-            safe_exec(f'gsutil {prj} ls {db}.*')
-        except SafeExecError:
+            _gcs_ls_db_files(db, gcp_prj)
+        except ValueError:
             raise ValueError(f'BLAST database {db} was not found')
         # TODO: find a way to check custom DB size w/o transferring it to user machine
         return 1000000
@@ -270,8 +283,12 @@ def gcp_get_blastdb_latest_path(gcp_prj: Optional[str]) -> str:
     """Get latest path of GCP-based blastdb repository"""
     prj = f'-u {gcp_prj}' if gcp_prj else ''
     cmd = f'gsutil {prj} cat {GCS_DFLT_BUCKET}/latest-dir'
-    proc = safe_exec(cmd)
-    return os.path.join(GCS_DFLT_BUCKET, proc.stdout.decode().rstrip())
+    gcs = get_gcs_client()
+    if gcs:
+        latest_dir = gcs.read(f'{GCS_DFLT_BUCKET}/latest-dir', user_project=gcp_prj)
+    else:
+        latest_dir = safe_exec(cmd).stdout
+    return os.path.join(GCS_DFLT_BUCKET, latest_dir.decode().rstrip())
 
 
 def gcp_get_blastdb_size(db: str, gcp_prj: Optional[str]) -> float:
@@ -283,8 +300,12 @@ def gcp_get_blastdb_size(db: str, gcp_prj: Optional[str]) -> float:
     latest_path = gcp_get_blastdb_latest_path(gcp_prj)
     prj = f'-u {gcp_prj}' if gcp_prj else ''
     cmd = f'gsutil {prj} cat {latest_path}/blastdb-manifest.json'
-    proc = safe_exec(cmd)
-    blastdb_metadata = json.loads(proc.stdout.decode())
+    gcs = get_gcs_client()
+    if gcs:
+        manifest = gcs.read(f'{latest_path}/blastdb-manifest.json', user_project=gcp_prj)
+    else:
+        manifest = safe_exec(cmd).stdout
+    blastdb_metadata = json.loads(manifest.decode())
     if not db in blastdb_metadata:
         raise ValueError(f'BLAST database {db} was not found')
     return blastdb_metadata[db]['size']
@@ -529,6 +550,30 @@ def clean_up(clean_up_stack: List[Callable]) -> List[str]:
     return messages
 
 
+class TokenBucket:
+    """ Thread-safe rate limiter: allows on average rate calls to acquire per
+    second, with bursts of up to capacity calls """
+    def __init__(self, rate: float, capacity: Optional[float] = None):
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else rate
+        self.tokens = self.capacity
+        self.last = timer()
+        self.lock = threading.Lock()
+
+    def acquire(self) -> None:
+        """ Take a token, waiting until one is available """
+        with self.lock:
+            now = timer()
+            self.tokens = min(self.capacity, self.tokens + (now - self.last) * self.rate)
+            self.last = now
+            # tokens go negative for callers that have to wait, which
+            # reserves a place in line for each of them
+            self.tokens -= 1
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0
+        if wait:
+            time.sleep(wait)
+
+
 def get_usage_reporting() -> bool:
     """ Use environment variable to get Usage Reporting status 
     as described in https://www.ncbi.nlm.nih.gov/books/NBK563686
@@ -45,9 +45,13 @@ import configparser
 import os
 import json
 import re
+import threading
+import time
 import boto3 #type: ignore
 import getpass
+import yaml
 from moto import mock_batch, mock_s3, mock_ec2, mock_cloudformation, mock_iam #type: ignore
+from moto import mock_dynamodb #type: ignore
 
 from elastic_blast import aws
 from elastic_blast import aws_traits
@@ -105,6 +109,13 @@ def s3(aws_credentials):
         yield boto3.resource('s3')
 
 
+@pytest.fixture()
+def dynamodb(aws_credentials):
+    """Get mocked API for DynamoDB"""
+    with mock_dynamodb():
+        yield boto3.client('dynamodb')
+
+
 def create_roles():
     """Create roles needed for AWS Batch compute environment.
 
@@ -605,3 +616,278 @@ def test_wrong_provider_user_db():
     assert(exc_info.value.returncode == BLASTDB_ERROR)
     assert('User database ' in exc_info.value.message)
     assert('must reside in AWS S3' in exc_info.value.message)
+
+
+@pytest.fixture
+def elb_submitter(mocker):
+    """ElasticBlastAws object set up only for job submission, with mocked
+    AWS Batch client and results bucket"""
+    eb = aws.ElasticBlastAws.__new__(aws.ElasticBlastAws)
+    eb.cfg = MagicMock()
+    eb.cfg.blast.program = 'blastn'
+    eb.cfg.blast.options = '-evalue 0.01'
+    eb.cfg.blast.taxidlist = None
+    eb.cfg.cluster.db_source = DBSource.AWS
+    eb.cfg.cluster.num_cpus = 16
+    eb.cfg.cluster.mem_limit = '60G'
+    eb.db, eb.db_path, eb.db_label = 'pdbnt', '', 'pdbnt'
+    eb.results_bucket = 's3://test-results'
+    eb.owner = 'user'
+    eb.dry_run = False
+    eb.boto_cfg = None
+    eb.job_queue_name = 'queue'
+    eb.blast_job_definition_name = 'blast-job-definition'
+    eb.job_ids = aws.JobIds()
+    eb.terminal_job_states = {}
+    eb.job_state_table_name = None
+    eb.batch = MagicMock()
+    eb.batch.submit_job.side_effect = [{'jobId': f'job-{i}'} for i in range(100)]
+    mocker.patch.object(eb, 'upload_job_ids')
+    mocker.patch('elastic_blast.aws.write_to_s3')
+    yield eb
+
+
+def test_client_submit_array_jobs(elb_submitter, mocker):
+    """Test that query batches are submitted as array jobs"""
+    mocker.patch('elastic_blast.aws.ELB_AWS_BATCH_MAX_ARRAY_SIZE', 10)
+    query_batches = [f's3://test-results/query_batches/batch_{i:03d}.fa' for i in range(21)]
+    elb_submitter.client_submit(query_batches, False)
+
+    batch_list = 's3://test-results/metadata/query_batch_list.txt'
+    aws.write_to_s3.assert_called_once_with(batch_list, '\n'.join(query_batches) + '\n', None, False)
+    calls = elb_submitter.batch.submit_job.call_args_list
+    assert len(calls) == 3
+    assert [c.kwargs.get('arrayProperties') for c in calls] == [{'size': 10}, {'size': 10}, None]
+    for c, offset in zip(calls, ['0', '10', '20']):
+        assert c.kwargs['parameters']['query-batch'] == batch_list
+        env = {e['name']: e['value'] for e in c.kwargs['containerOverrides']['environment']}
+        assert env['ELB_QUERY_BATCH_LIST'] == batch_list
+        assert env['ELB_ARRAY_INDEX_OFFSET'] == offset
+    assert elb_submitter.job_ids.search == ['job-0', 'job-1', 'job-2']
+
+
+def test_client_submit_single_jobs(elb_submitter, monkeypatch):
+    """Test that array jobs can be disabled"""
+    monkeypatch.setenv('ELB_DISABLE_ARRAY_JOBS', '1')
+    query_batches = [f's3://test-results/query_batches/batch_{i:03d}.fa' for i in range(3)]
+    elb_submitter.client_submit(query_batches, False)
+    calls = elb_submitter.batch.submit_job.call_args_list
+    assert len(calls) == 3
+    assert not any('arrayProperties' in c.kwargs for c in calls)
+    assert sorted(c.kwargs['parameters']['query-batch'] for c in calls) == query_batches
+
+
+def test_client_submit_db_version(elb_submitter, mocker, monkeypatch):
+    """Test that database version is passed to jobs in an environment
+    variable and not as a job definition parameter"""
+    mocker.patch('elastic_blast.aws.get_db_version', return_value='2024-01-01-abc')
+    for disable_array_jobs in [False, True]:
+        if disable_array_jobs:
+            monkeypatch.setenv('ELB_DISABLE_ARRAY_JOBS', '1')
+        elb_submitter.batch.submit_job.reset_mock()
+        elb_submitter.batch.submit_job.side_effect = [{'jobId': f'job-{i}'} for i in range(3)]
+        query_batches = [f's3://test-results/query_batches/batch_{i:03d}.fa' for i in range(3)]
+        elb_submitter.client_submit(query_batches, False)
+        calls = elb_submitter.batch.submit_job.call_args_list
+        assert calls
+        for c in calls:
+            assert 'db-version' not in c.kwargs['parameters']
+            env = {e['name']: e['value'] for e in c.kwargs['containerOverrides']['environment']}
+            assert env['ELB_DB_VERSION'] == '2024-01-01-abc'
+            assert 'BLAST_USAGE_REPORT' in env
+
+
+def test_client_submit_concurrent_jobs(elb_submitter, monkeypatch, mocker):
+    """Test that jobs submitted concurrently are recorded in query batch
+    order and throttled requests are retried"""
+    monkeypatch.setenv('ELB_DISABLE_ARRAY_JOBS', '1')
+    mocker.patch('elastic_blast.aws.ELB_AWS_BATCH_SUBMIT_JOB_TPS', 1000)
+    throttled = set()
+
+    def submit_job(**kwargs):
+        query = kwargs['parameters']['query-batch']
+        # throttle the first request for every other job
+        if query.endswith('1.fa') and query not in throttled:
+            throttled.add(query)
+            raise ClientError({'Error': {'Code': 'TooManyRequestsException'}}, 'SubmitJob')
+        return {'jobId': 'id-' + kwargs['parameters']['split-part']}
+
+    elb_submitter.batch.submit_job.side_effect = submit_job
+    query_batches = [f's3://test-results/query_batches/batch_{i:03d}.fa' for i in range(50)]
+    elb_submitter.client_submit(query_batches, False)
+    assert elb_submitter.job_ids.search == [f'id-{i}' for i in range(50)]
+    assert len(throttled) == 5
+    assert elb_submitter.batch.submit_job.call_count == 55
+
+
+def test_client_submit_error(elb_submitter, monkeypatch):
+    """Test that errors other than throttling are not retried"""
+    monkeypatch.setenv('ELB_DISABLE_ARRAY_JOBS', '1')
+    elb_submitter.batch.submit_job.side_effect = ClientError({'Error': {'Code': 'ClientException'}}, 'SubmitJob')
+    with pytest.raises(UserReportError):
+        elb_submitter.client_submit(['s3://test-results/query_batches/batch_000.fa'], False)
+    assert elb_submitter.batch.submit_job.call_count == 1
+    assert not elb_submitter.job_ids.search
+
+
+def test_check_status_array_jobs(elb_submitter):
+    """Test that array jobs are counted by the states of their child jobs"""
+    elb_submitter.job_ids.search = ['array-job', 'pending-array-job', 'single-job']
+    elb_submitter.batch.describe_jobs.return_value = {'jobs': [
+        {'jobId': 'array-job', 'status': 'RUNNING',
+         'arrayProperties': {'size': 10, 'statusSummary': {'RUNNING': 3, 'SUCCEEDED': 6, 'FAILED': 1}}},
+        {'jobId': 'pending-array-job', 'status': 'PENDING',
+         'arrayProperties': {'size': 5, 'statusSummary': {}}},
+        {'jobId': 'single-job', 'status': 'SUCCEEDED'}]}
+    counts, _ = elb_submitter._check_status(False)
+    assert counts == {'pending': 5, 'running': 3, 'succeeded': 7, 'failed': 1}
+
+
+def test_check_status_extended_array_jobs(elb_submitter):
+    """Test that detailed status reports child jobs of array jobs"""
+    children = [{'jobId': f'array-job:{i}', 'jobName': 'search', 'arrayProperties': {'index': i},
+                 'status': 'SUCCEEDED' if i < 3 else 'FAILED'} for i in range(4)]
+
+    def list_jobs(jobStatus, **kwargs):
+        if 'jobQueue' in kwargs:
+            jobs = [{'jobId': 'array-job', 'status': 'RUNNING', 'arrayProperties': {'size': 4}},
+                    {'jobId': 'single-job', 'status': 'SUCCEEDED'}]
+        else:
+            assert kwargs == {'arrayJobId': 'array-job'}
+            jobs = children
+        return {'jobSummaryList': [job for job in jobs if job['status'] == jobStatus]}
+
+    elb_submitter.batch.list_jobs.side_effect = list_jobs
+    counts, _ = elb_submitter._check_status_extended()
+    assert counts == {'succeeded': 4, 'failed': 1}
+
+
+def test_check_status_cache(elb_submitter):
+    """Test that jobs in terminal states are described only once across
+    status checks"""
+    elb_submitter.job_ids.search = [f'job-{i}' for i in range(150)]
+    states = {f'job-{i}': 'SUCCEEDED' if i < 120 else 'RUNNING' for i in range(150)}
+    states['job-0'] = 'FAILED'
+    described = []
+
+    def describe_jobs(jobs):
+        described.append(jobs)
+        return {'jobs': [{'jobId': job_id, 'status': states[job_id]} for job_id in jobs]}
+
+    elb_submitter.batch.describe_jobs.side_effect = describe_jobs
+    counts, _ = elb_submitter._check_status(False)
+    assert counts == {'pending': 0, 'running': 30, 'succeeded': 119, 'failed': 1}
+    assert sum(len(jobs) for jobs in described) == 150
+
+    described.clear()
+    for i in range(120, 140):
+        states[f'job-{i}'] = 'SUCCEEDED'
+    counts, _ = elb_submitter._check_status(False)
+    assert counts == {'pending': 0, 'running': 10, 'succeeded': 139, 'failed': 1}
+    assert described == [[f'job-{i}' for i in range(120, 150)]]
+
+    described.clear()
+    counts, _ = elb_submitter._check_status(False)
+    assert counts == {'pending': 0, 'running': 10, 'succeeded': 139, 'failed': 1}
+    assert described == [[f'job-{i}' for i in range(140, 150)]]
+
+
+@pytest.fixture()
+def job_state_table(dynamodb, monkeypatch):
+    """Create job state table and return the job state event handler from
+    CloudFormation template"""
+    table_name = 'job-states'
+    dynamodb.create_table(TableName=table_name, BillingMode='PAY_PER_REQUEST',
+                          AttributeDefinitions=[{'AttributeName': 'jobId', 'AttributeType': 'S'}],
+                          KeySchema=[{'AttributeName': 'jobId', 'KeyType': 'HASH'}])
+    monkeypatch.setenv('TABLE_NAME', table_name)
+
+    class CfnLoader(yaml.SafeLoader):
+        pass
+    CfnLoader.add_multi_constructor('!', lambda loader, suffix, node: None)
+    with open(aws.CF_TEMPLATE) as f:
+        template = yaml.load(f, Loader=CfnLoader)
+    code = template['Resources']['JobStateFunction']['Properties']['Code']['ZipFile']
+    namespace: dict = {}
+    exec(code, namespace)
+    yield table_name, namespace['handler']
+
+
+def job_state_event(job_id, status, time, array_properties=None):
+    """Create an AWS Batch Job State Change event"""
+    event = {'source': 'aws.batch', 'detail-type': 'Batch Job State Change',
+             'time': time, 'detail': {'jobId': job_id, 'status': status}}
+    if array_properties:
+        event['detail']['arrayProperties'] = array_properties
+    return event
+
+
+def test_check_status_job_state_events(elb_submitter, job_state_table, dynamodb):
+    """Test that search job states are counted from AWS Batch events"""
+    table_name, handler = job_state_table
+    elb_submitter.job_state_table_name = table_name
+    elb_submitter.dynamodb = dynamodb
+    elb_submitter.client_submit([f's3://test-results/query_batches/batch_{i:03d}.fa' for i in range(5)], False)
+
+    events = [
+        # array parent job events are not counted
+        job_state_event('array', 'RUNNING', '2022-01-01T00:00:00Z', {'size': 5}),
+        job_state_event('array:0', 'RUNNABLE', '2022-01-01T00:00:01Z', {'index': 0}),
+        job_state_event('array:0', 'RUNNING', '2022-01-01T00:00:02Z', {'index': 0}),
+        job_state_event('array:1', 'RUNNING', '2022-01-01T00:00:02Z', {'index': 1}),
+        job_state_event('array:2', 'SUCCEEDED', '2022-01-01T00:00:05Z', {'index': 2}),
+        # delivered out of order
+        job_state_event('array:2', 'RUNNING', '2022-01-01T00:00:03Z', {'index': 2}),
+        job_state_event('array:3', 'FAILED', '2022-01-01T00:00:05Z', {'index': 3}),
+        # duplicate delivery
+        job_state_event('array:3', 'FAILED', '2022-01-01T00:00:05Z', {'index': 3}),
+        # delivered late within the same second as the terminal state
+        job_state_event('array:3', 'RUNNING', '2022-01-01T00:00:05Z', {'index': 3}),
+    ]
+    for event in events:
+        handler(event, None)
+
+    counts, _ = elb_submitter._check_status(False)
+    assert counts == {'pending': 1, 'running': 2, 'succeeded': 1, 'failed': 1}
+    elb_submitter.batch.describe_jobs.assert_not_called()
+
+
+def test_check_status_job_state_events_not_submitted(elb_submitter, job_state_table, dynamodb, mocker):
+    """Test that AWS Batch jobs are described if search jobs were not
+    submitted yet"""
+    mocker.patch.object(elb_submitter, '_load_job_ids_from_aws')
+    elb_submitter.job_state_table_name, _ = job_state_table
+    elb_submitter.dynamodb = dynamodb
+    elb_submitter.job_ids.job_submission = 'submit-job'
+    elb_submitter.batch.describe_jobs.return_value = {'jobs': [{'jobId': 'submit-job', 'status': 'RUNNING'}]}
+    counts, _ = elb_submitter._check_status(False)
+    assert counts == {'pending': 0, 'running': 1, 'succeeded': 0, 'failed': 0}
+
+
+def test_client_submit_concurrent_jobs_failure(elb_submitter, monkeypatch, mocker):
+    """Test that jobs submitted while another submission fails are recorded"""
+    monkeypatch.setenv('ELB_DISABLE_ARRAY_JOBS', '1')
+    mocker.patch('elastic_blast.aws.ELB_AWS_BATCH_SUBMIT_JOB_TPS', 1000)
+    failed = threading.Event()
+    submitted = []
+
+    def submit_job(**kwargs):
+        part = kwargs['parameters']['split-part']
+        if part == '0':
+            failed.wait(5)
+            raise ClientError({'Error': {'Code': 'AccessDeniedException'}}, 'SubmitJob')
+        if part == '1':
+            failed.set()
+        else:
+            # still running when the first submission fails
+            failed.wait(5)
+            time.sleep(0.2)
+        submitted.append('id-' + part)
+        return {'jobId': 'id-' + part}
+
+    elb_submitter.batch.submit_job.side_effect = submit_job
+    query_batches = [f's3://test-results/query_batches/batch_{i:03d}.fa' for i in range(8)]
+    with pytest.raises(UserReportError):
+        elb_submitter.client_submit(query_batches, False)
+    assert len(submitted) == 7
+    assert sorted(elb_submitter.job_ids.search) == sorted(submitted)
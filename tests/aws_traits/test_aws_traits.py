@@ -24,8 +24,12 @@ Test for elastic_blast.aws_traits
 Author: Greg Boratyn boratyng@ncbi.nlm.nih.gov
 """
 import os
+import threading
 from elastic_blast.aws_traits import get_machine_properties, create_aws_config, get_availability_zones_for
 from elastic_blast.aws_traits import get_regions
+from elastic_blast.aws_traits import get_boto_client, get_boto_resource, clear_boto_cache
+from elastic_blast.constants import ELB_BOTO_MAX_POOL_CONNECTIONS
+from tests.utils import aws_credentials
 from elastic_blast.base import InstanceProperties
 from elastic_blast.util import UserReportError
 from elastic_blast.constants import INPUT_ERROR, ELB_DFLT_AWS_REGION
@@ -46,6 +50,41 @@ def test_create_default_config():
     assert config.region_name == ELB_DFLT_AWS_REGION
 
 
+def test_shared_boto_clients(aws_credentials):
+    """Test that boto3 clients are shared by service and configuration"""
+    client = get_boto_client('s3')
+    assert client is get_boto_client('s3')
+    assert client.meta.config.max_pool_connections == ELB_BOTO_MAX_POOL_CONNECTIONS
+
+    regional = get_boto_client('s3', create_aws_config('us-east-2'))
+    assert regional is get_boto_client('s3', create_aws_config('us-east-2'))
+    assert regional is not client
+    assert regional.meta.region_name == 'us-east-2'
+    assert regional is not get_boto_client('s3', create_aws_config('us-west-2'))
+    assert regional is not get_boto_client('batch', create_aws_config('us-east-2'))
+
+    resource = get_boto_resource('s3')
+    assert resource is get_boto_resource('s3')
+    assert resource is not client
+
+    # configurations are compared by value
+    retries = create_aws_config('us-east-2')
+    retries.retries = {'max_attempts': 10}
+    assert get_boto_resource('s3', create_aws_config('us-east-2')) is get_boto_resource('s3', create_aws_config('us-east-2'))
+    assert get_boto_client('s3', retries) is not regional
+
+    # each thread has its own resources
+    other = []
+    thread = threading.Thread(target=lambda: other.append(get_boto_resource('s3')))
+    thread.start()
+    thread.join()
+    assert other[0] is not resource
+
+    clear_boto_cache()
+    assert client is not get_boto_client('s3')
+    assert resource is not get_boto_resource('s3')
+
+
 @pytest.mark.skipif(os.getenv('TEAMCITY_VERSION') is not None, reason='AWS credentials not set in TC')
 def test_get_regions():
     regions = get_regions()
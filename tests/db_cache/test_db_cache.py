@@ -0,0 +1,134 @@
+#                           PUBLIC DOMAIN NOTICE
+#              National Center for Biotechnology Information
+#
+# This software is a "United States Government Work" under the
+# terms of the United States Copyright Act.  It was written as part of
+# the authors' official duties as United States Government employees and
+# thus cannot be copyrighted.  This software is freely available
+# to the public for use.  The National Library of Medicine and the U.S.
+# Government have not placed any restriction on its use or reproduction.
+#
+# Although all reasonable efforts have been taken to ensure the accuracy
+# and reliability of the software and data, the NLM and the U.S.
+# Government do not and cannot warrant the performance or results that
+# may be obtained by using this software or data.  The NLM and the U.S.
+# Government disclaim all warranties, express or implied, including
+# warranties of performance, merchantability or fitness for any particular
+# purpose.
+#
+# Please cite NCBI in any work or product based on this material.
+
+"""
+Unit tests for the node-level BLAST database cache of search jobs
+
+"""
+
+import os
+import sys
+from collections import namedtuple
+import pytest
+
+# database cache module is shipped with the worker script in the docker image
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', '..', 'docker-blast'))
+import db_cache
+from db_cache import DbCache, db_cache_key
+
+DiskUsage = namedtuple('DiskUsage', ['total', 'used', 'free'])
+
+
+@pytest.fixture
+def cache_dir(tmpdir):
+    return str(tmpdir.join('db-cache'))
+
+
+def make_entry(cache_dir, name, last_used, verified=True):
+    """Create a cache entry last used at time last_used"""
+    path = os.path.join(cache_dir, name)
+    os.makedirs(path)
+    if verified:
+        marker = os.path.join(path, db_cache.DB_CACHE_VERIFIED)
+        open(marker, 'w').close()
+        os.utime(marker, (last_used, last_used))
+    os.utime(path, (last_used, last_used))
+
+
+@pytest.fixture
+def disk(cache_dir, monkeypatch):
+    """Fake disk of 100 bytes where every cache entry takes 30 bytes"""
+    def disk_usage(path):
+        used = 30 * len([name for name in os.listdir(cache_dir)
+                         if os.path.isdir(os.path.join(cache_dir, name))])
+        return DiskUsage(100, used, 100 - used)
+    monkeypatch.setattr(db_cache.shutil, 'disk_usage', disk_usage)
+
+
+def test_db_cache_key():
+    """Test that each database version and location has its own entry"""
+    key = db_cache_key('nt', 'AWS', 'nucl', '1.0')
+    assert key.startswith('nt_')
+    assert db_cache_key('nt', 'AWS', 'nucl', '1.0') == key
+    assert len({key, db_cache_key('nt', 'AWS', 'nucl', '2.0'), db_cache_key('nt', 'GCP', 'nucl', '1.0'),
+                db_cache_key('nt', 'AWS', 'nucl', None)}) == 4
+    assert db_cache_key('s3://bucket/my db', 'AWS', 'prot', None).startswith('s3---bucket-my-db_')
+
+
+def test_cache_hit(cache_dir):
+    """Test that a cached database is not downloaded and checked again"""
+    filled = []
+
+    def fill(entry):
+        filled.append(entry)
+        open(os.path.join(entry, 'nt.00.nsq'), 'w').close()
+
+    key = db_cache_key('nt', 'AWS', 'nucl', '1.0')
+    entry = DbCache(cache_dir).get(key, fill)
+    assert filled == [entry]
+    marker = os.path.join(entry, db_cache.DB_CACHE_VERIFIED)
+    os.utime(marker, (1000, 1000))
+    assert DbCache(cache_dir).get(key, fill) == entry
+    assert len(filled) == 1
+    assert os.path.exists(os.path.join(entry, 'nt.00.nsq'))
+    # the hit is recorded as the last use
+    assert os.path.getmtime(marker) > 1000
+
+
+def test_failed_fill(cache_dir):
+    """Test that an entry whose download or check failed is filled again"""
+    key = db_cache_key('nt', 'AWS', 'nucl', '1.0')
+
+    def fail(entry):
+        open(os.path.join(entry, 'partial'), 'w').close()
+        raise RuntimeError('download failed')
+
+    with pytest.raises(RuntimeError):
+        DbCache(cache_dir).get(key, fail)
+    entry = DbCache(cache_dir).get(key, lambda entry: None)
+    assert os.listdir(entry) == [db_cache.DB_CACHE_VERIFIED]
+
+
+def test_eviction_order(cache_dir, disk):
+    """Test that least recently used entries are evicted only until enough
+    disk space is free"""
+    cache = DbCache(cache_dir, log=lambda message: None)
+    make_entry(cache_dir, 'recent', 300)
+    make_entry(cache_dir, 'oldest', 100)
+    make_entry(cache_dir, 'unverified', 200, verified=False)
+    make_entry(cache_dir, 'old', 150)
+    assert cache.evict('oldest') == ['old', 'unverified']
+    assert sorted(name for name in os.listdir(cache_dir) if '.' not in name) == ['oldest', 'recent']
+    assert cache.evict('new') == []
+
+
+def test_eviction_skips_entries_in_use(cache_dir, disk):
+    """Test that entries in use by other jobs are not evicted"""
+    make_entry(cache_dir, 'oldest', 100)
+    make_entry(cache_dir, 'old', 200)
+    make_entry(cache_dir, 'recent', 300)
+    other_job = DbCache(cache_dir)
+    other_job.lock('oldest')
+    cache = DbCache(cache_dir, log=lambda message: None)
+    assert cache.evict('new') == ['old']
+    make_entry(cache_dir, 'old', 250)
+    other_job.lock('recent')
+    # the lock on oldest was released
+    assert cache.evict('new') == ['oldest']
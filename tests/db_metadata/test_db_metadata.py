@@ -28,7 +28,7 @@ Created: Mon 27 Sep 2021 05:26:12 PM EDT
 import json
 import os
 from unittest.mock import MagicMock, patch
-from elastic_blast.db_metadata import get_db_metadata
+from elastic_blast.db_metadata import get_db_metadata, get_db_version, DbMetadata
 from elastic_blast.util import UserReportError
 from elastic_blast.constants import MolType, BLASTDB_ERROR
 from elastic_blast.base import DBSource
@@ -270,3 +270,17 @@ def test_malformed_json(gke_mock):
         db = get_db_metadata(DB, MolType.PROTEIN, DBSource.GCP, gcp_prj=GCP_PRJ)
     assert err.value.returncode == BLASTDB_ERROR
     assert 'is not a proper JSON file' in err.value.message
+
+
+def test_get_db_version():
+    """Test that database version changes with update time and file list, but
+    not with the order of files"""
+    metadata = DbMetadata.schema().loads(DB_METADATA)  # type: ignore
+    version = get_db_version(metadata)
+    assert version.startswith(metadata.last_updated)
+    metadata.files = list(reversed(metadata.files))
+    assert get_db_version(metadata) == version
+    metadata.files = metadata.files[1:]
+    fewer_files = get_db_version(metadata)
+    metadata.last_updated = 'later'
+    assert len({version, fewer_files, get_db_version(metadata)}) == 3
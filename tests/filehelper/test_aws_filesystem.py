@@ -117,6 +117,7 @@ def test_check_aws_for_write_failure():
     try:
         with filehelper.open_for_write(tn) as f:
             f.write('Test')
+        filehelper.copy_to_bucket()
     except:
         assert(True)
     else:
@@ -0,0 +1,107 @@
+#                           PUBLIC DOMAIN NOTICE
+#              National Center for Biotechnology Information
+#  
+# This software is a "United States Government Work" under the
+# terms of the United States Copyright Act.  It was written as part of
+# the authors' official duties as United States Government employees and
+# thus cannot be copyrighted.  This software is freely available
+# to the public for use.  The National Library of Medicine and the U.S.
+# Government have not placed any restriction on its use or reproduction.
+#   
+# Although all reasonable efforts have been taken to ensure the accuracy
+# and reliability of the software and data, the NLM and the U.S.
+# Government do not and cannot warrant the performance or results that
+# may be obtained by using this software or data.  The NLM and the U.S.
+# Government disclaim all warranties, express or implied, including
+# warranties of performance, merchantability or fitness for any particular
+# purpose.
+#   
+# Please cite NCBI in any work or product based on this material.
+
+
+"""
+Unit tests for uploading files written with filehelper.open_for_write to
+cloud buckets
+
+"""
+
+import os
+from unittest.mock import MagicMock
+from elastic_blast import filehelper
+from tests.utils import gke_mock
+
+
+def test_copy_to_bucket_s3(gke_mock):
+    """Test that files are uploaded as soon as they are closed"""
+    bucket_dir = 's3://test-results/query_batches'
+    filehelper.start_bucket_upload()
+    for i in range(5):
+        with filehelper.open_for_write(f'{bucket_dir}/batch_{i:03d}.fa') as f:
+            f.write(f'>seq{i}\nACGT\n')
+    filehelper.copy_to_bucket()
+
+    for i in range(5):
+        assert gke_mock.cloud.storage[f'{bucket_dir}/batch_{i:03d}.fa'] == f'>seq{i}\nACGT\n'
+    assert not filehelper.bucket_temp_dirs
+    assert not filehelper.bucket_uploader
+
+
+def test_copy_to_bucket_s3_not_started(gke_mock):
+    """Test that files are uploaded in copy_to_bucket if streaming upload
+    was not started"""
+    fname = 's3://test-results/query_batches/taxidlist.txt'
+    with filehelper.open_for_write(fname) as f:
+        f.write('9606\n')
+    assert fname not in gke_mock.cloud.storage
+    filehelper.copy_to_bucket()
+    assert gke_mock.cloud.storage[fname] == '9606\n'
+    assert not filehelper.bucket_temp_dirs
+
+
+def test_copy_to_bucket_gcs_groups(mocker):
+    """Test that files are uploaded to GCS in groups"""
+    safe_exec = mocker.patch('elastic_blast.filehelper.safe_exec')
+    mocker.patch('elastic_blast.filehelper.ELB_GCS_UPLOAD_GROUP_SIZE', 2)
+    bucket_dir = 'gs://test-results/query_batches'
+    filehelper.start_bucket_upload()
+    for i in range(5):
+        with filehelper.open_for_write(f'{bucket_dir}/batch_{i:03d}.fa') as f:
+            f.write(f'>seq{i}\nACGT\n')
+    filehelper.copy_to_bucket()
+
+    uploaded = []
+    assert safe_exec.call_count == 3
+    for call in safe_exec.call_args_list:
+        cmd = call.args[0]
+        assert cmd[:3] == ['gsutil', '-mq', 'cp']
+        assert cmd[-1] == bucket_dir + '/'
+        uploaded += [os.path.basename(fn) for fn in cmd[3:-1]]
+    assert sorted(uploaded) == [f'batch_{i:03d}.fa' for i in range(5)]
+    assert not filehelper.bucket_temp_dirs
+
+
+def test_copy_to_bucket_dry_run(mocker):
+    """Test that nothing is uploaded in dry-run mode"""
+    safe_exec = mocker.patch('elastic_blast.filehelper.safe_exec')
+    with filehelper.open_for_write('gs://test-results/query_batches/batch_000.fa') as f:
+        f.write('>seq\nACGT\n')
+    filehelper.copy_to_bucket(dry_run=True)
+    safe_exec.assert_not_called()
+    assert not filehelper.bucket_temp_dirs
+
+
+def test_copy_to_bucket_error(mocker):
+    """Test that upload errors are reported by copy_to_bucket"""
+    mocker.patch('elastic_blast.filehelper.safe_exec',
+                 side_effect=filehelper.SafeExecError(1, 'Mocked upload error'))
+    filehelper.start_bucket_upload()
+    with filehelper.open_for_write('gs://test-results/query_batches/batch_000.fa') as f:
+        f.write('>seq\nACGT\n')
+    try:
+        filehelper.copy_to_bucket()
+    except filehelper.SafeExecError as err:
+        assert 'Mocked upload error' in err.message
+    else:
+        assert False
+    filehelper.cleanup_temp_bucket_dirs()
+    assert not filehelper.bucket_temp_dirs
@@ -24,8 +24,10 @@ Unit tests for filehelper module
 Author: Victor Joukov joukovv@ncbi.nlm.nih.gov
 """
 
-import os, pytest
+import os, io, gzip, tarfile, pytest
 from elastic_blast import filehelper
+from elastic_blast.split import FASTAIndex
+from tests.utils import gsutil_stub
 
 TEST_DATA_DIR = os.path.join(os.path.dirname(__file__), 'data')
 
@@ -42,3 +44,62 @@ def test_tar_merge_read():
         contents = f.read()
         assert(contents == expected)
 
+
+
+def test_open_for_read_parallel(tmpdir, monkeypatch):
+    """Test that read ahead files are returned in order with the same
+    contents as open_for_read"""
+    monkeypatch.setattr(filehelper, 'ELB_READ_AHEAD_BLOCK_SIZE', 7)
+    monkeypatch.setattr(filehelper, 'ELB_TAR_PREFETCH_MAX_MEMBER_SIZE', 20)
+    plain = tmpdir.join('plain.fa')
+    plain.write('>seq1\nACGT\n')
+    gzipped = tmpdir.join('multi.fa.gz')
+    gzipped.write_binary(gzip.compress(b'>seq2\nACGT\n') + gzip.compress(b'>seq3\nTTTT\n'))
+    tgz = str(tmpdir.join('query.tar.gz'))
+    with tarfile.open(tgz, 'w:gz') as tar:
+        for i, data in enumerate([b'>seq4\nAC', gzip.compress(b'>seq5\nGGGG\n'),
+                                  b'>seq6\n' + b'A' * 30 + b'\n']):
+            info = tarfile.TarInfo(f'member{i}.fa' + ('.gz' if i == 1 else ''))
+            info.size = len(data)
+            tar.addfile(info, io.BytesIO(data))
+    fnames = [str(plain), str(gzipped), os.path.join(TEST_DATA_DIR, 'test.tar'), tgz]
+    contents = [f.read() for f in filehelper.open_for_read_parallel(fnames, num_files=2)]
+    assert contents == [b'>seq1\nACGT\n', b'>seq2\nACGT\n>seq3\nTTTT\n', expected.encode(),
+                        b'>seq4\nAC\n>seq5\nGGGG\n>seq6\n' + b'A' * 30 + b'\n']
+
+    truncated = tmpdir.join('truncated.fa.gz')
+    truncated.write_binary(gzip.compress(b'>seq1\nACGT\n')[:-10])
+    with pytest.raises(EOFError):
+        for f in filehelper.open_for_read_parallel([str(truncated)]):
+            f.read()
+
+
+def test_open_for_read_parallel_error(monkeypatch, tmpdir):
+    """Test that errors from the process reading a file are available after
+    the file is closed"""
+    monkeypatch.setattr(filehelper, '_open_raw',
+                        lambda *args, **kwargs: (io.BytesIO(b''), lambda: 'No URLs matched'))
+    with pytest.raises(FileNotFoundError, match='No URLs matched'):
+        with FASTAIndex(filehelper.open_for_read_parallel(['gs://test-bucket/query.fa'])) as index:
+            index.read()
+
+
+def test_open_for_read_parallel_gsutil(gsutil_stub):
+    """Test that a failure of gsutil reading a file is reported, and that
+    gsutil processes and their pipes are released when files are closed"""
+    for i in range(30):
+        gsutil_stub.join(f'bucket/results/batch_{i:03d}.out').write_binary(b'x' * i, ensure=True)
+    fnames = [f'gs://bucket/results/batch_{i:03d}.out' for i in range(30)]
+    num_fds = len(os.listdir('/proc/self/fd'))
+    num_error_funcs = len(filehelper.error_report_funcs)
+    contents = [f.read() for f in filehelper.open_for_read_parallel(fnames, num_files=4, uncompress=False)]
+    assert contents == [b'x' * i for i in range(30)]
+    assert len(os.listdir('/proc/self/fd')) == num_fds
+    assert len(filehelper.error_report_funcs) == num_error_funcs
+
+    files = filehelper.open_for_read_parallel(fnames[:1] + ['gs://bucket/results/missing.out'])
+    assert next(files).read() == b''
+    with pytest.raises(FileNotFoundError, match='No URLs matched'):
+        next(files).read()
+    files.close()
+    assert len(os.listdir('/proc/self/fd')) == num_fds
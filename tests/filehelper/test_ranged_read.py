@@ -0,0 +1,86 @@
+#                           PUBLIC DOMAIN NOTICE
+#              National Center for Biotechnology Information
+#
+# This software is a "United States Government Work" under the
+# terms of the United States Copyright Act.  It was written as part of
+# the authors' official duties as United States Government employees and
+# thus cannot be copyrighted.  This software is freely available
+# to the public for use.  The National Library of Medicine and the U.S.
+# Government have not placed any restriction on its use or reproduction.
+#
+# Although all reasonable efforts have been taken to ensure the accuracy
+# and reliability of the software and data, the NLM and the U.S.
+# Government do not and cannot warrant the performance or results that
+# may be obtained by using this software or data.  The NLM and the U.S.
+# Government disclaim all warranties, express or implied, including
+# warranties of performance, merchantability or fitness for any particular
+# purpose.
+#
+# Please cite NCBI in any work or product based on this material.
+
+"""
+Unit tests for reading S3 objects with concurrent ranged requests
+
+"""
+
+import boto3
+import pytest
+from moto import mock_s3  # type: ignore
+from elastic_blast import filehelper
+from elastic_blast import aws_traits
+from elastic_blast.split import FASTAReader
+from tests.utils import aws_credentials
+
+BUCKET = 'test-bucket'
+DATA = b''.join(f'>seq{i}\nACGTACGTAC\n'.encode() for i in range(100))
+
+
+@pytest.fixture
+def s3_bucket(aws_credentials, monkeypatch):
+    """Mocked S3 bucket with a query file"""
+    monkeypatch.setattr(filehelper, 'ELB_RANGED_READ_MIN_SIZE', 100)
+    monkeypatch.setattr(filehelper, 'ELB_RANGED_READ_BLOCK_SIZE', 64)
+    monkeypatch.setattr(aws_traits, '_boto_objects', {})
+    with mock_s3():
+        s3 = boto3.client('s3', region_name='us-east-1')
+        s3.create_bucket(Bucket=BUCKET)
+        s3.put_object(Bucket=BUCKET, Key='query.fa', Body=DATA)
+        s3.put_object(Bucket=BUCKET, Key='small.fa', Body=b'>seq\nACGT\n')
+        yield f's3://{BUCKET}'
+
+
+def test_ranged_reader():
+    """Test that blocks are returned in order and short reads are detected"""
+    data = bytes(range(256)) * 10
+    reader = filehelper.RangedReader(lambda start, end: data[start:end], len(data),
+                                     num_threads=3, block_size=100)
+    assert reader.readall() == data
+    reader.close()
+    reader = filehelper.RangedReader(lambda start, end: data[start:end-1], len(data),
+                                     num_threads=3, block_size=100)
+    with pytest.raises(EOFError):
+        reader.readall()
+    reader.close()
+
+
+def test_open_for_read_ranged_s3(s3_bucket, tmpdir):
+    """Test reading an S3 object with ranged requests into FASTAReader"""
+    with filehelper.open_for_read(f'{s3_bucket}/query.fa', ranged=True) as f:
+        assert isinstance(f.buffer.raw, filehelper.RangedReader)
+        reader = FASTAReader(f, 200, str(tmpdir))
+        total, batches = reader.read_and_cut()
+    assert total == 1000
+    assert b''.join(open(name, 'rb').read() for name in batches) == DATA
+    with filehelper.open_for_read(f'{s3_bucket}/small.fa', ranged=True) as f:
+        assert not isinstance(getattr(f.buffer, 'raw', None), filehelper.RangedReader)
+        assert f.read() == '>seq\nACGT\n'
+
+
+def test_open_for_read_ranged_s3_modified(s3_bucket, monkeypatch):
+    """Test that an object overwritten during a ranged read is reported"""
+    monkeypatch.setattr(filehelper, 'ELB_RANGED_READ_THREADS', 1)
+    with filehelper.open_for_read(f'{s3_bucket}/query.fa', ranged=True) as f:
+        boto3.client('s3', region_name='us-east-1').put_object(Bucket=BUCKET, Key='query.fa',
+                                                               Body=DATA.lower())
+        with pytest.raises(OSError, match='modified'):
+            f.read()
@@ -0,0 +1,303 @@
+#                           PUBLIC DOMAIN NOTICE
+#              National Center for Biotechnology Information
+#
+# This software is a "United States Government Work" under the
+# terms of the United States Copyright Act.  It was written as part of
+# the authors' official duties as United States Government employees and
+# thus cannot be copyrighted.  This software is freely available
+# to the public for use.  The National Library of Medicine and the U.S.
+# Government have not placed any restriction on its use or reproduction.
+#
+# Although all reasonable efforts have been taken to ensure the accuracy
+# and reliability of the software and data, the NLM and the U.S.
+# Government do not and cannot warrant the performance or results that
+# may be obtained by using this software or data.  The NLM and the U.S.
+# Government disclaim all warranties, express or implied, including
+# warranties of performance, merchantability or fitness for any particular
+# purpose.
+#
+# Please cite NCBI in any work or product based on this material.
+
+"""
+Unit tests for in-process GCS client, run against a local fake GCS server
+
+"""
+
+import re
+import errno
+import gzip
+import zlib
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs, unquote
+from elastic_blast import gcs
+from elastic_blast import filehelper
+from elastic_blast import util
+from elastic_blast.util import get_blastdb_info
+import pytest
+
+FORBIDDEN_BUCKET = 'forbidden'
+LIST_PAGE_SIZE = 2
+
+
+class FakeGCSHandler(BaseHTTPRequestHandler):
+    """Implements the subset of GCS JSON API used by elastic-blast"""
+
+    def log_message(self, *args):
+        pass
+
+    def _reply(self, status, body=b'', content_type='application/json'):
+        if isinstance(body, dict):
+            body = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _error(self, status):
+        self._reply(status, {'error': {'code': status, 'message': 'fake error'}})
+
+    def _parse(self):
+        url = urlparse(self.path)
+        query = {k: v[0] for k, v in parse_qs(url.query).items()}
+        return url.path, query
+
+    def do_GET(self):
+        path, query = self._parse()
+        objects = self.server.objects
+        mo = re.match(r'^/storage/v1/b/([^/]+)/o/([^/]+)$', path)
+        if mo:
+            key = (unquote(mo.group(1)), unquote(mo.group(2)))
+            if key not in objects:
+                return self._error(404)
+            data = objects[key]
+            # object generation changes whenever the object is overwritten
+            generation = str(zlib.crc32(data))
+            if query.get('generation', generation) != generation:
+                return self._error(404)
+            if query.get('alt') != 'media':
+                return self._reply(200, {'bucket': key[0], 'name': key[1], 'size': str(len(data)),
+                                         'generation': generation})
+            rng = self.headers.get('Range')
+            if rng:
+                start, _, last = rng[len('bytes='):].partition('-')
+                end = int(last) + 1 if last else len(data)
+                return self._reply(206, data[int(start):end], 'application/octet-stream')
+            return self._reply(200, data, 'application/octet-stream')
+        mo = re.match(r'^/storage/v1/b/([^/]+)/o$', path)
+        if mo:
+            bucket = unquote(mo.group(1))
+            prefix = query.get('prefix', '')
+            delimiter = query.get('delimiter')
+            names = sorted(name for b, name in objects if b == bucket and name.startswith(prefix)
+                           and not (delimiter and delimiter in name[len(prefix):]))
+            start = int(query.get('pageToken', 0))
+            listing = {'items': [{'name': name} for name in names[start:start+LIST_PAGE_SIZE]]}
+            if start + LIST_PAGE_SIZE < len(names):
+                listing['nextPageToken'] = str(start + LIST_PAGE_SIZE)
+            return self._reply(200, listing)
+        self._error(400)
+
+    def do_POST(self):
+        path, query = self._parse()
+        objects = self.server.objects
+        body = self.rfile.read(int(self.headers['Content-Length']))
+        mo = re.match(r'^/upload/storage/v1/b/([^/]+)/o$', path)
+        if mo:
+            bucket = unquote(mo.group(1))
+            if bucket == FORBIDDEN_BUCKET:
+                return self._error(403)
+            objects[(bucket, query['name'])] = body
+            return self._reply(200, {'bucket': bucket, 'name': query['name'], 'size': str(len(body))})
+        mo = re.match(r'^/storage/v1/b/([^/]+)/o/([^/]+)/compose$', path)
+        if mo:
+            bucket = unquote(mo.group(1))
+            sources = [(bucket, src['name']) for src in json.loads(body)['sourceObjects']]
+            if any(src not in objects for src in sources):
+                return self._error(404)
+            objects[(bucket, unquote(mo.group(2)))] = b''.join(objects[src] for src in sources)
+            return self._reply(200, {})
+        self._error(400)
+
+    def do_DELETE(self):
+        path, _ = self._parse()
+        mo = re.match(r'^/storage/v1/b/([^/]+)/o/([^/]+)$', path)
+        key = (unquote(mo.group(1)), unquote(mo.group(2)))
+        if key not in self.server.objects:
+            return self._error(404)
+        del self.server.objects[key]
+        self._reply(204)
+
+
+@pytest.fixture
+def gcs_server(monkeypatch):
+    """Start a fake GCS server, point the in-process GCS client to it, and
+    make sure gsutil is not used. Yields the dictionary of stored objects
+    keyed by (bucket, name)."""
+    server = ThreadingHTTPServer(('127.0.0.1', 0), FakeGCSHandler)
+    server.objects = {}
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    monkeypatch.setenv('STORAGE_EMULATOR_HOST', f'127.0.0.1:{server.server_port}')
+
+    def no_gsutil(*args, **kwargs):
+        raise AssertionError(f'Unexpected external command: {args}')
+
+    monkeypatch.setattr(filehelper, 'safe_exec', no_gsutil)
+    monkeypatch.setattr(util, 'safe_exec', no_gsutil)
+    monkeypatch.setattr(filehelper.subprocess, 'Popen', no_gsutil)
+    gcs.clear_gcs_client()
+    yield server.objects
+    gcs.clear_gcs_client()
+    server.shutdown()
+    server.server_close()
+
+
+def test_native_gcs_disabled(monkeypatch):
+    """Test that gsutil is used if requested"""
+    monkeypatch.setenv('ELB_USE_GSUTIL', '1')
+    monkeypatch.setenv('GOOGLE_OAUTH_ACCESS_TOKEN', 'test-token')
+    monkeypatch.delenv('STORAGE_EMULATOR_HOST', raising=False)
+    gcs.clear_gcs_client()
+    assert gcs.get_gcs_client() is None
+    gcs.clear_gcs_client()
+
+
+def test_native_gcs_default(monkeypatch):
+    """Test that the in-process client is used by default, unless no access
+    token can be obtained"""
+    monkeypatch.delenv('ELB_USE_GSUTIL', raising=False)
+    monkeypatch.delenv('STORAGE_EMULATOR_HOST', raising=False)
+    monkeypatch.setenv('GOOGLE_OAUTH_ACCESS_TOKEN', 'test-token')
+    gcs.clear_gcs_client()
+    assert isinstance(gcs.get_gcs_client(), gcs.GCSClient)
+
+    def no_gcloud(*args, **kwargs):
+        raise FileNotFoundError(errno.ENOENT, 'No such file or directory', 'gcloud')
+
+    monkeypatch.delenv('GOOGLE_OAUTH_ACCESS_TOKEN')
+    monkeypatch.setattr(gcs.subprocess, 'run', no_gcloud)
+    gcs.clear_gcs_client()
+    assert gcs.get_gcs_client() is None
+    gcs.clear_gcs_client()
+
+
+def test_open_for_read(gcs_server):
+    """Test streaming, ranged, and compressed reads"""
+    gcs_server[('test-bucket', 'queries/query.fa')] = b'>seq1\nACGT\n'
+    gcs_server[('test-bucket', 'queries/query.fa.gz')] = gzip.compress(b'>seq2\nTTTT\n')
+    with filehelper.open_for_read('gs://test-bucket/queries/query.fa') as f:
+        assert f.read() == '>seq1\nACGT\n'
+    with filehelper.open_for_read('gs://test-bucket/queries/query.fa.gz') as f:
+        assert f.read() == '>seq2\nTTTT\n'
+    client = gcs.get_gcs_client()
+    assert client.read('gs://test-bucket/queries/query.fa', 6, 10) == b'ACGT'
+    assert client.read('gs://test-bucket/queries/query.fa', 6) == b'ACGT\n'
+    with pytest.raises(FileNotFoundError):
+        filehelper.open_for_read('gs://test-bucket/queries/missing.fa')
+
+
+def test_check_for_read_and_get_length(gcs_server):
+    """Test object stat"""
+    gcs_server[('test-bucket', 'query.fa')] = b'>seq1\nACGT\n'
+    filehelper.check_for_read('gs://test-bucket/query.fa', print_file_size=True)
+    assert filehelper.get_length('gs://test-bucket/query.fa') == 11
+    with pytest.raises(FileNotFoundError):
+        filehelper.check_for_read('gs://test-bucket/missing.fa')
+    with pytest.raises(FileNotFoundError):
+        filehelper.get_length('gs://test-bucket/missing.fa')
+
+
+def test_check_dir_for_write(gcs_server):
+    """Test that write check leaves no probe file behind"""
+    filehelper.check_dir_for_write('gs://test-bucket/results')
+    assert not gcs_server
+    with pytest.raises(PermissionError):
+        filehelper.check_dir_for_write(f'gs://{FORBIDDEN_BUCKET}/results')
+
+
+def test_remove_bucket_key(gcs_server):
+    """Test that only objects directly under the key are removed, across
+    several list pages"""
+    for i in range(5):
+        gcs_server[('test-bucket', f'results/metadata/file{i}')] = b'x'
+    gcs_server[('test-bucket', 'results/metadata/subdir/file')] = b'x'
+    gcs_server[('test-bucket', 'results/batch_000.out.gz')] = b'x'
+    filehelper.remove_bucket_key('gs://test-bucket/results/metadata')
+    assert sorted(gcs_server.keys()) == [('test-bucket', 'results/batch_000.out.gz'),
+                                         ('test-bucket', 'results/metadata/subdir/file')]
+
+
+def test_upload_file_to_gcs(gcs_server, tmpdir, monkeypatch):
+    """Test simple and parallel composite uploads"""
+    monkeypatch.setattr(gcs, 'ELB_GCS_COMPOSITE_UPLOAD_THRESHOLD', 100)
+    monkeypatch.setattr(gcs, 'ELB_GCS_MAX_COMPOSE_COMPONENTS', 4)
+    small = tmpdir.join('small.txt')
+    small.write('small file')
+    filehelper.upload_file_to_gcs(str(small), 'gs://test-bucket/results/')
+    assert gcs_server[('test-bucket', 'results/small.txt')] == b'small file'
+
+    data = bytes(range(256)) * 3 + b'tail'
+    large = tmpdir.join('large.bin')
+    large.write_binary(data)
+    filehelper.upload_file_to_gcs(str(large), 'gs://test-bucket/results/large.bin')
+    assert gcs_server[('test-bucket', 'results/large.bin')] == data
+    # components were removed
+    assert len(gcs_server) == 2
+
+
+def test_open_for_write(gcs_server):
+    """Test immediate and deferred writes"""
+    with filehelper.open_for_write_immediate('gs://test-bucket/metadata/num_jobs') as f:
+        f.write('10')
+    assert gcs_server[('test-bucket', 'metadata/num_jobs')] == b'10'
+
+    filehelper.start_bucket_upload()
+    for i in range(3):
+        with filehelper.open_for_write(f'gs://test-bucket/query_batches/batch_{i:03d}.fa') as f:
+            f.write(f'>seq{i}\nACGT\n')
+    filehelper.copy_to_bucket()
+    for i in range(3):
+        assert gcs_server[('test-bucket', f'query_batches/batch_{i:03d}.fa')] == f'>seq{i}\nACGT\n'.encode()
+
+
+def test_get_blastdb_info(gcs_server):
+    """Test custom BLAST database lookup"""
+    gcs_server[('test-bucket', 'db/mydb.tar.gz')] = b'x'
+    gcs_server[('test-bucket', 'db/mydb.tar.gz.md5')] = b'x'
+    gcs_server[('test-bucket', 'db/other.tar.gz')] = b'x'
+    gcs_server[('test-bucket', 'db2/mydb.nal')] = b'x'
+    assert get_blastdb_info('gs://test-bucket/db/mydb') == ('mydb', 'gs://test-bucket/db/mydb.tar.gz', 'mydb')
+    assert get_blastdb_info('gs://test-bucket/db2/mydb') == ('mydb', 'gs://test-bucket/db2/mydb.*', 'mydb')
+    with pytest.raises(ValueError):
+        get_blastdb_info('gs://test-bucket/db/missing')
+
+
+def test_open_for_read_ranged(gcs_server, monkeypatch):
+    """Test that large objects are read with concurrent ranged requests"""
+    monkeypatch.setattr(filehelper, 'ELB_RANGED_READ_MIN_SIZE', 100)
+    monkeypatch.setattr(filehelper, 'ELB_RANGED_READ_BLOCK_SIZE', 16)
+    data = b''.join(f'>seq{i}\nACGTACGT\n'.encode() for i in range(50))
+    gcs_server[('test-bucket', 'queries/query.fa')] = data
+    gcs_server[('test-bucket', 'queries/query.fa.gz')] = gzip.compress(data)
+    with filehelper.open_for_read('gs://test-bucket/queries/query.fa', ranged=True) as f:
+        assert isinstance(f.buffer.raw, filehelper.RangedReader)
+        assert f.read() == data.decode()
+    contents = [f.read() for f in filehelper.open_for_read_parallel(['gs://test-bucket/queries/query.fa.gz',
+                                                                     'gs://test-bucket/queries/query.fa'])]
+    assert contents == [data, data]
+
+
+def test_open_for_read_ranged_modified(gcs_server, monkeypatch):
+    """Test that an object overwritten during a ranged read is reported"""
+    monkeypatch.setattr(filehelper, 'ELB_RANGED_READ_MIN_SIZE', 100)
+    monkeypatch.setattr(filehelper, 'ELB_RANGED_READ_BLOCK_SIZE', 16)
+    monkeypatch.setattr(filehelper, 'ELB_RANGED_READ_THREADS', 1)
+    data = b''.join(f'>seq{i}\nACGTACGT\n'.encode() for i in range(50))
+    gcs_server[('test-bucket', 'queries/query.fa')] = data
+    with filehelper.open_for_read('gs://test-bucket/queries/query.fa', ranged=True) as f:
+        gcs_server[('test-bucket', 'queries/query.fa')] = data.lower()
+        with pytest.raises(OSError, match='modified'):
+            f.read()
@@ -25,7 +25,7 @@
 
 
 import os
-from elastic_blast.jobs import read_job_template, write_job_files
+from elastic_blast.jobs import read_job_template, write_job_files, write_indexed_job_file
 from tempfile import TemporaryDirectory
 import pytest  # type: ignore
 
@@ -63,6 +63,24 @@ $SOME_UNDEFINED_VARIABLE"""
         assert job_text == expected
 
 
+def test_single_job_file(test_dir):
+    """Test writing all jobs to one multi-document file"""
+    queries = [f'gs://test-bucket/query_batches/batch_{i:03d}.fa' for i in range(3)]
+    template = read_job_template()
+    jobs = write_job_files(test_dir, 'batch_', template, queries, ELB_BLAST_PROGRAM='blastn',
+                           ELB_DB_LABEL='nt')
+    single = write_job_files(test_dir, 'batch_', template, queries, single_file=True,
+                             ELB_BLAST_PROGRAM='blastn', ELB_DB_LABEL='nt')
+    assert single == [os.path.join(test_dir, 'batch_all.yaml')]
+    docs = []
+    for job in jobs:
+        with open(job) as f:
+            docs.append(f.read())
+    with open(single[0]) as f:
+        assert f.read() == ''.join(docs)
+    assert 'name: blastn-batch-nt-job-002' in docs[2]
+
+
 def test_default_template():
     job_template = read_job_template()
     assert type(job_template) == str
@@ -72,3 +90,27 @@ def test_default_template():
 def test_missing_template():
     with pytest.raises(FileNotFoundError):
         read_job_template('some_wild_and_non_existing_name.template')
+
+
+def test_indexed_job(test_dir):
+    queries = [f'gs://test-bucket/query_batches/batch_{i:03d}.fa' for i in range(5)]
+    template = read_job_template(indexed=True)
+    job = write_indexed_job_file(test_dir, 'batch_', template, queries, 3, ELB_BLAST_PROGRAM='blastn')
+    with open(job) as f:
+        job_text = f.read()
+    assert 'completionMode: Indexed' in job_text
+    assert 'completions: 5\n' in job_text
+    assert 'parallelism: 3\n' in job_text
+    assert 'backoffLimit: 15\n' in job_text
+    assert 'name: blastn-batch-' in job_text
+    # query batch number is set in the pod from its completion index
+    assert '${JOB_NUM}' in job_text
+    assert '${JOB_COMPLETION_INDEX}' in job_text
+
+    # parallelism does not exceed the number of query batches
+    job = write_indexed_job_file(test_dir, 'batch_', template, queries, 100)
+    with open(job) as f:
+        assert 'parallelism: 5\n' in f.read()
+
+    # query batch numbers must match completion indices
+    assert write_indexed_job_file(test_dir, 'batch_', template, queries[1:], 3) is None
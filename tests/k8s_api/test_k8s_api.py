@@ -0,0 +1,468 @@
+#                           PUBLIC DOMAIN NOTICE
+#              National Center for Biotechnology Information
+#
+# This software is a "United States Government Work" under the
+# terms of the United States Copyright Act.  It was written as part of
+# the authors' official duties as United States Government employees and
+# thus cannot be copyrighted.  This software is freely available
+# to the public for use.  The National Library of Medicine and the U.S.
+# Government have not placed any restriction on its use or reproduction.
+#
+# Although all reasonable efforts have been taken to ensure the accuracy
+# and reliability of the software and data, the NLM and the U.S.
+# Government do not and cannot warrant the performance or results that
+# may be obtained by using this software or data.  The NLM and the U.S.
+# Government disclaim all warranties, express or implied, including
+# warranties of performance, merchantability or fitness for any particular
+# purpose.
+#
+# Please cite NCBI in any work or product based on this material.
+
+"""
+Unit tests for in-process Kubernetes API client, run against a local fake
+Kubernetes API server
+
+"""
+
+import os
+import re
+import json
+import time
+import threading
+from argparse import Namespace
+from pathlib import Path
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs, unquote
+import yaml
+from tenacity import wait_none
+from elastic_blast import k8s_api
+from elastic_blast import kubernetes
+from elastic_blast import gcp
+from elastic_blast.config import configure
+from elastic_blast.elb_config import ElasticBlastConfig
+from elastic_blast.constants import ElbCommand, ElbStatus, ELB_K8S_API_APPLY_THREADS
+from elastic_blast.jobs import read_job_template, write_job_files
+from tests.utils import gke_mock
+import pytest
+
+K8S_CTX = 'test-context'
+TOKEN = 'test-token'
+NAMESPACE_PATH = '/namespaces/default'
+JOBS = f'/apis/batch/v1{NAMESPACE_PATH}/jobs'
+PODS = f'/api/v1{NAMESPACE_PATH}/pods'
+PVCS = f'/api/v1{NAMESPACE_PATH}/persistentvolumeclaims'
+PVS = '/api/v1/persistentvolumes'
+SNAPSHOTS = f'/apis/snapshot.storage.k8s.io/v1{NAMESPACE_PATH}/volumesnapshots'
+STATUS_INI = os.path.join(os.path.dirname(__file__), '..', 'status', 'data', 'status-test.ini')
+
+
+class FakeK8sHandler(BaseHTTPRequestHandler):
+    """Implements the subset of Kubernetes API used by elastic-blast.
+    Objects are stored by their API path."""
+
+    # needed for chunked watch responses
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *args):
+        pass
+
+    def _reply(self, status, body=None, content_type='application/json'):
+        if isinstance(body, (dict, list)):
+            body = json.dumps(body).encode()
+        body = body or b''
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _error(self, status):
+        self._reply(status, {'kind': 'Status', 'code': status, 'message': 'fake error'})
+
+    def _parse(self):
+        self.server.requests.append((self.command, self.path))
+        if self.headers.get('Authorization') != f'Bearer {TOKEN}':
+            return None, None
+        url = urlparse(self.path)
+        query = {k: v[0] for k, v in parse_qs(url.query).items()}
+        return unquote(url.path), query
+
+    @staticmethod
+    def _is_collection(path):
+        return path.rsplit('/', 1)[1] in [plural for plural, _ in k8s_api.K8S_RESOURCES.values()]
+
+    def _select(self, path, query):
+        """Objects in collection path selected by labels and fields"""
+        items = []
+        for obj_path, obj in sorted(self.server.objects.items()):
+            if obj_path.rsplit('/', 1)[0] != path:
+                continue
+            labels = obj['metadata'].get('labels', {})
+            if 'labelSelector' in query:
+                mo = re.match(r'^(\w+) in \((.*)\)$', query['labelSelector'])
+                if mo:
+                    key, values = mo.group(1), mo.group(2).split(',')
+                else:
+                    key, _, value = query['labelSelector'].partition('=')
+                    values = [value]
+                if labels.get(key) not in values:
+                    continue
+            if query.get('fieldSelector') == 'status.phase=Running' and \
+                    obj.get('status', {}).get('phase') != 'Running':
+                continue
+            if query.get('fieldSelector', '').startswith('metadata.name=') and \
+                    query['fieldSelector'] != f'metadata.name={obj["metadata"]["name"]}':
+                continue
+            items.append((obj_path, obj))
+        return items
+
+    def _watch(self, path, query):
+        """Stream changes of objects in collection path made after the
+        given resource version, see update_object"""
+        name = query['fieldSelector'][len('metadata.name='):]
+        start = int(query['resourceVersion'])
+        deadline = time.monotonic() + int(query['timeoutSeconds'])
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Transfer-Encoding', 'chunked')
+        self.end_headers()
+        with self.server.changed:
+            while time.monotonic() < deadline:
+                for version, obj_path, obj in self.server.events[start:]:
+                    if obj_path == f'{path}/{name}':
+                        obj = dict(obj, metadata=dict(obj['metadata'], resourceVersion=str(version)))
+                        line = json.dumps({'type': 'MODIFIED', 'object': obj}).encode() + b'\n'
+                        self.wfile.write(b'%x\r\n%s\r\n' % (len(line), line))
+                        self.wfile.flush()
+                start = len(self.server.events)
+                self.server.changed.wait(deadline - time.monotonic())
+        self.wfile.write(b'0\r\n\r\n')
+
+    def do_GET(self):
+        path, query = self._parse()
+        if path is None:
+            return self._error(401)
+        if query.get('watch') == 'true':
+            return self._watch(path, query)
+        if path == '/version':
+            return self._reply(200, {'major': '1', 'minor': '24'})
+        if path.endswith('/log'):
+            pod = self.server.objects.get(path[:-len('/log')])
+            if not pod:
+                return self._error(404)
+            logs = pod['logs'].get(query['container'])
+            if logs is None:
+                return self._error(400)
+            return self._reply(200, logs.encode(), 'text/plain')
+        if path in self.server.objects:
+            return self._reply(200, self.server.objects[path])
+        if not self._is_collection(path):
+            return self._error(404)
+        items = self._select(path, query)
+        start = int(query.get('continue', 0))
+        limit = int(query.get('limit', len(items)))
+        page = {'items': [obj for _, obj in items[start:start+limit]],
+                'metadata': {'resourceVersion': str(len(self.server.events))}}
+        if start + limit < len(items):
+            page['metadata']['continue'] = str(start + limit)
+        self._reply(200, page)
+
+    def do_PATCH(self):
+        path, query = self._parse()
+        if path is None:
+            return self._error(401)
+        body = self.rfile.read(int(self.headers['Content-Length']))
+        content_type = self.headers['Content-Type']
+        if self.server.failures.get(path):
+            return self._error(self.server.failures[path].pop(0))
+        if content_type == 'application/apply-patch+yaml':
+            assert query['fieldManager'] == 'elastic-blast'
+            with self.server.lock:
+                self.server.active += 1
+                self.server.max_active = max(self.server.max_active, self.server.active)
+            time.sleep(self.server.apply_delay)
+            with self.server.lock:
+                self.server.active -= 1
+            obj = yaml.safe_load(body)
+            assert obj['metadata']['name'] == path.rsplit('/', 1)[1]
+            self.server.objects[path] = obj
+        elif content_type == 'application/merge-patch+json':
+            if path not in self.server.objects:
+                return self._error(404)
+            patch = json.loads(body)
+            self.server.objects[path]['metadata'].update(patch['metadata'])
+        else:
+            return self._error(415)
+        self._reply(200, self.server.objects[path])
+
+    def do_DELETE(self):
+        path, query = self._parse()
+        if path is None:
+            return self._error(401)
+        if path in self.server.objects:
+            return self._reply(200, self.server.objects.pop(path))
+        if not self._is_collection(path):
+            return self._error(404)
+        items = self._select(path, query)
+        for obj_path, _ in items:
+            del self.server.objects[obj_path]
+        self._reply(200, {'items': [obj for _, obj in items]})
+
+
+@pytest.fixture
+def k8s_server(monkeypatch):
+    """Start a fake Kubernetes API server and point the in-process
+    Kubernetes API client to it. Yields the server; its objects attribute is
+    a dictionary of stored objects keyed by API path, requests is a list of
+    received requests, failures is a dictionary of HTTP error statuses
+    returned for PATCH requests before they succeed, keyed by API path, and
+    max_active is the largest number of concurrent applies."""
+    server = ThreadingHTTPServer(('127.0.0.1', 0), FakeK8sHandler)
+    server.objects = {}
+    server.requests = []
+    server.failures = {}
+    server.lock = threading.Lock()
+    server.active = 0
+    server.max_active = 0
+    server.apply_delay = 0
+    server.events = []
+    server.changed = threading.Condition()
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    kubeconfig = {'clusters': [{'name': 'test', 'cluster': {'server': f'http://127.0.0.1:{server.server_port}'}}],
+                  'users': [{'name': 'test', 'user': {'token': TOKEN}}],
+                  'contexts': [{'name': K8S_CTX, 'context': {'cluster': 'test', 'user': 'test'}}]}
+    monkeypatch.setenv('ELB_USE_K8S_API', '1')
+    monkeypatch.setenv('ELB_PAUSE_AFTER_INIT_PV', '0')
+    monkeypatch.setattr(k8s_api, '_load_kubeconfig', lambda ctx: kubeconfig)
+
+    def no_kubectl(*args, **kwargs):
+        raise AssertionError(f'Unexpected external command: {args}')
+
+    monkeypatch.setattr(kubernetes, 'safe_exec', no_kubectl)
+    k8s_api.clear_k8s_clients()
+    yield server
+    k8s_api.clear_k8s_clients()
+    server.shutdown()
+    server.server_close()
+
+
+def add_object(server, path, name, labels=None, status=None, **kwargs):
+    """Store an object in fake Kubernetes API server"""
+    obj = {'metadata': {'name': name, 'labels': labels or {}}, 'status': status or {}}
+    obj.update(kwargs)
+    server.objects[f'{path}/{name}'] = obj
+
+
+def update_object(server, path, name, status):
+    """Change status of an object in fake Kubernetes API server and notify
+    watches"""
+    with server.changed:
+        obj = server.objects[f'{path}/{name}']
+        obj['status'] = status
+        server.events.append((len(server.events) + 1, f'{path}/{name}', obj))
+        server.changed.notify_all()
+
+
+def test_k8s_api_disabled(monkeypatch):
+    """Test that kubectl is used unless the in-process client is requested"""
+    monkeypatch.delenv('ELB_USE_K8S_API', raising=False)
+    k8s_api.clear_k8s_clients()
+    assert k8s_api.get_k8s_client(K8S_CTX) is None
+
+
+def test_unsupported_credentials(monkeypatch):
+    """Test fall back to kubectl for credentials the client cannot use"""
+    monkeypatch.setenv('ELB_USE_K8S_API', '1')
+    kubeconfig = {'clusters': [{'cluster': {'server': 'https://127.0.0.1'}}],
+                  'users': [{'user': {'client-certificate': '/some/file'}}]}
+    monkeypatch.setattr(k8s_api, '_load_kubeconfig', lambda ctx: kubeconfig)
+    k8s_api.clear_k8s_clients()
+    assert k8s_api.get_k8s_client(K8S_CTX) is None
+    k8s_api.clear_k8s_clients()
+
+
+def test_parse_manifest_header():
+    """Test reading object kind and name from YAML manifests"""
+    manifests = k8s_api.split_manifests("""---
+# comment
+---
+apiVersion: batch/v1
+kind: Job
+metadata:
+  labels:
+    name: label-name
+  name: "job-name"
+spec:
+  template:
+    metadata:
+      name: pod-name
+---
+apiVersion: v1
+kind: PersistentVolumeClaim
+metadata:
+  namespace: other
+  name: pvc-name
+""")
+    assert len(manifests) == 2
+    assert k8s_api.parse_manifest_header(manifests[0]) == ('batch/v1', 'Job', 'job-name', None)
+    assert k8s_api.parse_manifest_header(manifests[1]) == ('v1', 'PersistentVolumeClaim', 'pvc-name', 'other')
+    with pytest.raises(ValueError):
+        k8s_api.parse_manifest_header('kind: Job\n')
+
+
+def test_submit_jobs(k8s_server, tmpdir):
+    """Test job submission with server-side apply"""
+    template = read_job_template()
+    queries = [f'gs://test-bucket/batch_{i:03d}.fa' for i in range(3)]
+    write_job_files(str(tmpdir), 'batch_', template, queries, ELB_BLAST_PROGRAM='blastn',
+                    ELB_DB_LABEL='nt', ELB_DB='nt', ELB_NUM_CPUS='1')
+    names = kubernetes.submit_jobs(K8S_CTX, Path(str(tmpdir)))
+    assert names == [f'blastn-batch-nt-job-{i:03d}' for i in range(3)]
+    assert sorted(k8s_server.objects.keys()) == [f'{JOBS}/{name}' for name in names]
+    assert kubernetes.get_jobs(K8S_CTX, 'app=blast') == names
+    assert kubernetes.get_jobs(K8S_CTX, 'app=setup') == []
+
+
+def test_submit_jobs_concurrently_with_retries(k8s_server, tmpdir, mocker):
+    """Test that jobs are applied concurrently and that applies rejected by
+    an overloaded server are retried"""
+    mocker.patch.object(k8s_api.K8sApiClient.apply_with_retries.retry, 'wait', wait_none())
+    k8s_server.apply_delay = 0.05
+    template = read_job_template()
+    queries = [f'gs://test-bucket/batch_{i:03d}.fa' for i in range(20)]
+    write_job_files(str(tmpdir), 'batch_', template, queries, ELB_BLAST_PROGRAM='blastn',
+                    ELB_DB_LABEL='nt', ELB_DB='nt', ELB_NUM_CPUS='1')
+    expected = [f'blastn-batch-nt-job-{i:03d}' for i in range(20)]
+    k8s_server.failures[f'{JOBS}/{expected[3]}'] = [429, 503]
+    k8s_server.failures[f'{JOBS}/{expected[7]}'] = [500]
+    names = kubernetes.submit_jobs(K8S_CTX, Path(str(tmpdir)))
+    assert names == expected
+    assert sorted(k8s_server.objects.keys()) == [f'{JOBS}/{name}' for name in names]
+    assert 1 < k8s_server.max_active <= ELB_K8S_API_APPLY_THREADS
+    assert len([r for r in k8s_server.requests if r[0] == 'PATCH']) == 23
+
+
+def test_submit_jobs_client_error_not_retried(k8s_server, tmpdir, mocker):
+    """Test that an apply rejected for a reason other than server load fails
+    without retries"""
+    mocker.patch.object(k8s_api.K8sApiClient.apply_with_retries.retry, 'wait', wait_none())
+    job_file = Path(str(tmpdir.join('job.yaml')))
+    job_file.write_text('apiVersion: batch/v1\nkind: Job\nmetadata:\n  name: bad-job\n')
+    k8s_server.failures[f'{JOBS}/bad-job'] = [422, 422]
+    with pytest.raises(k8s_api.K8sApiError) as err:
+        kubernetes.submit_jobs(K8S_CTX, job_file)
+    assert err.value.returncode == 422
+    assert len([r for r in k8s_server.requests if r[0] == 'PATCH']) == 1
+
+
+def test_list_pagination(k8s_server, monkeypatch):
+    """Test that all pages of a listing are retrieved"""
+    monkeypatch.setattr(k8s_api, 'ELB_K8S_API_PAGE_SIZE', 2)
+    for i in range(5):
+        add_object(k8s_server, JOBS, f'job-{i}', {'app': 'blast'})
+    assert kubernetes.get_jobs(K8S_CTX) == [f'job-{i}' for i in range(5)]
+    assert len([r for r in k8s_server.requests if r[0] == 'GET']) == 3
+
+
+def test_job_succeeded(k8s_server, tmpdir):
+    """Test checking job status described by a job file"""
+    job_file = Path(str(tmpdir.join('job.yaml')))
+    job_file.write_text('apiVersion: batch/v1\nkind: Job\nmetadata:\n  name: init-pv\n')
+    add_object(k8s_server, JOBS, 'init-pv', status={'active': 1})
+    assert not kubernetes._job_succeeded(K8S_CTX, job_file)
+    add_object(k8s_server, JOBS, 'init-pv', status={'succeeded': 1, 'conditions': [{'type': 'Complete'}]})
+    assert kubernetes._job_succeeded(K8S_CTX, job_file)
+    kubernetes._ensure_successful_job(K8S_CTX, job_file)
+    add_object(k8s_server, JOBS, 'init-pv', status={'failed': 2, 'conditions': [{'type': 'Failed'}]})
+    with pytest.raises(RuntimeError):
+        kubernetes._job_succeeded(K8S_CTX, job_file)
+
+
+def test_pvc_bound(k8s_server):
+    """Test checking persistent volume claim status"""
+    add_object(k8s_server, PVCS, 'blast-dbs-pvc', status={'phase': 'Pending'})
+    assert not kubernetes._pvc_bound(K8S_CTX, 'blast-dbs-pvc')
+    add_object(k8s_server, PVCS, 'blast-dbs-pvc', status={'phase': 'Bound'})
+    assert kubernetes._pvc_bound(K8S_CTX, 'blast-dbs-pvc')
+    with pytest.raises(k8s_api.K8sApiError):
+        kubernetes._pvc_bound(K8S_CTX, 'missing-pvc')
+
+
+def test_wait_for_job(k8s_server, tmpdir):
+    """Test that waiting for a job returns as soon as the job finishes"""
+    job_file = Path(str(tmpdir.join('job.yaml')))
+    job_file.write_text('apiVersion: batch/v1\nkind: Job\nmetadata:\n  name: init-pv\n')
+    add_object(k8s_server, JOBS, 'init-pv', status={'active': 1})
+    threading.Timer(0.5, update_object, [k8s_server, JOBS, 'init-pv', {'active': 1, 'ready': 1}]).start()
+    threading.Timer(1, update_object, [k8s_server, JOBS, 'init-pv',
+                                       {'succeeded': 1, 'conditions': [{'type': 'Complete'}]}]).start()
+    start = time.monotonic()
+    kubernetes._wait_for_job(K8S_CTX, job_file, attempts=2, secs2wait=30)
+    assert time.monotonic() - start < 10
+
+    threading.Timer(0.5, update_object, [k8s_server, JOBS, 'init-pv',
+                                         {'failed': 1, 'conditions': [{'type': 'Failed'}]}]).start()
+    add_object(k8s_server, JOBS, 'init-pv', status={'active': 1})
+    with pytest.raises(RuntimeError):
+        kubernetes._wait_for_job(K8S_CTX, job_file, attempts=2, secs2wait=30)
+
+
+def test_wait_for_pvc(k8s_server):
+    """Test waiting for persistent volume claim and its time limit"""
+    add_object(k8s_server, PVCS, 'blast-dbs-pvc', status={'phase': 'Pending'})
+    with pytest.raises(TimeoutError):
+        kubernetes.wait_for_pvc(K8S_CTX, 'blast-dbs-pvc', attempts=1, secs2wait=1)
+    threading.Timer(0.5, update_object, [k8s_server, PVCS, 'blast-dbs-pvc', {'phase': 'Bound'}]).start()
+    kubernetes.wait_for_pvc(K8S_CTX, 'blast-dbs-pvc', attempts=1, secs2wait=30)
+
+
+def test_get_logs(k8s_server, caplog):
+    """Test collecting container logs from pods selected by label"""
+    for i in range(2):
+        add_object(k8s_server, PODS, f'pod-{i}', {'app': 'blast'},
+                   spec={'containers': [{'name': 'blast'}, {'name': 'results-export'}]},
+                   logs={'blast': f'2022-01-01T00:00:00Z log from pod {i}\n'})
+    add_object(k8s_server, PODS, 'setup-pod', {'app': 'setup'}, spec={'containers': [{'name': 'blast'}]},
+               logs={'blast': 'should not be collected\n'})
+    caplog.set_level('DEBUG')
+    kubernetes.get_logs(K8S_CTX, 'app=blast', ['blast', 'results-export'])
+    messages = [r.getMessage() for r in caplog.records]
+    assert '2022-01-01T00:00:00Z log from pod 0' in messages
+    assert '2022-01-01T00:00:00Z log from pod 1' in messages
+    assert 'should not be collected' not in messages
+
+
+def test_delete_all(k8s_server):
+    """Test deleting jobs and storage objects"""
+    add_object(k8s_server, JOBS, 'init-pv', {'app': 'setup'})
+    add_object(k8s_server, JOBS, 'blast-job', {'app': 'blast'})
+    add_object(k8s_server, JOBS, 'other-job', {'app': 'janitor'})
+    add_object(k8s_server, PVCS, 'blast-dbs-pvc')
+    add_object(k8s_server, PVS, 'pv-1')
+    add_object(k8s_server, SNAPSHOTS, 'blast-dbs-snapshot')
+    k8s_server.objects[f'{PVS}/pv-1']['metadata']['finalizers'] = ['kubernetes.io/pv-protection']
+    deleted = kubernetes.delete_all(K8S_CTX)
+    assert sorted(deleted) == ['blast-dbs-pvc', 'blast-dbs-snapshot', 'blast-job', 'init-pv', 'pv-1']
+    assert list(k8s_server.objects.keys()) == [f'{JOBS}/other-job']
+    assert ('PATCH', f'{PVS}/pv-1') in k8s_server.requests
+
+
+def test_check_status(k8s_server, gke_mock, mocker):
+    """Test GCP search status from Kubernetes API"""
+    mocker.patch.object(gcp.ElasticBlastGcp, '_get_gke_credentials', return_value=K8S_CTX)
+    add_object(k8s_server, JOBS, 'job-0', {'app': 'blast'}, status={'conditions': [{'type': 'Complete'}], 'succeeded': 1})
+    add_object(k8s_server, JOBS, 'job-1', {'app': 'blast'}, status={'conditions': [{'type': 'Failed'}]})
+    add_object(k8s_server, JOBS, 'job-2', {'app': 'blast'}, status={'active': 1})
+    add_object(k8s_server, JOBS, 'job-3', {'app': 'blast'}, status={'active': 1})
+    add_object(k8s_server, PODS, 'pod-2', {'app': 'blast'}, status={'phase': 'Running'})
+    add_object(k8s_server, PODS, 'pod-3', {'app': 'blast'}, status={'phase': 'Pending'})
+    cfg = ElasticBlastConfig(configure(Namespace(cfg=STATUS_INI)), task=ElbCommand.STATUS)
+    status, counts, _ = gcp.ElasticBlastGcp(cfg).check_status()
+    assert status == ElbStatus.FAILURE
+    assert counts == {'failed': 1, 'succeeded': 1, 'pending': 1, 'running': 1}
+    job_requests = [r for r in k8s_server.requests if r[1].startswith(JOBS)]
+    # one listing of jobs for all apps
+    assert len(job_requests) == 1
+    assert 'labelSelector=app+in+%28blast%2Csetup%2Csubmit%29' in job_requests[0][1]
+    assert any('fieldSelector=status.phase%3DRunning' in r[1] for r in k8s_server.requests)
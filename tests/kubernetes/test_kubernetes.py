@@ -31,6 +31,7 @@ from tempfile import TemporaryDirectory
 import json
 from unittest.mock import MagicMock, patch
 import pytest
+from tenacity import wait_none
 from tests.utils import MockedCompletedProcess
 from tests.utils import mocked_safe_exec
 from tests.utils import GKE_PVS, GCP_DISKS, K8S_JOBS, gke_mock, GKEMock
@@ -120,6 +121,34 @@ def test_submit_jobs_bad_path():
             kubernetes.submit_jobs(K8S_UNINITIALIZED_CONTEXT, path)
 
 
+def test_submit_jobs_in_chunks(mocker, tmpdir):
+    """Test that many jobs are submitted in chunks and only a failed chunk
+    is retried"""
+    mocker.patch.object(kubernetes.submit_jobs_with_retries.retry, 'wait', wait_none())
+    mocker.patch('elastic_blast.kubernetes.ELB_K8S_JOB_SUBMISSION_CHUNK_SIZE', 40)
+    num_jobs = 250
+    for i in range(num_jobs):
+        tmpdir.join(f'batch_{i:03d}.yaml').write(f'apiVersion: batch/v1\nkind: Job\nmetadata:\n  name: job-{i:03d}\n')
+    applied = []
+    failed = []
+
+    def safe_exec(cmd):
+        chunk = Path(cmd.split()[-3])
+        if chunk.name == 'chunk_00002.yaml' and not failed:
+            failed.append(chunk.name)
+            raise kubernetes.SafeExecError(1, 'timeout')
+        applied.append(chunk.name)
+        docs = [doc for doc in chunk.read_text().split('---\n') if doc]
+        items = [{'metadata': {'name': doc.split('name: ')[1].strip()}} for doc in docs]
+        return MockedCompletedProcess(json.dumps({'items': items}))
+
+    mocker.patch('elastic_blast.kubernetes.safe_exec', side_effect=safe_exec)
+    names = kubernetes.submit_jobs(K8S_UNINITIALIZED_CONTEXT, Path(str(tmpdir)))
+    assert names == [f'job-{i:03d}' for i in range(num_jobs)]
+    assert sorted(applied) == [f'chunk_{i:05d}.yaml' for i in range(7)]
+    assert failed == ['chunk_00002.yaml']
+
+
 FAKE_LABELS = 'cluster-name=fake-cluster'
 
 
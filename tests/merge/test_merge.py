@@ -0,0 +1,224 @@
+#                           PUBLIC DOMAIN NOTICE
+#              National Center for Biotechnology Information
+#
+# This software is a "United States Government Work" under the
+# terms of the United States Copyright Act.  It was written as part of
+# the authors' official duties as United States Government employees and
+# thus cannot be copyrighted.  This software is freely available
+# to the public for use.  The National Library of Medicine and the U.S.
+# Government have not placed any restriction on its use or reproduction.
+#
+# Although all reasonable efforts have been taken to ensure the accuracy
+# and reliability of the software and data, the NLM and the U.S.
+# Government do not and cannot warrant the performance or results that
+# may be obtained by using this software or data.  The NLM and the U.S.
+# Government disclaim all warranties, express or implied, including
+# warranties of performance, merchantability or fitness for any particular
+# purpose.
+#
+# Please cite NCBI in any work or product based on this material.
+
+"""
+Unit tests for merge command
+
+"""
+
+import io
+import gzip
+import json
+import boto3
+from argparse import Namespace
+from unittest.mock import MagicMock
+from moto import mock_s3  # type: ignore
+from elastic_blast import aws_traits
+from elastic_blast.commands import merge
+from elastic_blast.commands.merge import parse_outfmt, rerank_tabular, list_batch_results, STD_FIELDS
+from elastic_blast.constants import INPUT_ERROR
+from elastic_blast.util import UserReportError
+from tests.utils import aws_credentials, gsutil_stub
+import pytest
+
+BUCKET = 'test-bucket'
+RESULTS = f's3://{BUCKET}/results'
+NUM_BATCHES = 12
+
+
+@pytest.fixture
+def results_bucket(aws_credentials, monkeypatch):
+    """Mocked S3 results bucket with per batch BLAST results and search
+    configuration"""
+    monkeypatch.setattr(aws_traits, '_boto_objects', {})
+    with mock_s3():
+        s3 = boto3.client('s3', region_name='us-east-1')
+        s3.create_bucket(Bucket=BUCKET)
+        for i in range(NUM_BATCHES):
+            s3.put_object(Bucket=BUCKET, Key=f'results/batch_{i:03d}-blastn-pdbnt.out.gz',
+                          Body=gzip.compress(f'q{i}\ts{i}\t1e-10\t100\n'.encode()))
+        s3.put_object(Bucket=BUCKET, Key='results/query_batches/batch_000.fa', Body=b'>q0\nACGT\n')
+        cfg = {'blast': {'program': 'blastn', 'db': 'pdbnt',
+                         'options': '-evalue 0.01 -outfmt "6 qseqid sseqid evalue bitscore"'}}
+        s3.put_object(Bucket=BUCKET, Key='results/metadata/elastic-blast-config.json',
+                      Body=json.dumps(cfg).encode())
+        yield s3
+
+
+def test_parse_outfmt():
+    """Test BLAST output format parsing"""
+    assert parse_outfmt('-outfmt 11') == (11, [])
+    assert parse_outfmt('-outfmt 6 -evalue 0.01') == (6, STD_FIELDS)
+    assert parse_outfmt('-outfmt "7 std staxid"') == (7, STD_FIELDS + ['staxid'])
+    assert parse_outfmt("-outfmt '6 qseqid sseqid'") == (6, ['qseqid', 'sseqid'])
+    with pytest.raises(UserReportError) as err:
+        parse_outfmt('-evalue 0.01')
+    assert err.value.returncode == INPUT_ERROR
+
+
+def test_rerank_tabular():
+    """Test that hits to top N subjects are selected for each query, keeping
+    all HSPs of a selected subject"""
+    fields = ['qseqid', 'sseqid', 'evalue', 'bitscore']
+    lines = [b'q1\ts1\t1e-5\t50\n',
+             b'q1\ts2\t1e-20\t90\n',
+             b'q1\ts3\t1e-20\t95\n',
+             b'q1\ts2\t1e-3\t30\n',
+             b'q2\ts1\t0.0\t500\n']
+    out = io.BytesIO()
+    rerank_tabular(lines, out, 2, 6, fields)
+    assert out.getvalue() == b'q1\ts3\t1e-20\t95\n' \
+                             b'q1\ts2\t1e-20\t90\n' \
+                             b'q1\ts2\t1e-3\t30\n' \
+                             b'q2\ts1\t0.0\t500\n'
+    with pytest.raises(UserReportError):
+        rerank_tabular(lines, out, 2, 6, ['qseqid', 'sseqid'])
+
+
+def test_rerank_tabular_comments():
+    """Test that hit counts are updated for output format 7 and counts of
+    processed queries from all batches are combined"""
+    fields = ['qaccver', 'saccver', 'evalue', 'bitscore']
+    batch1 = [b'# BLASTN 2.13.0+\n', b'# Query: q1\n', b'# Fields: x\n', b'# 3 hits found\n',
+              b'q1\ts1\t1e-5\t50\n', b'q1\ts2\t1e-20\t90\n', b'q1\ts3\t1e-10\t60\n',
+              b'# BLAST processed 1 queries\n']
+    batch2 = [b'# BLASTN 2.13.0+\n', b'# Query: q2\n', b'# 0 hits found\n',
+              b'# BLASTN 2.13.0+\n', b'# Query: q3\n', b'# Fields: x\n', b'# 1 hits found\n',
+              b'q3\ts1\t0.0\t500\n', b'# BLAST processed 2 queries\n']
+    out = io.BytesIO()
+    rerank_tabular(batch1 + batch2, out, 1, 7, fields)
+    assert out.getvalue().splitlines(keepends=True) == \
+        [b'# BLASTN 2.13.0+\n', b'# Query: q1\n', b'# Fields: x\n', b'# 1 hits found\n',
+         b'q1\ts2\t1e-20\t90\n'] + batch2[:-1] + [b'# BLAST processed 3 queries\n']
+
+
+def test_merge(results_bucket, tmpdir):
+    """Test that batch results are concatenated in batch order without
+    recompression, and uploaded to the results bucket by default"""
+    cfg = MagicMock()
+    cfg.cluster.results = RESULTS
+    cfg.cluster.dry_run = False
+    expected = b''.join(f'q{i}\ts{i}\t1e-10\t100\n'.encode() for i in range(NUM_BATCHES))
+
+    output = str(tmpdir.join('merged.out.gz'))
+    assert merge._merge(Namespace(output=output, top_n=None), cfg, []) == 0
+    with open(output, 'rb') as f:
+        data = f.read()
+    # one gzip member per batch
+    assert data.count(b'\x1f\x8b\x08') == NUM_BATCHES
+    assert gzip.decompress(data) == expected
+
+    assert merge._merge(Namespace(output=None, top_n=1), cfg, []) == 0
+    obj = results_bucket.get_object(Bucket=BUCKET, Key='results/merged-blastn-pdbnt.out.gz')
+    assert gzip.decompress(obj['Body'].read()) == expected
+
+
+def test_merge_no_results(results_bucket):
+    """Test that missing results are reported"""
+    cfg = MagicMock()
+    cfg.cluster.results = f's3://{BUCKET}/missing'
+    cfg.cluster.dry_run = False
+    with pytest.raises(UserReportError) as err:
+        merge._merge(Namespace(output=None, top_n=None), cfg, [])
+    assert err.value.returncode == INPUT_ERROR
+
+
+def test_list_batch_results_local(tmpdir):
+    """Test that results outside of cloud storage are reported"""
+    with pytest.raises(UserReportError) as err:
+        list_batch_results(str(tmpdir))
+    assert err.value.returncode == INPUT_ERROR
+
+
+def _fmt7_results(queries):
+    """BLAST output format 7 for queries given as (query, subjects) tuples"""
+    lines = []
+    for query, subjects in queries:
+        lines += ['# BLASTN 2.13.0+', f'# Query: {query}']
+        if subjects:
+            lines.append('# Fields: query acc.ver, subject acc.ver, evalue, bit score')
+        lines.append(f'# {len(subjects)} hits found')
+        lines += [f'{query}\t{subject}\t1e-{10 + i}\t{100 + i}' for i, subject in enumerate(subjects)]
+    lines.append(f'# BLAST processed {len(queries)} queries')
+    return gzip.compress(('\n'.join(lines) + '\n').encode())
+
+
+def test_merge_balanced_batches(results_bucket, tmpdir, caplog):
+    """Test that results of balanced query batches are put back in input
+    order of queries when re-ranked, and a warning is logged otherwise"""
+    for i in range(NUM_BATCHES):
+        results_bucket.delete_object(Bucket=BUCKET, Key=f'results/batch_{i:03d}-blastn-pdbnt.out.gz')
+    # queries q0 to q4, q2 has no hits
+    batches = {'batch_000': [('q0', ['s1', 's2']), ('q2', []), ('q3', ['s3'])],
+               'batch_001': [('q1', ['s4', 's5']), ('q4', ['s6'])]}
+    for name, queries in batches.items():
+        results_bucket.put_object(Bucket=BUCKET, Key=f'results/{name}-blastn-pdbnt.out.gz',
+                                  Body=_fmt7_results(queries))
+    results_bucket.put_object(Bucket=BUCKET, Key='results/metadata/query_order.txt',
+                              Body=b'batch_000.fa\t0,2-3\nbatch_001.fa\t1,4\n')
+    blast_cfg = {'blast': {'program': 'blastn', 'db': 'pdbnt',
+                           'options': '-evalue 0.01 -outfmt "7 qaccver saccver evalue bitscore"'}}
+    results_bucket.put_object(Bucket=BUCKET, Key='results/metadata/elastic-blast-config.json',
+                              Body=json.dumps(blast_cfg).encode())
+    cfg = MagicMock()
+    cfg.cluster.results = RESULTS
+    cfg.cluster.dry_run = False
+
+    output = str(tmpdir.join('merged.out.gz'))
+    assert merge._merge(Namespace(output=output, top_n=1), cfg, []) == 0
+    with gzip.open(output, 'rb') as f:
+        lines = f.read().decode().splitlines()
+    assert [line.split()[-1] for line in lines if line.startswith('# Query:')] == \
+        ['q0', 'q1', 'q2', 'q3', 'q4']
+    assert [line for line in lines if not line.startswith('#')] == \
+        ['q0\ts2\t1e-11\t101', 'q1\ts5\t1e-11\t101', 'q3\ts3\t1e-10\t100', 'q4\ts6\t1e-10\t100']
+    assert lines[-1] == '# BLAST processed 5 queries'
+    assert 'batch order' not in caplog.text
+
+    # concatenated results stay in query batch order
+    assert merge._merge(Namespace(output=output, top_n=None), cfg, []) == 0
+    assert 'batch order' in caplog.text
+    with open(output, 'rb') as f:
+        assert gzip.decompress(f.read()) == \
+            gzip.decompress(_fmt7_results(batches['batch_000'])) + \
+            gzip.decompress(_fmt7_results(batches['batch_001']))
+
+    # results that do not match the map are reported
+    results_bucket.put_object(Bucket=BUCKET, Key='results/metadata/query_order.txt',
+                              Body=b'batch_000.fa\t0-1\nbatch_001.fa\t2-4\n')
+    with pytest.raises(UserReportError) as err:
+        merge._merge(Namespace(output=output, top_n=1), cfg, [])
+    assert err.value.returncode == INPUT_ERROR
+
+
+def test_merge_gsutil_read_failure(gsutil_stub, tmpdir, mocker):
+    """Test that a results file that gsutil fails to read is reported instead
+    of being left out of the merged results"""
+    results = 'gs://test-bucket/results'
+    fnames = [f'{results}/batch_{i:03d}-blastn-pdbnt.out.gz' for i in range(3)]
+    for fname in fnames[:2]:
+        gsutil_stub.join(fname[len('gs://'):]).write_binary(gzip.compress(b'q\ts\t1e-10\t100\n'),
+                                                            ensure=True)
+    output = str(tmpdir.join('merged.out.gz'))
+    assert merge._write_merged_results(fnames[:2], output, None, 6, []) > 0
+    with pytest.raises(UserReportError) as err:
+        merge._write_merged_results(fnames, output, None, 6, [])
+    assert err.value.returncode == INPUT_ERROR
+    assert 'No URLs matched' in err.value.message
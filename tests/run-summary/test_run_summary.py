@@ -27,6 +27,8 @@ Author: Victor Joukov joukovv@ncbi.nlm.nih.gov
 import os
 import subprocess
 import pytest
+from unittest.mock import MagicMock
+from elastic_blast.commands.run_summary import AwsLogParser, CpuInfo, _expand_array_jobs
 
 TEST_DIR = os.path.join(os.path.dirname(__file__), 'data')
 TEST_LOGS = 'aws-output-sample-aggregate.log'
@@ -50,3 +52,54 @@ def test_from_logs():
             sample = f.read()
         assert output == sample
         assert proc.returncode == 0
+
+
+def test_concurrent_phases():
+    """Test that phases of a job running concurrently are timed separately"""
+    parser = AwsLogParser()
+    for ts, message in [(100, 'Start database download'),
+                        (110, 'Start query download'),
+                        (120, 'End query download'),
+                        (130, 'Start query splitting'),
+                        (140, '1.00user 2.00system 0:03.00elapsed 99%CPU'),
+                        (150, 'End database download'),
+                        (160, 'End query splitting')]:
+        parser.parse(ts, message)
+    spans = {phase: [(job.start, job.end) for job in jobs] for phase, jobs in parser.phases.items()}
+    assert spans == {'blastDbSetup': [(100, 150)], 'queryDownload': [(110, 120)],
+                     'querySplit': [(130, 160)]}
+    # time output belongs to query splitting that runs in the foreground
+    assert parser.phases['querySplit'][0].cpu_info == CpuInfo('1.00', '2.00', '0:03.00', '99')
+    assert parser.phases['blastDbSetup'][0].cpu_info is None
+
+
+def test_tagged_time_output():
+    """Test that time output is attributed to the phase it is tagged with,
+    even if another phase started later"""
+    parser = AwsLogParser()
+    for ts, message in [(100, 'Start database download'),
+                        (110, 'Start query download'),
+                        (120, 'Timed phase: taxonomy database download'),
+                        (120, '0.50user 0.50system 0:01.00elapsed 99%CPU'),
+                        (140, 'Timed phase: database download'),
+                        (140, '1.00user 2.00system 0:03.00elapsed 99%CPU'),
+                        (150, 'End database download'),
+                        (160, 'End query download'),
+                        (170, 'Start blast search'),
+                        (180, 'Timed phase: blast search'),
+                        (180, '4.00user 5.00system 0:06.00elapsed 150%CPU'),
+                        (190, 'End blast search')]:
+        parser.parse(ts, message)
+    assert parser.phases['blastDbSetup'][0].cpu_info == CpuInfo('1.00', '2.00', '0:03.00', '99')
+    assert parser.phases['queryDownload'][0].cpu_info is None
+    assert parser.phases['blast'][0].cpu_info == CpuInfo('4.00', '5.00', '0:06.00', '150')
+
+
+def test_expand_array_jobs():
+    """Test that array jobs are replaced with their child jobs"""
+    batch = MagicMock()
+    batch.describe_jobs.side_effect = lambda jobs: {'jobs': [
+        {'jobId': job_id, 'arrayProperties': {'size': 3}} if job_id.startswith('array')
+        else {'jobId': job_id} for job_id in jobs]}
+    assert _expand_array_jobs(batch, ['split', 'array-1', 'array-2'], page_size=2) == \
+        ['split', 'array-1:0', 'array-1:1', 'array-1:2', 'array-2:0', 'array-2:1', 'array-2:2']
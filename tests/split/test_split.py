@@ -24,6 +24,7 @@ Unit tests for split module
 """
 
 import os
+import io
 from io import StringIO
 import tempfile
 import shutil
@@ -70,3 +71,156 @@ AAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAAA"""
     assert hashlib.sha256('\n'.join([fasta1, fasta2, '']).encode()).hexdigest() == \
            hashlib.sha256(''.join(batch).encode()).hexdigest()
         
+
+def test_FASTAReader_iter_batches(tmpdir, monkeypatch):
+    """Test that batches are yielded before the whole input is read and
+    that they report their length and number of sequences"""
+    monkeypatch.setattr(split, 'FASTA_BLOCK_SIZE', 64)
+    fasta = ''.join(f'>seq{i}\n{"ACGT" * (i + 1)}\n' for i in range(20)).encode()
+    stream = io.BytesIO(fasta)
+    reader = split.FASTAReader(stream, 40, tmpdir)
+    batches = []
+    for batch in reader.iter_batches():
+        if not batches:
+            assert stream.tell() < len(fasta)
+        batches.append(batch)
+    assert [b.name for b in batches] == reader.queries
+    assert reader.total_count == sum(b.residues for b in batches) == sum(4 * (i + 1) for i in range(20))
+    assert sum(b.sequences for b in batches) == 20
+    for batch in batches:
+        with open(batch.name) as f:
+            text = f.read()
+        assert batch.sequences == text.count('>')
+        assert batch.residues == sum(len(l) for l in text.split('\n') if not l.startswith('>'))
+
+    with split.FASTAIndex(io.BytesIO(fasta)) as index:
+        index.read()
+        assert list(index.iter_batches(40, tmpdir)) == batches
+
+
+def test_FASTAIndex_matches_FASTAReader(tmpdir):
+    """Test that FASTAIndex produces the same batches as FASTAReader for
+    any batch length, reading input only once"""
+    fasta1 = """>seq1
+ACGTACGTAC
+GTACGT
+>seq2
+AAAAACCCCC
+>seq3 header only
+>seq4
+TTTTTTTTTTTTTTTTTTTTTTTTTTTTTT"""
+    fasta2 = """GGGG
+>seq5
+CCCCCCCCCCCCCC
+>seq6
+A
+"""
+
+    with StringIO(fasta1) as f1, StringIO(fasta2) as f2:
+        index = split.FASTAIndex([f1, f2])
+        total_count = index.read()
+
+    for batch_len in [0, 1, 10, 16, 27, 40, 1000]:
+        reader_dir = os.path.join(tmpdir, f'reader{batch_len}')
+        index_dir = os.path.join(tmpdir, f'index{batch_len}')
+        with StringIO(fasta1) as f1, StringIO(fasta2) as f2:
+            reader = split.FASTAReader([f1, f2], batch_len, reader_dir)
+            expected_count, expected_queries = reader.read_and_cut()
+
+        assert total_count == expected_count
+        assert index.get_num_batches(batch_len) == len(expected_queries)
+        queries = index.write_batches(batch_len, index_dir)
+        assert len(queries) == len(expected_queries)
+        for expected, actual in zip(expected_queries, queries):
+            assert os.path.basename(expected) == os.path.basename(actual)
+            with open(expected) as f:
+                expected_batch = f.read()
+            with open(actual) as f:
+                assert f.read() == expected_batch
+    index.close()
+
+
+def test_FASTAIndex_empty_input():
+    """Test that FASTAIndex reports empty input"""
+    with StringIO('') as f:
+        with split.FASTAIndex(f) as index:
+            with pytest.raises(Exception, match='Empty input file'):
+                index.read()
+
+
+@pytest.mark.parametrize('block_size', [1, 2, 3, 7, 1024])
+def test_FASTAReader_block_boundaries(tmpdir, monkeypatch, block_size):
+    """Test that batches do not depend on how input is cut into blocks and
+    that DOS line endings are translated"""
+    fasta = '>seq1 a>b\r\nACGT\r\nAC\r\n>seq2\r\n\r\nTTTTT\r\n>seq3\r\n>seq4\r\nGG'
+    monkeypatch.setattr(split, 'FASTA_BLOCK_SIZE', block_size)
+    with io.TextIOWrapper(io.BytesIO(fasta.encode())) as f:
+        reader = split.FASTAReader(f, 6, tmpdir)
+        total_count, queries = reader.read_and_cut()
+
+    assert total_count == 12
+    batches = []
+    for query in queries:
+        with open(query) as f:
+            batches.append(f.read())
+    assert batches == ['>seq1 a>b\nACGT\nAC\n', '>seq2\n\nTTTTT\n>seq3\n>seq4\nGG\n']
+
+
+def test_FASTAIndex_balanced_batches(tmpdir):
+    """Test that balanced batches have similar lengths, contain every
+    sequence once, and can be put back in input order"""
+    lengths = [1000, 10, 10, 10, 900, 10, 500, 500, 20, 30, 800, 5]
+    fasta = ''.join(f'>seq{i}\n{"A" * n}\n' for i, n in enumerate(lengths))
+    with split.FASTAIndex(io.BytesIO(fasta.encode())) as index:
+        index.read()
+        greedy = [sum(lengths[first:last]) for first, last in index.cut(1200)]
+        order = []
+        batches = list(index.iter_balanced_batches(len(greedy), tmpdir, order))
+    assert len(batches) == len(greedy) == 4
+    assert max(b.residues for b in batches) < max(greedy)
+    assert max(b.residues for b in batches) == 1000
+    assert sum(b.sequences for b in batches) == len(lengths)
+
+    map_file = io.StringIO()
+    split.write_query_order(order, [b.name for b in batches], map_file)
+    map_file.seek(0)
+    seqs = {}
+    for name, numbers in split.read_query_order(map_file):
+        with open(os.path.join(tmpdir, name)) as f:
+            records = f.read().split('>')[1:]
+        assert len(records) == len(numbers)
+        for number, record in zip(numbers, records):
+            seqs[number] = '>' + record
+    assert ''.join(seqs[i] for i in range(len(lengths))) == fasta
+
+
+def test_FASTAIndex_balanced_batches_by_cost(tmpdir):
+    """Test that batches are balanced by estimated search cost, if given,
+    rather than by length"""
+    lengths = [400, 100, 100, 100, 100]
+    fasta = ''.join(f'>seq{i}\n{"A" * n}\n' for i, n in enumerate(lengths))
+
+    def seq_cost(length):
+        # fixed cost per sequence dominates
+        return 1000 + length
+
+    with split.FASTAIndex(io.BytesIO(fasta.encode())) as index:
+        index.read()
+        assert index.balance(2) == [[0], [1, 2, 3, 4]]
+        assert [len(b) for b in index.balance(2, seq_cost)] == [2, 3]
+        batches = list(index.iter_balanced_batches(2, tmpdir, seq_cost=seq_cost))
+    assert [(b.residues, b.sequences) for b in batches] == [(500, 2), (300, 3)]
+
+
+def test_FASTAIndex_cut_by_cost(tmpdir):
+    """Test cutting batches by estimated search cost"""
+    lengths = [100] * 10 + [1000] * 2
+    fasta = ''.join(f'>seq{i}\n{"A" * n}\n' for i, n in enumerate(lengths))
+    with split.FASTAIndex(io.BytesIO(fasta.encode())) as index:
+        index.read()
+        assert list(index.cut(1000)) == [(0, 10), (10, 11), (11, 12)]
+        # a fixed cost of 100 letters per sequence
+        assert list(index.cut(1100, lambda n: n + 100)) == [(0, 5), (5, 10), (10, 11), (11, 12)]
+        assert index.get_num_batches(1100, lambda n: n + 100) == 4
+        queries = index.write_batches(1100, tmpdir, lambda n: n + 100)
+    assert len(queries) == 4
@@ -31,7 +31,7 @@ from elastic_blast.elb_config import ElasticBlastConfig
 
 from elastic_blast.gcp import ElasticBlastGcp
 from elastic_blast.constants import ElbCommand, ElbStatus
-from tests.utils import gke_mock
+from tests.utils import gke_mock, MockedCompletedProcess
 
 DATA_DIR = os.path.join(os.path.dirname(__file__), 'data')
 INI = os.path.join(DATA_DIR, 'status-test.ini')
@@ -44,3 +44,48 @@ def test_status(gke_mock):
     status, counters, _ = elastic_blast.check_status()
     assert status == ElbStatus.FAILURE
     assert counters ==  {'failed': 1, 'succeeded': 1, 'pending': 1, 'running': 1}
+
+
+def test_status_indexed_job(gke_mock, mocker):
+    "Test that searches of an indexed job are counted by completions"
+    mocked_safe_exec = gke_mock.mocked_safe_exec
+
+    def safe_exec(cmd):
+        if 'get jobs -o custom-columns=APP' in ' '.join(cmd):
+            return MockedCompletedProcess('\n'.join(['blast <none> Indexed 10 7',
+                                                      'setup Complete <none> <none> <none>']))
+        return mocked_safe_exec(cmd)
+
+    mocker.patch('elastic_blast.gcp.safe_exec', side_effect=safe_exec)
+    args = Namespace(cfg=INI)
+    cfg = ElasticBlastConfig(configure(args), task = ElbCommand.STATUS)
+    elastic_blast = ElasticBlastGcp(cfg)
+    status, counters, _ = elastic_blast.check_status()
+    assert status == ElbStatus.RUNNING
+    assert counters ==  {'failed': 0, 'succeeded': 7, 'pending': 2, 'running': 1}
+
+
+def test_status_single_job_listing(gke_mock, mocker):
+    "Test that setup and submit job states come from the same listing of jobs"
+    mocked_safe_exec = gke_mock.mocked_safe_exec
+
+    def safe_exec(cmd):
+        if 'get jobs -o custom-columns=APP' in ' '.join(cmd):
+            return MockedCompletedProcess('\n'.join(['setup Complete <none> <none> <none>',
+                                                      'submit Failed <none> <none> <none>',
+                                                      'janitor Failed <none> <none> <none>']))
+        if 'get pods' in ' '.join(cmd):
+            return MockedCompletedProcess('')
+        return mocked_safe_exec(cmd)
+
+    mocked = mocker.patch('elastic_blast.gcp.safe_exec', side_effect=safe_exec)
+    args = Namespace(cfg=INI)
+    cfg = ElasticBlastConfig(configure(args), task = ElbCommand.STATUS)
+    elastic_blast = ElasticBlastGcp(cfg)
+    status, counters, _ = elastic_blast.check_status()
+    assert status == ElbStatus.FAILURE
+    assert counters ==  {'failed': 0, 'succeeded': 0, 'pending': 0, 'running': 0}
+    job_listings = [c for c in mocked.call_args_list if 'get jobs' in ' '.join(c.args[0])]
+    assert len(job_listings) == 1
+    # the label selector is passed as a single argument
+    assert job_listings[0].args[0][-2:] == ['-l', 'app in (blast,setup,submit)']
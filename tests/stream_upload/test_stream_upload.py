@@ -0,0 +1,120 @@
+#                           PUBLIC DOMAIN NOTICE
+#              National Center for Biotechnology Information
+#
+# This software is a "United States Government Work" under the
+# terms of the United States Copyright Act.  It was written as part of
+# the authors' official duties as United States Government employees and
+# thus cannot be copyrighted.  This software is freely available
+# to the public for use.  The National Library of Medicine and the U.S.
+# Government have not placed any restriction on its use or reproduction.
+#
+# Although all reasonable efforts have been taken to ensure the accuracy
+# and reliability of the software and data, the NLM and the U.S.
+# Government do not and cannot warrant the performance or results that
+# may be obtained by using this software or data.  The NLM and the U.S.
+# Government disclaim all warranties, express or implied, including
+# warranties of performance, merchantability or fitness for any particular
+# purpose.
+#
+# Please cite NCBI in any work or product based on this material.
+
+"""
+Unit tests for streaming of BLAST output to AWS S3, with stub commands in
+place of BLAST and the uploader
+
+"""
+
+import os
+import sys
+import gzip
+import pytest
+
+# the module is shipped with the worker script in the docker image
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', '..', 'docker-blast'))
+import stream_upload
+
+# Writes NUM_LINES lines to stdout, a message to stderr, and exits with
+# EXIT_CODE once the uploader is ready
+SEARCH_STUB = """
+import os, sys, time
+ready, num_lines, exit_code = sys.argv[1], int(sys.argv[2]), int(sys.argv[3])
+while not os.path.exists(ready):
+    time.sleep(0.01)
+for i in range(num_lines):
+    sys.stdout.write(f'line {i}\\n')
+sys.stdout.flush()
+sys.stderr.write('search done\\n')
+sys.exit(exit_code)
+"""
+
+# Like aws s3 cp - DEST: stores its input in DEST once the input ends,
+# cancels the upload on SIGINT, or fails at once with EXIT_CODE if given
+UPLOAD_STUB = """
+import sys, signal
+dest = sys.argv[1]
+if len(sys.argv) > 2:
+    print('upload failed')
+    sys.exit(int(sys.argv[2]))
+def cancel(signum, frame):
+    open(dest + '.cancelled', 'w').close()
+    sys.exit(130)
+signal.signal(signal.SIGINT, cancel)
+open(dest + '.ready', 'w').close()
+data = sys.stdin.buffer.read()
+with open(dest, 'wb') as f:
+    f.write(data)
+"""
+
+
+@pytest.fixture
+def stubs(tmpdir):
+    """Returns a function making the search, compress, and upload commands
+    for a stub search writing num_lines lines and exiting with search_exit
+    code, and for a stub upload to tmpdir/result.gz, failing with upload_exit
+    code unless it is None"""
+    search = tmpdir.join('search.py')
+    search.write(SEARCH_STUB)
+    upload = tmpdir.join('upload.py')
+    upload.write(UPLOAD_STUB)
+    dest = str(tmpdir.join('result.gz'))
+
+    def commands(num_lines, search_exit=0, upload_exit=None):
+        ready = dest + '.ready' if upload_exit is None else str(search)
+        upload_cmd = [sys.executable, str(upload), dest]
+        if upload_exit is not None:
+            upload_cmd.append(str(upload_exit))
+        return ([sys.executable, str(search), ready, str(num_lines), str(search_exit)],
+                ['gzip', '-c'], upload_cmd)
+    return commands, dest
+
+
+def test_stream(stubs):
+    """Test that the whole output is compressed and uploaded"""
+    commands, dest = stubs
+    result = stream_upload.stream(*commands(1000), chunk_size=100, preview_lines=3)
+    with gzip.open(dest, 'rt') as f:
+        assert f.read() == ''.join(f'line {i}\n' for i in range(1000))
+    assert result.head.decode().splitlines()[:3] == ['line 0', 'line 1', 'line 2']
+    assert result.stderr == b'search done\n'
+
+
+def test_failed_search_cancels_upload(stubs):
+    """Test that the upload of partial output of a failed search is
+    cancelled rather than completed or killed"""
+    commands, dest = stubs
+    with pytest.raises(stream_upload.StreamError) as err:
+        stream_upload.stream(*commands(1000, search_exit=3), chunk_size=100, preview_lines=3)
+    assert err.value.returncode == 3
+    assert err.value.stderr == b'search done\n'
+    assert os.path.exists(dest + '.cancelled')
+    assert not os.path.exists(dest)
+
+
+def test_failed_upload(stubs):
+    """Test that a failed upload is reported and stops the search"""
+    commands, dest = stubs
+    with pytest.raises(stream_upload.StreamError) as err:
+        stream_upload.stream(*commands(2000000, upload_exit=2), chunk_size=1024, preview_lines=3)
+    assert err.value.returncode == 2
+    assert 'upload failed' in err.value.message
+    assert not os.path.exists(dest)
@@ -24,7 +24,7 @@ test_subst.py - unit test for elastic_blast.subst module
 Author: Victor Joukov joukovv@ncbi.nlm.nih.gov
 """
 
-from elastic_blast.subst import substitute_params
+from elastic_blast.subst import substitute_params, Template
 
 def test_subst():
     query_num = '046'
@@ -42,4 +42,22 @@ ${SOME_NON_EXISTING_VARIABLE}"""
 {query_path}
 ${{SOME_NON_EXISTING_VARIABLE}}"""
     sub_text = substitute_params(text, map_obj)
-    assert sub_text == ref_text
\ No newline at end of file
+    assert sub_text == ref_text
+
+def test_template():
+    """Test that compiled template renders the same text as substitute_params"""
+    text = """\
+name: job-${JOB_NUM}
+query: ${QUERY_PATH}/$QUERY.fa
+results: ${RESULTS}
+${SOME_NON_EXISTING_VARIABLE}$"""
+    map_obj = {'JOB_NUM': '007', 'QUERY': 'batch_007',
+               'QUERY_PATH': 'gs://example-bucket/query_batches',
+               'RESULTS': 'gs://example-bucket/results'}
+    template = Template(text)
+    assert template.variables == {'JOB_NUM', 'QUERY_PATH', 'QUERY', 'RESULTS', 'SOME_NON_EXISTING_VARIABLE'}
+    assert template.render(map_obj) == substitute_params(text, map_obj)
+    bound = template.bind(map_obj, keep={'JOB_NUM'})
+    assert bound.variables == {'JOB_NUM', 'SOME_NON_EXISTING_VARIABLE'}
+    assert bound.render({'JOB_NUM': '008'}) == substitute_params(text, dict(map_obj, JOB_NUM='008'))
+    assert Template('no variables').render(map_obj) == 'no variables'
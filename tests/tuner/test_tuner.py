@@ -33,6 +33,7 @@ from elastic_blast.tuner import aws_get_mem_limit, gcp_get_mem_limit
 from elastic_blast.tuner import aws_get_machine_type, gcp_get_machine_type
 from elastic_blast.tuner import get_mem_limit, get_machine_type
 from elastic_blast.tuner import MAX_NUM_THREADS_AWS, MAX_NUM_THREADS_GCP
+from elastic_blast.tuner import WorkModel, get_work_model, SEQUENCE_OVERHEAD_LETTERS
 from elastic_blast.filehelper import open_for_read
 from elastic_blast.base import DBSource
 from elastic_blast.constants import ELB_BLASTDB_MEMORY_MARGIN, SYSTEM_MEMORY_RESERVE
@@ -155,6 +156,34 @@ def test_get_batch_length():
                             num_cpus = NUM_CPUS) == get_query_batch_size(PROGRAM) * MAX_NUM_THREADS_GCP * 2
 
 
+def test_work_model(tmpdir):
+    """Test BLAST search cost estimates and their calibration with
+    run-summary outputs"""
+    model = WorkModel('blastp', int(1e9))
+    overhead = SEQUENCE_OVERHEAD_LETTERS['blastp']
+    # relative costs without calibration
+    assert model.seq_cost(500) == 500 + overhead
+    assert model.batch_cost(1000, 100) == 1000 + 10 * overhead
+    # many short sequences cost more than one long sequence of the same total length
+    assert 10 * model.seq_cost(100) > model.seq_cost(1000)
+
+    summaries = []
+    for rate, db_length in [(100.0, int(1e9)), (400.0, int(2.5e8)), (50.0, int(3e9))]:
+        summary = tmpdir.join(f'summary-{rate}.json')
+        summary.write(json.dumps({'lettersPerSecondPerCpu': rate, 'blastData': {'databaseLength': db_length}}))
+        summaries.append(str(summary))
+    tmpdir.join('no-rate.json').write(json.dumps({'blastData': {}}))
+    summaries.append(str(tmpdir.join('no-rate.json')))
+    model = get_work_model('blastp', run_summary_files=summaries,
+                           db_metadata=MagicMock(number_of_letters=int(1e9)))
+    # throughputs scaled to the database length are 100, 100, and 150
+    assert model.letters_per_second_per_cpu == 100
+    assert math.isclose(model.seq_cost(900), (900 + overhead) / 100)
+
+    with pytest.raises(UserReportError):
+        get_work_model('blastp', run_summary_files=[str(tmpdir.join('missing.json'))])
+
+
 @patch(target='elastic_blast.tuner.aws_get_machine_properties', new=MagicMock(return_value=InstanceProperties(32, 128)))
 def test_aws_get_mem_limit():
     """Test getting search job memory limit for AWS"""
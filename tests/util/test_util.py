@@ -28,6 +28,7 @@ import os
 import unittest
 from unittest.mock import patch, MagicMock
 import re
+from timeit import default_timer as timer
 
 from elastic_blast import util
 from elastic_blast.constants import ELB_DFLT_GCP_MACHINE_TYPE
@@ -388,3 +389,16 @@ def test_get_blastdb_info(mocker):
     mocker.patch('elastic_blast.util.safe_exec', side_effect=safe_exec_gsutil_ls_exception)
     with pytest.raises(ValueError):
         util.get_blastdb_info(DB, gcp_prj)
+
+
+def test_token_bucket():
+    """Test that TokenBucket allows a burst of capacity calls, then limits the
+    rate"""
+    bucket = util.TokenBucket(rate=100, capacity=5)
+    start = timer()
+    for _ in range(5):
+        bucket.acquire()
+    assert timer() - start < 0.05
+    for _ in range(10):
+        bucket.acquire()
+    assert timer() - start >= 0.09
@@ -40,7 +40,9 @@ from unittest.mock import MagicMock, patch
 from botocore.exceptions import ClientError
 from elastic_blast.util import SafeExecError
 from elastic_blast import config
+from elastic_blast import gcs
 from elastic_blast.elb_config import ElasticBlastConfig
+from elastic_blast.aws_traits import clear_boto_cache
 from elastic_blast.constants import ElbCommand
 from elastic_blast.constants import ELB_DFLT_AWS_REGION, CLUSTER_ERROR
 from typing import Optional, List, Union, Dict
@@ -118,7 +120,8 @@ class MockedCompletedProcess:
                  returncode: int = 0,
                  subprocess_run_called: bool = True,
                  storage: Optional[Dict[str, str]] = None,
-                 key: Optional[str] = None):
+                 key: Optional[str] = None,
+                 universal_newlines: bool = True):
         """Class constructor
         Arguments:
             stdout: Called process stdout
@@ -127,20 +130,36 @@ class MockedCompletedProcess:
             subprocess_run_called: Differentiates between objects created by
                                    subprocess.run and subprocess.Popen
             storage: Object simulating cloud storage (not needed in most cases)
-            key: Cloud storage object key (not needed in most cases)"""
+            key: Cloud storage object key (not needed in most cases)
+            universal_newlines: Popen streams are text, otherwise binary"""
         if subprocess_run_called:
             self.stdout: Optional[bytes] = str.encode(stdout)
             self.stderr: Optional[bytes] = str.encode(stderr)
         else:
             # when CompletedProcess is created by subprocess.Popen,
             # CompletedProcess.stdout and CompletedProcess.stderr are streams
-            self.stdout = io.StringIO(stdout)
-            self.stderr = io.StringIO(stderr)
+            if universal_newlines:
+                self.stdout = io.StringIO(stdout)
+                self.stderr = io.StringIO(stderr)
+            else:
+                self.stdout = io.BytesIO(stdout.encode())
+                self.stderr = io.BytesIO(stderr.encode())
         self.returncode: int = returncode
         self.stdin = MagicMock()
         self.storage = storage
         self.key = key
 
+    def poll(self) -> int:
+        """Simulate checking if a process started by subprocess.Popen exited"""
+        return self.returncode
+
+    def wait(self, timeout: Optional[float] = None) -> int:
+        """Simulate waiting for a process started by subprocess.Popen"""
+        return self.returncode
+
+    def kill(self) -> None:
+        pass
+
     def communicate(self, arg):
         """Simulate writing subprocess stdin to a cloud storage object.
         This function is used in elastic_blast.fileheloper.check_dir_for_write
@@ -199,9 +218,16 @@ def gke_mock(mocker):
     mocker.patch('boto3.client', side_effect=mock.mocked_client)
     mocker.patch('botocore.exceptions.ClientError.__init__', new=MagicMock(return_value=None))
     mocker.patch.dict(os.environ, {'ELB_PAUSE_AFTER_INIT_PV': '1'})
+    # shared boto3 clients must be created with mocked boto3 functions
+    clear_boto_cache()
+    # GCS is accessed with mocked gsutil rather than the in-process client
+    mocker.patch.dict(os.environ, {'ELB_USE_GSUTIL': '1'})
+    gcs.clear_gcs_client()
 
     yield mock
     del mock
+    clear_boto_cache()
+    gcs.clear_gcs_client()
 
 
 # constants used in mocked_safe_exec
@@ -347,12 +373,12 @@ def mocked_safe_exec(cmd: Union[List[str], str], cloud_state: CloudResources = N
     elif cmd[0] == 'kubectl' and 'get pods -o custom-columns=STATUS' in ' '.join(cmd):
         return MockedCompletedProcess('\n'.join(['STATUS'] + ['Running' for i in K8S_JOB_STATUS if i == 'Running']))
 
-    elif cmd[0] == 'kubectl' and 'get jobs -o custom-columns=STATUS' in ' '.join(cmd):
+    elif cmd[0] == 'kubectl' and 'get jobs -o custom-columns=APP' in ' '.join(cmd):
         switcher = {'Failed': 'Failed',
                     'Succeeded': 'Complete',
                     'Running': '<none>',
                     'Pending': '<none>'}
-        return MockedCompletedProcess('\n'.join(['STATUS'] + [switcher[i] for i in K8S_JOB_STATUS]))
+        return MockedCompletedProcess('\n'.join([f'blast {switcher[i]} <none> <none> <none>' for i in K8S_JOB_STATUS]))
 
     # delete all jobs
     elif cmd[0] == 'kubectl' and 'delete jobs' in ' '.join(cmd):
@@ -506,9 +532,9 @@ class GKEMock:
         # open_for_read
         if ' '.join(cmd).startswith('gsutil') and 'cat' in cmd:
             if cmd[-1] in self.cloud.storage:
-                return MockedCompletedProcess(stdout=self.cloud.storage[cmd[-1]], stderr='', subprocess_run_called=False)
+                return MockedCompletedProcess(stdout=self.cloud.storage[cmd[-1]], stderr='', subprocess_run_called=False, universal_newlines=universal_newlines)
             else:
-                return MockedCompletedProcess(returncode=1, stdout='', stderr=f'Object "{cmd[-1]}" does not exist', subprocess_run_called=False)
+                return MockedCompletedProcess(returncode=1, stdout='', stderr=f'Object "{cmd[-1]}" does not exist', subprocess_run_called=False, universal_newlines=universal_newlines)
         # test dir for write
         elif ' '.join(cmd).startswith('gsutil') and 'cp' in cmd and '-' in cmd:
             if '/'.join(cmd[-1].split('/')[:-1]) in self.cloud.storage:
@@ -582,9 +608,12 @@ def aws_credentials():
     os.environ['AWS_SESSION_TOKEN'] = 'testing'
     os.environ['AWS_ACCT'] = 'testing'
     os.environ['AWS_DEFAULT_REGION'] = ELB_DFLT_AWS_REGION
+    clear_boto_cache()
 
     yield
 
+    clear_boto_cache()
+
     # Cleanup
     # bring back pre-test environment
     for i in saved_vars:
@@ -671,6 +700,11 @@ class MockedS3Client:
             raise
         return {'Body': MockedStream(self.storage[key])}
 
+    def upload_file(self, Filename, Bucket, Key):
+        """Upload a local file to the cloud bucket"""
+        with open(Filename) as f:
+            self.storage[f's3://{Bucket}/{Key}'] = f.read()
+
 
 class MockedStsClient:
     """Mocked boto3 STS client object"""
@@ -697,3 +731,38 @@ class MockedCloudformationResource:
     def Stack(self, name):
         """Mocked create stack object"""
         return MockedCloudformationStack(name)
+
+
+GSUTIL_STUB = """#!/usr/bin/env python3
+# gsutil serving gs:// objects from a local directory: cat and ls only
+import os, sys, glob
+root = os.environ['GSUTIL_STUB_ROOT']
+args = [a for a in sys.argv[1:] if a != '-u']
+cmd, url = args[-2:]
+path = os.path.join(root, url[len('gs://'):])
+if cmd == 'cat' and os.path.isfile(path):
+    sys.stdout.buffer.write(open(path, 'rb').read())
+    sys.exit(0)
+if cmd == 'ls' and glob.glob(path):
+    print('\\n'.join('gs://' + os.path.relpath(p, root) for p in sorted(glob.glob(path))))
+    sys.exit(0)
+sys.stderr.write(f'CommandException: No URLs matched: {url}\\n')
+sys.exit(1)
+"""
+
+
+@pytest.fixture
+def gsutil_stub(tmpdir, monkeypatch):
+    """Local gsutil replacement in PATH, objects gs://<path> are read from
+    files <root>/<path> where root is the yielded directory. The in-process
+    GCS client is disabled, so that gsutil is used."""
+    root = tmpdir.mkdir('gsutil-root')
+    bindir = tmpdir.mkdir('gsutil-bin')
+    stub = bindir.join('gsutil')
+    stub.write(GSUTIL_STUB)
+    stub.chmod(0o755)
+    monkeypatch.setenv('PATH', f'{bindir}{os.pathsep}{os.environ["PATH"]}')
+    monkeypatch.setenv('GSUTIL_STUB_ROOT', str(root))
+    for module in ('elastic_blast.gcs', 'elastic_blast.filehelper', 'elastic_blast.commands.merge'):
+        monkeypatch.setattr(f'{module}.get_gcs_client', lambda: None)
+    yield root
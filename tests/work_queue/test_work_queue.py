@@ -0,0 +1,192 @@
+#                           PUBLIC DOMAIN NOTICE
+#              National Center for Biotechnology Information
+#
+# This software is a "United States Government Work" under the
+# terms of the United States Copyright Act.  It was written as part of
+# the authors' official duties as United States Government employees and
+# thus cannot be copyrighted.  This software is freely available
+# to the public for use.  The National Library of Medicine and the U.S.
+# Government have not placed any restriction on its use or reproduction.
+#
+# Although all reasonable efforts have been taken to ensure the accuracy
+# and reliability of the software and data, the NLM and the U.S.
+# Government do not and cannot warrant the performance or results that
+# may be obtained by using this software or data.  The NLM and the U.S.
+# Government disclaim all warranties, express or implied, including
+# warranties of performance, merchantability or fitness for any particular
+# purpose.
+#
+# Please cite NCBI in any work or product based on this material.
+
+"""
+Unit tests for the work queue of persistent search workers
+
+"""
+
+import os
+import sys
+import json
+import hashlib
+from datetime import datetime, timezone
+from unittest.mock import MagicMock
+from botocore.exceptions import ClientError  # type: ignore
+import pytest
+
+# work queue module is shipped with the worker script in the docker image
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', '..', 'docker-blast'))
+import work_queue
+from work_queue import WorkQueue
+
+BATCHES = [f's3://results/query_batches/batch_{i:03d}.fa' for i in range(3)]
+
+
+class FakeS3:
+    """Minimal S3 client with conditional writes. Modification times are
+    taken from work_queue.time.time(), so that tests can move the clock."""
+
+    class NoSuchKey(Exception):
+        pass
+
+    def __init__(self):
+        self.objects = {}
+        self.modified = {}
+        self.exceptions = MagicMock(NoSuchKey=self.NoSuchKey, ClientError=ClientError)
+
+    def get_object(self, Bucket, Key):
+        if (Bucket, Key) not in self.objects:
+            raise self.NoSuchKey()
+        body = self.objects[(Bucket, Key)]
+        return {'Body': MagicMock(read=lambda: body), 'ETag': self._etag(body)}
+
+    def put_object(self, Bucket, Key, Body, IfMatch=None, IfNoneMatch=None):
+        current = self.objects.get((Bucket, Key))
+        if (IfNoneMatch and current is not None) or \
+           (IfMatch and (current is None or self._etag(current) != IfMatch)):
+            raise ClientError({'Error': {'Code': 'PreconditionFailed'}}, 'PutObject')
+        self.objects[(Bucket, Key)] = Body
+        self.modified[(Bucket, Key)] = datetime.fromtimestamp(work_queue.time.time(), timezone.utc)
+        return {'ETag': self._etag(Body)}
+
+    def get_paginator(self, name):
+        def paginate(Bucket, Prefix):
+            yield {'Contents': [{'Key': key, 'ETag': self._etag(body),
+                                 'LastModified': self.modified[(bucket, key)]}
+                                for (bucket, key), body in self.objects.items()
+                                if bucket == Bucket and key.startswith(Prefix)]}
+        return MagicMock(paginate=paginate)
+
+    @staticmethod
+    def _etag(body):
+        return '"' + hashlib.md5(body).hexdigest() + '"'
+
+
+@pytest.fixture(params=['local', 's3'])
+def location(request, tmpdir):
+    """Queue location in a local directory or in a mocked S3 bucket"""
+    if request.param == 'local':
+        yield str(tmpdir.join('queue')), None
+    else:
+        yield 's3://results/metadata/work-queue', FakeS3()
+
+
+def make_queue(location, worker_id, **kwargs):
+    url, client = location
+    return WorkQueue(url, worker_id, client=client, **kwargs)
+
+
+def test_init(location):
+    """Test that the queue is filled only once"""
+    queue = make_queue(location, 'worker-1')
+    assert not queue.exists()
+    assert queue.init(BATCHES)
+    assert not make_queue(location, 'worker-2').init(BATCHES[:1])
+    assert make_queue(location, 'worker-3').batches() == BATCHES
+
+
+def test_claim_and_finish(location):
+    """Test that every batch is claimed by a single worker"""
+    workers = [make_queue(location, f'worker-{i}') for i in range(2)]
+    workers[0].init(BATCHES)
+    items = [workers[0].claim(), workers[1].claim(), workers[0].claim()]
+    assert [(item.index, item.query) for item in items] == list(enumerate(BATCHES))
+    assert workers[1].claim() is None
+    assert not workers[0].drained()
+    assert workers[0].finish(items[0])
+    assert workers[1].finish(items[1], failed=True)
+    assert not workers[1].drained()
+    assert workers[0].finish(items[2])
+    assert workers[1].drained()
+    assert workers[1].claim() is None
+    url, client = location
+    if client:
+        states = {key: json.loads(body)['state'] for (_, key), body in client.objects.items()
+                  if '/items/' in key}
+    else:
+        states = {f'items/{name}': json.load(open(os.path.join(url, 'items', name)))['state']
+                  for name in os.listdir(os.path.join(url, 'items')) if not name.startswith('.')}
+    assert sorted(states.values()) == ['done', 'done', 'failed']
+
+
+def test_requeue_expired_lease(location, monkeypatch):
+    """Test that a batch claimed by a worker that stopped renewing its lease
+    is claimed again by another worker, and the first worker cannot finish it"""
+    now = 1000.0
+    monkeypatch.setattr(work_queue.time, 'time', lambda: now)
+    crashed = make_queue(location, 'crashed', lease_seconds=60)
+    crashed.init(BATCHES[:1])
+    lost = crashed.claim()
+    assert lost
+    worker = make_queue(location, 'worker', lease_seconds=60)
+    assert worker.claim() is None
+
+    # renewed lease is not reclaimed
+    now += 50
+    assert crashed.renew(lost)
+    now += 50
+    assert worker.claim() is None
+
+    now += 61
+    item = worker.claim()
+    assert item and item.index == lost.index
+    assert not crashed.renew(lost)
+    assert not crashed.finish(lost)
+    assert worker.finish(item)
+    assert worker.drained()
+
+    # finished batches are not requeued
+    now += 1000
+    assert worker.claim() is None
+
+
+def test_poll_without_reading_items(location, monkeypatch):
+    """Test that polling a queue whose batches are claimed by other workers
+    with unexpired leases, or finished, does not read any items"""
+    workers = [make_queue(location, f'worker-{i}') for i in range(2)]
+    workers[0].init(BATCHES)
+    items = [workers[0].claim() for _ in BATCHES]
+    assert workers[0].finish(items[0])
+    assert workers[1].batches() == BATCHES
+    reads = []
+    real_get = workers[1].store.get
+    monkeypatch.setattr(workers[1].store, 'get', lambda key: reads.append(key) or real_get(key))
+    for _ in range(3):
+        assert workers[1].claim() is None
+        assert not workers[1].drained()
+    assert reads == []
+
+
+def test_interrupted_finish(location, monkeypatch):
+    """Test that a batch whose worker stopped after recording its state, but
+    before marking it finished, is not searched again and the queue drains"""
+    now = 1000.0
+    monkeypatch.setattr(work_queue.time, 'time', lambda: now)
+    crashed = make_queue(location, 'crashed', lease_seconds=60)
+    crashed.init(BATCHES[:1])
+    item = crashed.claim()
+    assert crashed._update(item, work_queue.STATE_FAILED)
+    worker = make_queue(location, 'worker', lease_seconds=60)
+    assert worker.claim() is None
+    assert not worker.drained()
+    now += 61
+    assert worker.claim() is None
+    assert worker.drained()